@@ -0,0 +1,157 @@
+# --- START OF FILE ContextCache.py ---
+
+import os
+import json
+import time
+import hashlib
+import datetime
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+CACHE_ENDPOINT_ENV_VAR = "TRANSGEMINI_CACHE_ENDPOINT" # Например, адрес локального тестового сервера
+DEFAULT_CACHE_ENDPOINT = "https://generativelanguage.googleapis.com/v1beta"
+CONTEXT_CACHE_TTL_SECONDS = 3600 # Время жизни кэша системной инструкции
+CONTEXT_CACHE_REFRESH_MARGIN_SECONDS = 300 # Продлеваем кэш, если до истечения осталось меньше
+CONTEXT_CACHE_MIN_CHARS = 4096 # ~1024 токенов: более короткие инструкции API кэшировать не дает
+CONTEXT_CACHE_RETRY_SECONDS = 600 # Пауза после временной ошибки создания кэша
+CONTEXT_CACHE_HTTP_TIMEOUT = 60
+
+
+def prompt_hash(system_instruction):
+    """Возвращает хэш текста системной инструкции."""
+    return hashlib.sha256(system_instruction.encode("utf-8")).hexdigest()
+
+
+def _parse_expire_time(value):
+    """Преобразует expireTime из ответа API (RFC 3339) в epoch или None."""
+    if not value:
+        return None
+    try:
+        value = value.rstrip("Z")
+        if "." in value:
+            # Python < 3.11 не принимает больше 6 знаков дробной части
+            head, fraction = value.split(".", 1)
+            value = f"{head}.{fraction[:6]}"
+        return datetime.datetime.fromisoformat(value).replace(tzinfo=datetime.timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+class ContextCacheError(Exception):
+    """Ошибка запроса к API кэширования контекста."""
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def is_permanent(self):
+        # 400/403/404 - модель не поддерживает кэш или инструкция слишком короткая: повторять бессмысленно
+        return self.status in (400, 403, 404)
+
+
+class ContextCacheManager:
+    """Кэширует статическую системную инструкцию через API cachedContents.
+
+    Для каждой тройки (модель, ключ, хэш промпта) кэш создается один раз и используется
+    всеми чанками задачи; перед истечением TTL он продлевается. Если кэширование
+    не поддерживается (модель, ключ, слишком короткий промпт), get_cache_name() возвращает
+    None и запросы идут с обычной системной инструкцией.
+    Адрес API задается параметром endpoint или переменной TRANSGEMINI_CACHE_ENDPOINT.
+    """
+    def __init__(self, endpoint=None, ttl_seconds=CONTEXT_CACHE_TTL_SECONDS,
+                 refresh_margin_seconds=CONTEXT_CACHE_REFRESH_MARGIN_SECONDS,
+                 min_chars=CONTEXT_CACHE_MIN_CHARS, log_callback=None):
+        self.endpoint = (endpoint or os.environ.get(CACHE_ENDPOINT_ENV_VAR) or DEFAULT_CACHE_ENDPOINT).rstrip("/")
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.min_chars = min_chars
+        self.log_callback = log_callback or print
+        self.entries = {} # {(model_id, api_key, хэш): {'name', 'expire', 'disabled_until'}}
+        self.lock = threading.Lock()
+        self._entry_locks = {}
+
+    def _request(self, method, path, api_key, body=None, query=None):
+        params = dict(query or {})
+        params["key"] = api_key
+        url = f"{self.endpoint}/{path}?{urllib.parse.urlencode(params)}"
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        request = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=CONTEXT_CACHE_HTTP_TIMEOUT) as response:
+                payload = response.read()
+        except urllib.error.HTTPError as e:
+            detail = e.read().decode("utf-8", "replace")[:300]
+            raise ContextCacheError(f"HTTP {e.code}: {detail}", status=e.code) from e
+        except (urllib.error.URLError, OSError) as e:
+            raise ContextCacheError(f"Сетевая ошибка: {e}") from e
+        return json.loads(payload) if payload else {}
+
+    def _create(self, api_key, model_id, system_instruction):
+        body = {
+            "model": model_id,
+            "systemInstruction": {"parts": [{"text": system_instruction}]},
+            "ttl": f"{self.ttl_seconds}s",
+        }
+        result = self._request("POST", "cachedContents", api_key, body)
+        if not result.get("name"):
+            raise ContextCacheError("Ответ API не содержит имени кэша")
+        return result["name"], _parse_expire_time(result.get("expireTime")) or time.time() + self.ttl_seconds
+
+    def _refresh(self, api_key, name):
+        result = self._request("PATCH", name, api_key, {"ttl": f"{self.ttl_seconds}s"}, query={"updateMask": "ttl"})
+        return _parse_expire_time(result.get("expireTime")) or time.time() + self.ttl_seconds
+
+    def get_cache_name(self, api_key, model_id, system_instruction):
+        """Возвращает имя кэша (cachedContents/...) для инструкции или None, если кэш недоступен."""
+        if not api_key or not system_instruction or len(system_instruction) < self.min_chars:
+            return None
+        entry_key = (model_id, api_key, prompt_hash(system_instruction))
+        with self.lock:
+            entry = self.entries.setdefault(entry_key, {"name": None, "expire": 0.0, "disabled_until": 0.0})
+            entry_lock = self._entry_locks.setdefault(entry_key, threading.Lock())
+        # Потоки одной тройки ждут друг друга, чтобы не создавать кэш дважды
+        with entry_lock:
+            now = time.time()
+            if entry["disabled_until"] > now:
+                return None
+            if entry["name"] and entry["expire"] - now > self.refresh_margin_seconds:
+                return entry["name"]
+            try:
+                if entry["name"] and entry["expire"] > now:
+                    try:
+                        entry["expire"] = self._refresh(api_key, entry["name"])
+                        return entry["name"]
+                    except ContextCacheError as e:
+                        self.log_callback(f"[CACHE] Не удалось продлить кэш {entry['name']}: {e}. Создаем новый.")
+                entry["name"], entry["expire"] = self._create(api_key, model_id, system_instruction)
+                self.log_callback(f"[CACHE] Системная инструкция закэширована для {model_id} (ключ ...{api_key[-4:]}): {entry['name']}")
+                return entry["name"]
+            except ContextCacheError as e:
+                entry["name"], entry["expire"] = None, 0.0
+                entry["disabled_until"] = float("inf") if e.is_permanent else now + CONTEXT_CACHE_RETRY_SECONDS
+                self.log_callback(f"[CACHE] Кэширование для {model_id} (ключ ...{api_key[-4:]}) недоступно, используем обычную инструкцию: {e}")
+                return None
+
+    def invalidate(self, api_key, model_id, system_instruction, disable=False):
+        """Забывает кэш (например, API сообщил, что он удален); при disable=True больше не пытается его создавать."""
+        entry_key = (model_id, api_key, prompt_hash(system_instruction))
+        with self.lock:
+            entry = self.entries.get(entry_key)
+            if entry is not None:
+                entry["name"], entry["expire"] = None, 0.0
+                if disable:
+                    entry["disabled_until"] = float("inf")
+
+    def release_all(self):
+        """Удаляет созданные кэши (по окончании задачи), чтобы не платить за хранение до истечения TTL."""
+        with self.lock:
+            active = [(entry_key[1], entry["name"]) for entry_key, entry in self.entries.items() if entry["name"]]
+            self.entries.clear()
+            self._entry_locks.clear()
+        for api_key, name in active:
+            try:
+                self._request("DELETE", name, api_key)
+            except ContextCacheError as e:
+                self.log_callback(f"[CACHE] Не удалось удалить кэш {name}: {e}")
@@ -4,57 +4,32 @@ import sys
 import os
 import json
 import subprocess
-import importlib.util
 
-# --- БЛОК АВТОМАТИЧЕСКОЙ УСТАНОВКИ ЗАВИСИМОСТЕЙ ---
+# --- БЛОК ПРОВЕРКИ ЗАВИСИМОСТЕЙ ---
 
-REQUIRED_PACKAGES = {
-    "PyQt6": "PyQt6",
-    "ebooklib": "ebooklib",
-    "bs4": "beautifulsoup4",
-    "google.generativeai": "google-generativeai",
-    "lxml": "lxml"
-}
-
-def check_and_install_dependencies():
-    """Проверяет наличие необходимых библиотек и предлагает их установить."""
-    missing_packages = []
-    for import_name, install_name in REQUIRED_PACKAGES.items():
-        spec = importlib.util.find_spec(import_name)
-        if spec is None:
-            missing_packages.append(install_name)
+from transgemini_core.capabilities import check_dependencies, format_dependency_report, PACKAGE_NAMES
 
-    if not missing_packages:
+def check_dependencies_or_report():
+    """Проверяет наличие необходимых библиотек и только сообщает об отсутствующих (ничего не устанавливает)."""
+    missing_required, _ = check_dependencies("launcher")
+    if not missing_required:
         return True
 
+    report = format_dependency_report("launcher")
+    print(report, file=sys.stderr)
+    if "PyQt6" in missing_required:
+        return False # Окно с сообщением показать нечем, отчета в консоли достаточно
+
     from PyQt6.QtWidgets import QApplication, QMessageBox
     app = QApplication.instance() or QApplication(sys.argv)
+    install_cmd = "pip install " + " ".join(PACKAGE_NAMES.get(name, name) for name in missing_required)
+    QMessageBox.critical(None, "Отсутствуют библиотеки",
+                         "Не найдены библиотеки, необходимые для работы программы:\n\n"
+                         + "\n".join(f"- {PACKAGE_NAMES.get(name, name)}" for name in missing_required)
+                         + f"\n\nУстановите их вручную командой:\n{install_cmd}")
+    return False
 
-    package_list = "\n".join(f"- {pkg}" for pkg in missing_packages)
-    msg_box = QMessageBox()
-    msg_box.setIcon(QMessageBox.Icon.Warning)
-    msg_box.setText(f"Обнаружены отсутствующие библиотеки, необходимые для работы программы:\n\n{package_list}\n\nРазрешить их автоматическую установку с помощью pip?")
-    msg_box.setWindowTitle("Установка зависимостей")
-    msg_box.setStandardButtons(QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
-    
-    response = msg_box.exec()
-
-    if response == QMessageBox.StandardButton.Yes:
-        try:
-            for package in missing_packages:
-                print(f"Установка {package}...")
-                subprocess.check_call([sys.executable, "-m", "pip", "install", package])
-            
-            QMessageBox.information(None, "Успех", "Все библиотеки были успешно установлены. Пожалуйста, перезапустите программу, чтобы изменения вступили в силу.")
-            sys.exit(0)
-        except subprocess.CalledProcessError as e:
-            QMessageBox.critical(None, "Ошибка установки", f"Не удалось установить библиотеки. Пожалуйста, установите их вручную командой:\npip install {' '.join(missing_packages)}\n\nОшибка: {e}")
-            return False
-    else:
-        QMessageBox.critical(None, "Отмена", "Установка отменена. Программа не может продолжить работу без необходимых библиотек.")
-        return False
-
-# --- КОНЕЦ БЛОКА УСТАНОВКИ ---
+# --- КОНЕЦ БЛОКА ПРОВЕРКИ ---
 
 
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
@@ -62,6 +37,8 @@ from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QH
 from PyQt6.QtCore import Qt, QThread, pyqtSignal
 from PyQt6.QtGui import QIntValidator
 
+from QuotaLedger import get_default_ledger
+
 # ИЗМЕНЕНО: Структура моделей и их ID взяты из предоставленного вами скрипта
 MODELS = {
     "Gemini 2.5 Flash Preview (10 RPM)": {
@@ -340,6 +317,12 @@ class LauncherWindow(QMainWindow):
         self.run_worker(epub_file, output_dir, threads, model_id, model_rpm, prompt)
 
     def run_worker(self, epub_file, output_dir, threads, model_id, model_rpm, prompt):
+        # Пропускаем ключи, квота которых уже исчерпана по данным общего журнала квот
+        ledger = get_default_ledger()
+        while self.current_key_index < len(self.api_keys) and ledger.is_exhausted(self.api_keys[self.current_key_index], model_id):
+            self.log_area.append(f"Skipping API key {self.current_key_index + 1}: quota exhausted until reset (shared quota ledger).")
+            self.current_key_index += 1
+
         if self.current_key_index >= len(self.api_keys):
             self.log_area.append("Error: All API keys exhausted.")
             self.start_button.setEnabled(True)
@@ -397,7 +380,7 @@ class LauncherWindow(QMainWindow):
         event.accept()
 
 if __name__ == "__main__":
-    if check_and_install_dependencies():
+    if check_dependencies_or_report():
         app = QApplication(sys.argv)
         window = LauncherWindow()
         window.show()
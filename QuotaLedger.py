@@ -0,0 +1,221 @@
+# --- START OF FILE QuotaLedger.py ---
+
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import datetime
+
+try:
+    from zoneinfo import ZoneInfo
+    _QUOTA_TZ = ZoneInfo("America/Los_Angeles")  # Дневные квоты Gemini сбрасываются в полночь по тихоокеанскому времени
+except Exception:
+    _QUOTA_TZ = datetime.timezone(datetime.timedelta(hours=-8))
+
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+LEDGER_ENV_VAR = "TRANSGEMINI_QUOTA_LEDGER"
+DEFAULT_LEDGER_PATH = os.path.join(os.path.expanduser("~"), ".transgemini", "quota_ledger.json")
+LEDGER_KEEP_DAYS = 3 # Сколько дней хранить записи о запросах
+
+
+def key_fingerprint(api_key):
+    """Возвращает короткий отпечаток ключа: сами ключи на диск не пишутся."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def current_quota_day(now=None):
+    """Возвращает дату квотного дня (по тихоокеанскому времени) в формате YYYY-MM-DD."""
+    moment = datetime.datetime.fromtimestamp(now if now is not None else time.time(), _QUOTA_TZ)
+    return moment.date().isoformat()
+
+
+def next_quota_reset(now=None):
+    """Возвращает время (epoch) ближайшего сброса дневной квоты."""
+    moment = datetime.datetime.fromtimestamp(now if now is not None else time.time(), _QUOTA_TZ)
+    next_midnight = datetime.datetime.combine(moment.date() + datetime.timedelta(days=1), datetime.time(0, 0), _QUOTA_TZ)
+    return next_midnight.timestamp()
+
+
+def is_daily_quota_error(error):
+    """Проверяет, что ошибка 429 вызвана дневной квотой, а не поминутным лимитом."""
+    error_lower = str(error).lower()
+    return "perday" in error_lower or "per day" in error_lower or "requests_per_day" in error_lower
+
+
+class _FileLock:
+    """Межпроцессная блокировка на отдельном lock-файле (flock / msvcrt.locking)."""
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self._handle = None
+
+    def __enter__(self):
+        self._handle = open(self.lock_path, "a+b")
+        if sys.platform == "win32":
+            self._handle.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._handle.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.05)
+        else:
+            fcntl.flock(self._handle.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if sys.platform == "win32":
+                self._handle.seek(0)
+                msvcrt.locking(self._handle.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._handle.close()
+            self._handle = None
+
+
+class QuotaLedger:
+    """Общий для всех процессов журнал квот: ключ -> модель -> счетчики за день и время сброса.
+
+    Данные лежат в JSON-файле, изменения выполняются под межпроцессной блокировкой
+    и записываются атомарно. Чтение идет из кэша, который перечитывается при изменении файла.
+    """
+    def __init__(self, path=None):
+        self.path = path or os.environ.get(LEDGER_ENV_VAR) or DEFAULT_LEDGER_PATH
+        self.lock_path = self.path + ".lock"
+        self._cache = {"keys": {}}
+        self._cache_mtime = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+    def _read_file(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict) and isinstance(data.get("keys"), dict):
+                return data
+        except (FileNotFoundError, json.JSONDecodeError, OSError):
+            pass
+        return {"keys": {}}
+
+    def _write_file(self, data):
+        fd, tmp_path = tempfile.mkstemp(prefix=".quota_ledger_", dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            try: os.remove(tmp_path)
+            except OSError: pass
+            raise
+
+    def _snapshot(self):
+        """Возвращает актуальные данные журнала, перечитывая файл только при изменении mtime."""
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != self._cache_mtime:
+                self._cache = self._read_file()
+                self._cache_mtime = mtime
+            return self._cache
+
+    def _update(self, api_key, model_id, mutate):
+        """Атомарно изменяет запись (ключ, модель) под межпроцессной блокировкой."""
+        try:
+            with self._lock, _FileLock(self.lock_path):
+                data = self._read_file()
+                now = time.time()
+                today = current_quota_day(now)
+                models = data["keys"].setdefault(key_fingerprint(api_key), {})
+                entry = models.setdefault(model_id or "*", {})
+                if entry.get("day") != today:
+                    entry["day"] = today
+                    entry["requests"] = 0
+                mutate(entry, now)
+                self._prune(data, now)
+                self._write_file(data)
+                self._cache = data
+                try: self._cache_mtime = os.stat(self.path).st_mtime_ns
+                except OSError: self._cache_mtime = None
+        except OSError as e:
+            print(f"[WARN] Журнал квот недоступен ({self.path}): {e}")
+
+    @staticmethod
+    def _prune(data, now):
+        oldest_day = current_quota_day(now - LEDGER_KEEP_DAYS * 86400)
+        for fingerprint in list(data["keys"].keys()):
+            models = data["keys"][fingerprint]
+            for model_id in list(models.keys()):
+                entry = models[model_id]
+                if entry.get("day", oldest_day) < oldest_day and entry.get("exhausted_until", 0) < now:
+                    del models[model_id]
+            if not models:
+                del data["keys"][fingerprint]
+
+    def _entries(self, api_key, model_id):
+        models = self._snapshot()["keys"].get(key_fingerprint(api_key), {})
+        # Запись "*" относится к ключу целиком (например, ключ отозван) и действует для всех моделей
+        return [entry for entry in (models.get(model_id or "*"), models.get("*")) if entry]
+
+    def blocked_until(self, api_key, model_id=None):
+        """Возвращает время (epoch), до которого ключ нельзя использовать для модели, или None."""
+        now = time.time()
+        deadline = max((max(e.get("exhausted_until", 0), e.get("cooldown_until", 0)) for e in self._entries(api_key, model_id)), default=0)
+        return deadline if deadline > now else None
+
+    def is_exhausted(self, api_key, model_id=None):
+        """Проверяет, исчерпана ли дневная квота ключа для модели (по данным любого процесса)."""
+        now = time.time()
+        return any(e.get("exhausted_until", 0) > now for e in self._entries(api_key, model_id))
+
+    def filter_available(self, api_keys, model_id=None):
+        """Возвращает ключи, которые сейчас не исчерпаны и не на паузе, сохраняя порядок."""
+        return [key for key in api_keys if self.blocked_until(key, model_id) is None]
+
+    def get_requests_today(self, api_key, model_id=None):
+        """Возвращает число запросов ключа к модели за текущий квотный день."""
+        today = current_quota_day()
+        models = self._snapshot()["keys"].get(key_fingerprint(api_key), {})
+        entry = models.get(model_id or "*", {})
+        return entry.get("requests", 0) if entry.get("day") == today else 0
+
+    def record_request(self, api_key, model_id=None, count=1):
+        """Учитывает выполненные запросы."""
+        def mutate(entry, now):
+            entry["requests"] = entry.get("requests", 0) + count
+            entry["last_used"] = now
+        self._update(api_key, model_id, mutate)
+
+    def mark_exhausted(self, api_key, model_id=None, until=None, reason=""):
+        """Помечает квоту ключа исчерпанной до момента until (по умолчанию - до сброса дневной квоты)."""
+        def mutate(entry, now):
+            entry["exhausted_until"] = max(entry.get("exhausted_until", 0), until or next_quota_reset(now))
+            entry["reason"] = str(reason)[:300]
+        self._update(api_key, model_id, mutate)
+
+    def mark_cooldown(self, api_key, model_id=None, seconds=0):
+        """Сообщает остальным процессам о временной паузе ключа после 429."""
+        def mutate(entry, now):
+            entry["cooldown_until"] = max(entry.get("cooldown_until", 0), now + max(0.0, seconds))
+        self._update(api_key, model_id, mutate)
+
+
+_default_ledger = None
+_default_ledger_lock = threading.Lock()
+
+def get_default_ledger():
+    """Возвращает общий для процесса экземпляр журнала квот (путь из TRANSGEMINI_QUOTA_LEDGER или по умолчанию)."""
+    global _default_ledger
+    with _default_ledger_lock:
+        if _default_ledger is None:
+            _default_ledger = QuotaLedger()
+        return _default_ledger
@@ -0,0 +1,81 @@
+# --- START OF FILE RateLimiter.py ---
+
+import time
+import asyncio
+import threading
+
+
+class RateLimiter:
+    """Ограничитель частоты запросов с поддержкой всплесков (алгоритм GCRA / token bucket).
+
+    Слот резервируется под блокировкой, а ожидание идет уже без нее, поэтому потоки
+    не выстраиваются в очередь за одним спящим потоком. До burst запросов подряд
+    проходят сразу, дальше - не чаще requests_per_minute в среднем.
+    Есть синхронный wait() для потоков и асинхронный wait_async() для event loop.
+    """
+    def __init__(self, requests_per_minute, burst=1):
+        self.lock = threading.Lock()
+        self.delay_between_requests = 60.0 / requests_per_minute if requests_per_minute and requests_per_minute > 0 else 0.0
+        self.burst = max(1, int(burst or 1))
+        self.next_request_time = 0.0 # Теоретическое время следующего запроса (TAT)
+
+    def set_rate(self, requests_per_minute, burst=None):
+        """Меняет лимит на лету (например, после уточнения RPM по ответам API)."""
+        with self.lock:
+            self.delay_between_requests = 60.0 / requests_per_minute if requests_per_minute and requests_per_minute > 0 else 0.0
+            if burst is not None:
+                self.burst = max(1, int(burst))
+
+    def reserve(self):
+        """Резервирует ближайший слот и возвращает, сколько секунд до него ждать (без сна)."""
+        with self.lock:
+            current_time = time.monotonic()
+            if self.delay_between_requests <= 0:
+                return 0.0
+            arrival_time = max(self.next_request_time, current_time)
+            burst_tolerance = (self.burst - 1) * self.delay_between_requests
+            scheduled_time = max(current_time, arrival_time - burst_tolerance)
+            self.next_request_time = arrival_time + self.delay_between_requests
+        return scheduled_time - current_time
+
+    def try_acquire(self):
+        """Занимает слот, только если он доступен прямо сейчас. Возвращает True/False."""
+        with self.lock:
+            current_time = time.monotonic()
+            if self.delay_between_requests <= 0:
+                return True
+            arrival_time = max(self.next_request_time, current_time)
+            if arrival_time - (self.burst - 1) * self.delay_between_requests > current_time:
+                return False
+            self.next_request_time = arrival_time + self.delay_between_requests
+            return True
+
+    def wait(self):
+        """Синхронное ожидание своего слота."""
+        sleep_time = self.reserve()
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+        return sleep_time
+
+    async def wait_async(self):
+        """Асинхронное ожидание своего слота (не блокирует event loop)."""
+        sleep_time = self.reserve()
+        if sleep_time > 0:
+            await asyncio.sleep(sleep_time)
+        return sleep_time
+
+
+_shared_limiters = {}
+_shared_limiters_lock = threading.Lock()
+
+def get_shared_limiter(name, requests_per_minute, burst=1):
+    """Возвращает общий для процесса ограничитель по имени (например, (api_key, model_id)).
+
+    Все потоки и задачи процесса, работающие с одним ключом и моделью, делят один лимит.
+    """
+    with _shared_limiters_lock:
+        limiter = _shared_limiters.get(name)
+        if limiter is None:
+            limiter = RateLimiter(requests_per_minute, burst)
+            _shared_limiters[name] = limiter
+        return limiter
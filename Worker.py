@@ -10,29 +10,17 @@ from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
 import google.generativeai as genai
 from google.api_core.exceptions import PermissionDenied, ResourceExhausted, InvalidArgument, DeadlineExceeded
-import threading
 import logging
 import random
+import signal
+from concurrent.futures import as_completed
+from QuotaLedger import get_default_ledger, is_daily_quota_error
+from RateLimiter import RateLimiter
 
-class RateLimiter:
-    def __init__(self, requests_per_minute):
-        self.lock = threading.Lock()
-        if requests_per_minute > 0:
-            self.delay_between_requests = 60.0 / requests_per_minute
-        else:
-            self.delay_between_requests = 0
-        self.last_request_time = 0
-
-    def wait(self):
-        with self.lock:
-            current_time = time.monotonic()
-            elapsed = current_time - self.last_request_time
-            
-            if elapsed < self.delay_between_requests:
-                sleep_time = self.delay_between_requests - elapsed
-                time.sleep(sleep_time)
-            
-            self.last_request_time = time.monotonic()
+GLOSSARY_BATCH_CHAR_BUDGET = 120000 # ~30k токенов текста на один запрос
+GLOSSARY_CHAPTER_SAMPLE_CHARS = 12000 # Сколько текста главы попадает в выборку
+GLOSSARY_SAMPLE_WINDOWS = 3 # На сколько фрагментов (начало/середина/конец) делится выборка длинной главы
+SKIPPED_CHAPTER_MARKERS = ["nav.xhtml", "cover", "description", "title", "copyright"]
 
 
 def setup_logging(output_dir):
@@ -108,16 +96,24 @@ def parse_api_response(response):
         logging.error(f"An unexpected error occurred in parse_api_response: {str(e)}")
         return {}
 
-def generate_content_with_retry(model, prompt, chapter_name):
+def generate_content_with_retry(model, prompt, chapter_name, api_key=None, model_name=None):
     max_retries = 5
     base_delay = 5
+    ledger = get_default_ledger()
     for attempt in range(max_retries):
         try:
             response = model.generate_content(prompt, request_options={"timeout": 120})
+            if api_key:
+                ledger.record_request(api_key, model_name)
             return response
         except ResourceExhausted as e:
+            if is_daily_quota_error(e):
+                logging.error(f"Daily quota exhausted while processing chapter {chapter_name}.")
+                raise e
             if attempt < max_retries - 1:
                 delay = base_delay * (2 ** attempt) + random.uniform(0, 1)
+                if api_key:
+                    ledger.mark_cooldown(api_key, model_name, delay)
                 logging.warning(f"Rate limit hit for chapter {chapter_name}. Retrying in {delay:.2f} seconds... (Attempt {attempt + 1}/{max_retries})")
                 time.sleep(delay)
             else:
@@ -129,66 +125,92 @@ def generate_content_with_retry(model, prompt, chapter_name):
 
     return None
 
-def process_chapter(chapter, api_key, model_name, output_dir, lock, rate_limiter, prompt_template):
-    chapter_name = chapter.get_name()
-    if any(x in chapter_name.lower() for x in ["nav.xhtml", "cover", "description", "title", "copyright"]):
-        logging.info(f"Skipping metadata file: {chapter_name}")
-        return chapter_name, None
-
-    start_time = time.time()
+def sample_chapter_text(chapter_text, sample_chars=GLOSSARY_CHAPTER_SAMPLE_CHARS, windows=GLOSSARY_SAMPLE_WINDOWS):
+    """Возвращает выборку из главы: короткая глава целиком, длинная - равномерно расставленными фрагментами."""
+    if len(chapter_text) <= sample_chars:
+        return chapter_text
+    window_chars = sample_chars // windows
+    step = (len(chapter_text) - window_chars) / max(1, windows - 1)
+    fragments = []
+    for i in range(windows):
+        start = int(i * step)
+        # Сдвигаем начало фрагмента к границе слова
+        space_pos = chapter_text.find(" ", start, start + 200)
+        if start > 0 and space_pos != -1:
+            start = space_pos + 1
+        fragments.append(chapter_text[start:start + window_chars])
+    return " [...] ".join(fragments)
+
+def build_extraction_batches(chapter_samples, char_budget=GLOSSARY_BATCH_CHAR_BUDGET):
+    """Упаковывает выборки глав в пакеты не длиннее char_budget. Возвращает [(имена_глав, текст_пакета)]."""
+    batches = []
+    batch_names, batch_parts, batch_size = [], [], 0
+    for chapter_name, sample in chapter_samples:
+        part = f"=== {chapter_name} ===\n{sample}"
+        if batch_parts and batch_size + len(part) > char_budget:
+            batches.append((batch_names, "\n\n".join(batch_parts)))
+            batch_names, batch_parts, batch_size = [], [], 0
+        batch_names.append(chapter_name)
+        batch_parts.append(part)
+        batch_size += len(part) + 2
+    if batch_parts:
+        batches.append((batch_names, "\n\n".join(batch_parts)))
+    return batches
+
+def normalize_term(term):
+    return " ".join(str(term).split()).casefold()
+
+def merge_terms(glossary, known_terms, terms):
+    """Добавляет новые термины в глоссарий в памяти; дубликаты (без учета регистра и пробелов) пропускаются."""
+    added = 0
+    for term, definition in terms.items():
+        normalized = normalize_term(term)
+        if not normalized or normalized in known_terms:
+            continue
+        known_terms.add(normalized)
+        glossary[" ".join(str(term).split())] = definition
+        added += 1
+    return added
+
+def process_batch(batch_index, chapter_names, batch_text, model, api_key, model_name, output_dir, rate_limiter, prompt_template):
+    """Извлекает термины из одного пакета. Возвращает (статус, термины), статус: 'done', 'blocked' или 'skipped'."""
+    batch_label = f"batch {batch_index + 1} ({len(chapter_names)} chapters: {chapter_names[0]} .. {chapter_names[-1]})"
     try:
         if load_progress(output_dir).get("paused", False):
-            return chapter_name, None
-
-        logging.info(f"Processing chapter: {chapter_name}")
-        chapter_text = extract_text_from_chapter(chapter)
-        if not chapter_text.strip():
-            logging.info(f"Chapter {chapter_name} is empty, skipping.")
-            return chapter_name, None
-
-        if load_progress(output_dir).get("paused", False):
-            logging.info(f"Halting API call for {chapter_name}; pause detected.")
-            return chapter_name, None
+            logging.info(f"Halting API call for {batch_label}; pause detected.")
+            return "skipped", None
 
         rate_limiter.wait()
-            
-        logging.info(f"Sending API request for {chapter_name}")
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(model_name)
-        prompt = prompt_template.format(text=chapter_text[:30000])
 
-        response = generate_content_with_retry(model, prompt, chapter_name)
+        logging.info(f"Sending API request for {batch_label}, {len(batch_text)} chars")
+        prompt = prompt_template.format(text=batch_text)
+        response = generate_content_with_retry(model, prompt, batch_label, api_key, model_name)
 
         if response is None:
-            return chapter_name, None
+            return "skipped", None
 
         if response.prompt_feedback and response.prompt_feedback.block_reason:
-            logging.warning(f"Chapter {chapter_name} blocked by API: {response.prompt_feedback.block_reason}")
-            with lock:
-                progress = load_progress(output_dir)
-                blocked_chapters = set(progress.get("blocked_chapters", []))
-                blocked_chapters.add(chapter_name)
-                save_progress(output_dir, progress["processed_chapters"], list(blocked_chapters), progress.get("paused", False))
-            return chapter_name, None
-
-        terms = parse_api_response(response)
-        
-        if terms:
-            with lock:
-                current_glossary = load_glossary(output_dir)
-                for term, definition in terms.items():
-                    if term not in current_glossary:
-                        current_glossary[term] = definition
-                save_glossary(output_dir, current_glossary)
-                logging.info(f"Updated glossary for {chapter_name}. Time taken: {time.time() - start_time:.2f} seconds")
-
-        return chapter_name, terms
+            logging.warning(f"{batch_label} blocked by API: {response.prompt_feedback.block_reason}")
+            return "blocked", None
+
+        return "done", parse_api_response(response)
     except (PermissionDenied, ResourceExhausted) as e:
-        logging.error(f"Permanent API error for chapter {chapter_name}: {str(e)}. Triggering API key switch.")
+        logging.error(f"Permanent API error for {batch_label}: {str(e)}. Triggering API key switch.")
+        # Записываем в общий журнал квот, чтобы следующие задания сразу пропускали этот ключ
+        if isinstance(e, PermissionDenied):
+            get_default_ledger().mark_exhausted(api_key, None, reason=e)
+        elif is_daily_quota_error(e):
+            get_default_ledger().mark_exhausted(api_key, model_name, reason=e)
+        else:
+            get_default_ledger().mark_cooldown(api_key, model_name, 600)
         raise
     except Exception as e:
-        logging.error(f"Critical error processing chapter {chapter_name}: {str(e)}", exc_info=True)
-        return chapter_name, None
+        logging.error(f"Critical error processing {batch_label}: {str(e)}", exc_info=True)
+        return "skipped", None
+
+def _raise_system_exit(signum, frame):
+    # Launcher останавливает процесс через terminate(): сохраняем собранное перед выходом
+    raise SystemExit(0)
 
 # ИЗМЕНЕНО: Добавлен `model_rpm` в аргументы
 def main(epub_path, api_key, output_dir, model_name, num_threads, prompt_template, model_rpm):
@@ -200,6 +222,10 @@ def main(epub_path, api_key, output_dir, model_name, num_threads, prompt_templat
         logging.info("Processing is paused. Please resume from the launcher to continue.")
         sys.exit(0)
 
+    if get_default_ledger().is_exhausted(api_key, model_name):
+        logging.info("API key quota is already exhausted according to the shared quota ledger. Launcher will try next key.")
+        sys.exit(10)
+
     processed_chapters = set(progress.get("processed_chapters", []))
     blocked_chapters = set(progress.get("blocked_chapters", []))
     
@@ -217,45 +243,82 @@ def main(epub_path, api_key, output_dir, model_name, num_threads, prompt_templat
         sys.exit(0)
 
     logging.info(f"Found {len(chapters_to_process)} chapters to process.")
-    lock = threading.Lock()
-    
+
+    # Выборка из всех глав книги, упакованная в пакеты по бюджету токенов
+    chapter_samples = []
+    for chapter in chapters_to_process:
+        chapter_name = chapter.get_name()
+        if any(x in chapter_name.lower() for x in SKIPPED_CHAPTER_MARKERS):
+            logging.info(f"Skipping metadata file: {chapter_name}")
+            continue
+        chapter_text = extract_text_from_chapter(chapter)
+        if not chapter_text.strip():
+            logging.info(f"Chapter {chapter_name} is empty, skipping.")
+            processed_chapters.add(chapter_name)
+            continue
+        chapter_samples.append((chapter_name, sample_chapter_text(chapter_text)))
+
+    batches = build_extraction_batches(chapter_samples)
+    logging.info(f"Packed {len(chapter_samples)} chapters into {len(batches)} batches (up to {GLOSSARY_BATCH_CHAR_BUDGET} chars each).")
+
     # ИЗМЕНЕНО: RateLimiter использует точный RPM, переданный из Launcher
-    rate_limiter = RateLimiter(int(model_rpm))
-    logging.info(f"Rate limiter initialized for {model_rpm} RPM.")
+    # Первые потоки стартуют одновременно, дальше запросы идут не чаще model_rpm в минуту
+    rate_limiter = RateLimiter(int(model_rpm), burst=min(int(num_threads), int(model_rpm)))
+    logging.info(f"Rate limiter initialized for {model_rpm} RPM (burst {rate_limiter.burst}).")
+
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(model_name)
+
+    # Термины собираются в памяти и записываются один раз в конце
+    glossary = load_glossary(output_dir)
+    known_terms = {normalize_term(term) for term in glossary}
+    exit_code = 0
+    signal.signal(signal.SIGTERM, _raise_system_exit)
 
     try:
         with ThreadPoolExecutor(max_workers=int(num_threads)) as executor:
-            from concurrent.futures import as_completed
-            future_to_chapter = {
-                executor.submit(process_chapter, chapter, api_key, model_name, output_dir, lock, rate_limiter, prompt_template): chapter
-                for chapter in chapters_to_process
+            future_to_batch = {
+                executor.submit(process_batch, index, names, text, model, api_key, model_name, output_dir, rate_limiter, prompt_template): names
+                for index, (names, text) in enumerate(batches)
             }
             
-            for future in as_completed(future_to_chapter):
-                chapter_name = future_to_chapter[future].get_name()
+            for future in as_completed(future_to_batch):
+                chapter_names = future_to_batch[future]
+                if future.cancelled():
+                    continue
                 try:
-                    _, terms = future.result()
-                    with lock:
-                        current_progress = load_progress(output_dir)
-                        current_processed = set(current_progress.get("processed_chapters", []))
-                        
-                        if terms is not None:
-                            current_processed.add(chapter_name)
-                            logging.info(f"Completed chapter: {chapter_name}")
-                        
-                        save_progress(output_dir, list(current_processed), current_progress['blocked_chapters'], current_progress.get("paused", False))
+                    status, terms = future.result()
+                except (PermissionDenied, ResourceExhausted):
+                    exit_code = 10
+                    for pending in future_to_batch:
+                        pending.cancel()
+                    continue
                 except Exception as exc:
-                     logging.error(f'Chapter {chapter_name} generated a final exception: {exc}')
+                    logging.error(f'Batch {chapter_names[0]} .. {chapter_names[-1]} generated a final exception: {exc}')
+                    continue
+
+                if status == "blocked":
+                    blocked_chapters.update(chapter_names)
+                elif status == "done":
+                    added = merge_terms(glossary, known_terms, terms or {})
+                    logging.info(f"Batch {chapter_names[0]} .. {chapter_names[-1]}: {len(terms or {})} terms, {added} new.")
+                    for chapter_name in chapter_names:
+                        processed_chapters.add(chapter_name)
+                        logging.info(f"Completed chapter: {chapter_name}")
 
-    except (PermissionDenied, ResourceExhausted):
-        logging.info("Exiting due to persistent API limit. Launcher will try next key.")
-        sys.exit(10)
     except Exception as e:
         logging.error(f"Unexpected error in main loop: {str(e)}", exc_info=True)
-        sys.exit(1)
+        exit_code = 1
+    finally:
+        save_glossary(output_dir, glossary)
+        save_progress(output_dir, processed_chapters, blocked_chapters, load_progress(output_dir).get("paused", False))
+        logging.info(f"Glossary saved: {len(glossary)} terms.")
 
-    logging.info("Processing completed successfully.")
-    sys.exit(0)
+    if exit_code == 10:
+        logging.info("Exiting due to persistent API limit. Launcher will try next key.")
+    elif exit_code == 0:
+        logging.info("Processing completed successfully.")
+    sys.exit(exit_code)
 
 if __name__ == "__main__":
     # ИЗМЕНЕНО: Ожидаем 8 аргументов
@@ -0,0 +1,99 @@
+# --- START OF FILE benchmarks/docx_writer_benchmark.py ---
+"""Бенчмарк записи DOCX: write_markdown_to_docx против эталонной записи через API python-docx.
+
+Генерирует документ ~1 млн символов (заголовки, списки, черты, табуляции, XML-спецсимволы,
+изображения), пишет его обоими способами, сравнивает word/document.xml и печатает время.
+
+    python benchmarks/docx_writer_benchmark.py [--chars 1000000] [--images 20] [--repeat 1]
+"""
+
+import os
+import sys
+import time
+import random
+import zipfile
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transgemini_core.placeholders import create_image_placeholder
+from transgemini_core.writers import write_markdown_to_docx, _write_markdown_to_docx_reference
+
+# Минимальный валидный PNG 1x1
+PNG_1X1 = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082")
+
+WORDS = ("перевод", "глава", "translation", "текст", "R&D", "<тег>", "книга", "\"цитата\"", "слово", "model")
+
+
+def build_document(target_chars, image_count, temp_dir, seed=1):
+    rng = random.Random(seed)
+    image_map = {}
+    for index in range(image_count):
+        img_uuid = f"{index:032x}"
+        saved_path = os.path.join(temp_dir, f"{img_uuid}.png")
+        with open(saved_path, "wb") as f: f.write(PNG_1X1)
+        image_map[img_uuid] = {'saved_path': saved_path, 'content_type': 'image/png',
+                               'original_filename': f"img{index}.png", 'width': rng.choice([None, 120, 900])}
+    image_map["f" * 32] = {'saved_path': os.path.join(temp_dir, "missing.png"), 'original_filename': "missing.png"}
+    image_ids = list(image_map) + ["e" * 32] # Последний - неизвестный UUID
+    lines, total, chapter = [], 0, 0
+    while total < target_chars:
+        kind = rng.random()
+        if kind < 0.03:
+            chapter += 1; line = f"{'#' * rng.randint(1, 3)} Глава {chapter}"
+        elif kind < 0.10:
+            line = f"{rng.choice(['-', '*', '1.', 'a.'])} " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        elif kind < 0.11:
+            line = "---"
+        else:
+            words = [rng.choice(WORDS) for _ in range(rng.randint(20, 120))]
+            if image_ids and rng.random() < 0.05:
+                words.insert(rng.randint(0, len(words)), create_image_placeholder(rng.choice(image_ids)))
+            line = " ".join(words)
+            if rng.random() < 0.1: line = "\t" + line
+            if rng.random() < 0.1: line = "  " + line + " "
+        lines.append(line)
+        lines.append("" if rng.random() < 0.7 else "\n")
+        total += len(line) + 1
+    return "\n".join(lines), image_map
+
+
+def document_xml(path):
+    with zipfile.ZipFile(path) as zf: return zf.read("word/document.xml")
+
+
+def timed(writer, path, text, image_map, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        writer(path, text, image_map)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chars", type=int, default=1_000_000)
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="docx_bench_") as temp_dir:
+        text, image_map = build_document(args.chars, args.images, temp_dir)
+        fast_path = os.path.join(temp_dir, "fast.docx"); reference_path = os.path.join(temp_dir, "reference.docx")
+        print(f"Документ: {len(text):,} символов, {text.count(chr(10)) + 1:,} строк, {args.images} изображений")
+        fast_time = timed(write_markdown_to_docx, fast_path, text, image_map, args.repeat)
+        reference_time = timed(_write_markdown_to_docx_reference, reference_path, text, image_map, args.repeat)
+        same = document_xml(fast_path) == document_xml(reference_path)
+        print(f"write_markdown_to_docx:            {fast_time:8.2f} с")
+        print(f"эталон (API python-docx):          {reference_time:8.2f} с  (x{reference_time / fast_time:.1f})")
+        print(f"word/document.xml совпадает:       {'да' if same else 'НЕТ'}")
+        return 0 if same else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+# --- START OF FILE benchmarks/inline_markdown_benchmark.py ---
+"""Проверка render_inline_markdown на незакрытых маркерах: время должно расти линейно.
+
+Незакрытые *, ** и ` (сноски, "5 * 3") перед длинным текстом раньше вызывали экспоненциальный
+перебор в регулярном выражении. Скрипт рендерит такие абзацы с хвостом words, 2*words, 4*words
+слов и сравнивает время: при x4 длины линейный рост дает ~x4, квадратичный - ~x16.
+
+    python benchmarks/inline_markdown_benchmark.py [--words 20000] [--repeat 3]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transgemini_core.writers import render_inline_markdown
+
+MARKERS = ("*", "**", "`")
+SIZE_FACTORS = (1, 2, 4)
+# При x4 длины время не должно вырасти больше чем в MAX_GROWTH раз (запас на шум таймера над x4)
+MAX_GROWTH = 6
+# Меньшие времена слишком шумные для сравнения; при таком малом --words рост не оценивается
+MIN_MEASURABLE_SECONDS = 0.01
+
+
+def build_paragraph(marker, words):
+    return f"Footnote{marker} here, and the story goes on." + " more words" * words
+
+
+def timed(text, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        render_inline_markdown(text)
+        render_inline_markdown(text, escape_spans=True)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--words", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    failed = False
+    for marker in MARKERS:
+        sizes = [args.words * factor for factor in SIZE_FACTORS]
+        times = [timed(build_paragraph(marker, words), args.repeat) for words in sizes]
+        growth = times[-1] / max(times[0], MIN_MEASURABLE_SECONDS)
+        linear = growth <= MAX_GROWTH
+        failed = failed or not linear
+        timings = "   ".join(f"{words:>7,} слов: {elapsed * 1000:7.1f} мс" for words, elapsed in zip(sizes, times))
+        print(f"незакрытый {marker!r:5} {timings}  (x{growth:.1f}) {'OK' if linear else 'НЕЛИНЕЙНО'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
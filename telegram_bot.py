@@ -10,67 +10,46 @@ import re
 import tempfile
 import asyncio
 import logging
-import subprocess
 import zipfile
 import uuid
 import shutil
 import datetime
 import json
 import time
-import threading
 from pathlib import Path
 from typing import Dict, Any, Optional, List, Union
 
+# Зависимости не устанавливаются во время запуска: без обязательных пакетов бот сразу завершается
+# (проверка без запуска: python -m transgemini_core.capabilities --profile bot)
+from transgemini_core.capabilities import require_dependencies, PACKAGE_NAMES
+MISSING_OPTIONAL_MODULES = require_dependencies("bot")
+
 # Импортируем исключение для обработки ошибок Telegram
 from telegram.error import BadRequest
 
-# Устанавливаем зависимости если не установлены
-def ensure_package(package_name, import_name=None):
-    import_name = import_name or package_name
-    try:
-        __import__(import_name.split('.')[0])
-    except ImportError:
-        print(f"Устанавливаю {package_name}...")
-        subprocess.check_call([sys.executable, "-m", "pip", "install", package_name])
-
-# Устанавливаем необходимые пакеты
-ensure_package("python-telegram-bot==20.7")
-ensure_package("google-generativeai", "google.generativeai")
-ensure_package("python-docx", "docx")
-ensure_package("beautifulsoup4", "bs4")
-ensure_package("lxml")
-ensure_package("PyQt6", "PyQt6")
-ensure_package("ebooklib")
-
 # Импортируем библиотеки Telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 from telegram.constants import ParseMode
 
-# Импортируем функции из TransGemini.py
-from TransGemini import (
+# Импортируем движок перевода из transgemini_core (без Qt; тяжелые зависимости грузятся при первом использовании)
+from transgemini_core import (
     MODELS,
     OUTPUT_FORMATS,
-    Worker,
+    TranslationWorker,
     write_to_epub,
     ApiKeyManager,
-    RateLimitTracker,
-    InitialSetupDialog,
-    TranslationSessionManager,
-    EpubCreator,
-    TranslatedChaptersManagerDialog,
-    ContextManager,
-    DynamicGlossaryFilter,
-    run_translation_with_auto_restart
+    TELEGRAM_MAX_UPLOAD_BYTES,
+    read_text_file,
+    build_chapter_index,
+    count_chapters,
+    translatable_paths,
+    is_translated_html,
 )
+from QuotaLedger import get_default_ledger
 
-# Импортируем Google API исключения для проверки ключа
-try:
-    import google.generativeai as genai
-    from google.api_core import exceptions as google_exceptions
-except ImportError:
-    genai = None
-    google_exceptions = None
+# Google API для проверки ключа (ленивый импорт)
+from transgemini_core.deps import GENAI_AVAILABLE, genai, google_exceptions
 
 # Настройка логирования
 logging.basicConfig(
@@ -79,6 +58,10 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+if MISSING_OPTIONAL_MODULES:
+    logger.warning("Не установлены необязательные пакеты (часть форматов недоступна): pip install "
+                   + " ".join(PACKAGE_NAMES.get(name, name) for name in MISSING_OPTIONAL_MODULES))
+
 # Поддерживаемые форматы файлов (соответствуют TransGemini.py)
 SUPPORTED_FORMATS = {
     'txt': ['.txt'],
@@ -1416,7 +1399,7 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def validate_api_key(api_key: str) -> tuple[bool, str]:
     """Проверяет валидность API ключа через Google Gemini API"""
     try:
-        if not genai or not google_exceptions:
+        if not GENAI_AVAILABLE:
             return False, "Google API библиотеки не установлены"
             
         # Настраиваем API
@@ -1527,199 +1510,85 @@ async def analyze_file_chapters(update: Update, state: UserState):
         state.step = "translating"
         await show_translation_options(update, state)
 
+def _empty_chapters_info(file_path: Optional[str] = None) -> dict:
+    info = {'total_all': 0, 'total_content': 0, 'all_files': [], 'content_files': [], 'skip_files': [], 'nav_file': None}
+    if file_path:
+        info['original_path'] = file_path
+    return info
+
+def _chapters_info_from_index(index, file_path: str) -> dict:
+    """Словарь для меню выбора глав из компактного индекса (см. transgemini_core.chapter_index)"""
+    chapters_info = _empty_chapters_info(file_path)
+    chapters_info['nav_file'] = index.nav_path
+    chapters_info['total_all'] = len(index.entries)
+    for entry in index.entries:
+        is_content = entry.category == 'content'
+        file_data = {
+            'path': entry.path,
+            'name': Path(entry.path).name,
+            'size': entry.size,
+            'is_nav': entry.category == 'nav',
+            'is_translated': is_translated_html(entry.path),
+            'is_selected': is_content,
+            'category': entry.category,
+            'text_length': entry.text_length,
+            'estimated_tokens': entry.estimated_tokens,
+        }
+        chapters_info['all_files'].append(file_data)
+        chapters_info['content_files' if is_content else 'skip_files'].append(file_data)
+    chapters_info['total_content'] = len(chapters_info['content_files'])
+    return chapters_info
+
+async def get_chapter_index(file_path: str):
+    """Индекс глав EPUB без блокировки event loop: разбор архива идет в пуле потоков, результат кэшируется по хэшу файла"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, build_chapter_index, file_path)
+
 async def get_transgemini_chapters_info(file_path: str, file_format: str) -> dict:
     """Получает информацию о главах используя точную логику TransGemini"""
     try:
         if file_format == 'epub':
-            with zipfile.ZipFile(file_path, 'r') as epub_zip:
-                # Получаем все HTML файлы (как в TransGemini)
-                html_files = sorted([
-                    name for name in epub_zip.namelist()
-                    if name.lower().endswith(('.html', '.xhtml', '.htm'))
-                    and not name.startswith(('__MACOSX', 'META-INF/'))
-                ])
-                
-                # Пытаемся найти NAV файл (как в TransGemini)
-                nav_path = None
-                for html_file in html_files:
-                    if 'nav' in Path(html_file).name.lower():
-                        nav_path = html_file
-                        break
-                
-                chapters_info = {
-                    'all_files': [],
-                    'content_files': [],
-                    'skip_files': [],
-                    'nav_file': nav_path,
-                    'total_all': len(html_files),
-                    'total_content': 0,
-                    'original_path': file_path  # Добавляем путь к оригинальному EPUB
-                }
-                
-                TRANSLATED_SUFFIX = '_translated'  # Константа из TransGemini
-                
-                for file_path_in_epub in html_files:
-                    try:
-                        file_info = epub_zip.getinfo(file_path_in_epub)
-                        file_size = file_info.file_size
-                    except:
-                        file_size = 0
-                    
-                    is_nav = (nav_path and file_path_in_epub == nav_path)
-                    is_translated = Path(file_path_in_epub).stem.endswith(TRANSLATED_SUFFIX)
-                    
-                    file_data = {
-                        'path': file_path_in_epub,
-                        'name': Path(file_path_in_epub).name,
-                        'size': file_size,
-                        'is_nav': is_nav,
-                        'is_translated': is_translated,
-                        'is_selected': False,
-                        'category': 'unknown'
-                    }
-                    
-                    if is_nav:
-                        file_data['category'] = 'nav'
-                        file_data['is_selected'] = False
-                        chapters_info['skip_files'].append(file_data)
-                    else:
-                        # Применяем точную логику TransGemini для определения типа файла
-                        item_text_lower = file_path_in_epub.lower()
-                        path = Path(item_text_lower)
-                        filename_lower = path.name
-                        filename_base = path.stem.split('.')[0]  # Get stem before first dot
-                        
-                        skip_indicators = ['toc', 'nav', 'ncx', 'cover', 'title', 'index', 'copyright', 'about', 'meta', 'opf',
-                                          'masthead', 'colophon', 'imprint', 'acknowledgments', 'dedication',
-                                          'glossary', 'bibliography', 'notes', 'annotations', 'epigraph', 'halftitle',
-                                          'frontmatter', 'backmatter', 'preface', 'introduction', 'appendix', 'biography',
-                                          'isbn', 'legal', 'notice', 'otherbooks', 'prelims', 'team', 'promo', 'bonus']
-                        content_indicators = ['chapter', 'part', 'section', 'content', 'text', 'page', 'body', 'main', 'article',
-                                            'chp', 'chap', 'prt', 'sec', 'glava', 'prologue', 'epilogue']
-                        
-                        is_likely_skip = any(skip in filename_base for skip in skip_indicators)
-                        parent_dir_lower = str(path.parent).lower()
-                        is_likely_skip = is_likely_skip or any(skip in parent_dir_lower for skip in ['toc', 'nav', 'meta', 'frontmatter', 'backmatter', 'index', 'notes'])
-                        is_likely_content = any(indicator in filename_base for indicator in content_indicators)
-                        is_chapter_like = (re.fullmatch(r'(ch|gl|chap|chapter|part|section|sec|glava)[\d_-]+.*', filename_base) or 
-                                          re.fullmatch(r'[\d]+', filename_base) or 
-                                          re.match(r'^[ivxlcdm]+$', filename_base))
-                        
-                        if not is_likely_skip and (is_likely_content or is_chapter_like):
-                            file_data['category'] = 'content'
-                            file_data['is_selected'] = True
-                            chapters_info['content_files'].append(file_data)
-                        else:
-                            if not is_likely_skip and 'text' in filename_base:
-                                file_data['category'] = 'text'
-                                file_data['is_selected'] = True
-                                chapters_info['content_files'].append(file_data)
-                            else:
-                                file_data['category'] = 'skip'
-                                file_data['is_selected'] = False
-                                chapters_info['skip_files'].append(file_data)
-                    
-                    chapters_info['all_files'].append(file_data)
-                
-                chapters_info['total_content'] = len(chapters_info['content_files'])
-                logger.info(f"TransGemini анализ EPUB: {chapters_info['total_content']} глав из {chapters_info['total_all']} файлов")
-                return chapters_info
+            index = await get_chapter_index(file_path)
+            chapters_info = _chapters_info_from_index(index, file_path)
+            logger.info(f"TransGemini анализ EPUB: {chapters_info['total_content']} глав из {chapters_info['total_all']} файлов")
+            return chapters_info
                 
-        return {'total_all': 0, 'total_content': 0, 'all_files': [], 'content_files': [], 'skip_files': [], 'nav_file': None}
+        return _empty_chapters_info()
         
     except Exception as e:
         logger.error(f"Ошибка TransGemini анализа: {e}")
-        return {'total_all': 0, 'total_content': 0, 'all_files': [], 'content_files': [], 'skip_files': [], 'nav_file': None}
+        return _empty_chapters_info()
 
 async def get_chapters_info(file_path: str, file_format: str) -> dict:
-    """Получает детальную информацию о главах в файле"""
+    """Получает детальную информацию о главах в файле (отбор файлов, которые бот отдает на перевод)"""
     try:
         if file_format == 'epub':
-            with zipfile.ZipFile(file_path, 'r') as epub_zip:
-                # Получаем все HTML файлы
-                all_html_files = sorted([
-                    name for name in epub_zip.namelist()
-                    if name.lower().endswith(('.html', '.xhtml', '.htm'))
-                    and not name.startswith(('__MACOSX', 'META-INF/'))
-                ])
+            index = await get_chapter_index(file_path)
+            chapters_info = _chapters_info_from_index(index, file_path)
+            translatable = set(translatable_paths(index))
+            chapters_info['content_files'] = [file_data for file_data in chapters_info['all_files'] if file_data['path'] in translatable]
+            chapters_info['skip_files'] = [file_data for file_data in chapters_info['all_files'] if file_data['path'] not in translatable]
+            chapters_info['total_content'] = len(chapters_info['content_files'])
+            return chapters_info
                 
-                # Анализируем каждый файл
-                chapters_info = {
-                    'all_files': [],
-                    'content_files': [],
-                    'skip_files': [],
-                    'total_all': len(all_html_files),
-                    'total_content': 0,
-                    'original_path': file_path  # Добавляем путь к оригинальному EPUB
-                }
-                
-                skip_indicators = [
-                    'toc', 'nav', 'ncx', 'cover', 'title', 'index', 'copyright', 'about', 'meta', 'opf',
-                    'masthead', 'colophon', 'imprint', 'acknowledgments', 'dedication',
-                    'glossary', 'bibliography', 'notes', 'annotations', 'epigraph', 'halftitle',
-                    'frontmatter', 'backmatter', 'preface', 'introduction', 'appendix', 'biography',
-                    'isbn', 'legal', 'notice', 'otherbooks', 'prelims', 'team', 'promo', 'bonus'
-                ]
-                
-                for html_file in all_html_files:
-                    filename_base = Path(html_file).stem.split('.')[0].lower()
-                    
-                    try:
-                        file_info = epub_zip.getinfo(html_file)
-                        file_size = file_info.file_size
-                    except:
-                        file_size = 0
-                    
-                    # Проверяем, является ли файл служебным
-                    is_skip_file = any(skip_word in filename_base for skip_word in skip_indicators)
-                    is_translated = filename_base.endswith('_translated')
-                    
-                    file_data = {
-                        'path': html_file,
-                        'name': Path(html_file).name,
-                        'size': file_size,
-                        'is_skip': is_skip_file,
-                        'is_translated': is_translated
-                    }
-                    
-                    chapters_info['all_files'].append(file_data)
-                    
-                    if not is_skip_file and not is_translated and file_size > 500:
-                        chapters_info['content_files'].append(file_data)
-                    else:
-                        chapters_info['skip_files'].append(file_data)
-                
-                chapters_info['total_content'] = len(chapters_info['content_files'])
-                return chapters_info
-                
-        return {'total_all': 0, 'total_content': 0, 'all_files': [], 'content_files': [], 'skip_files': []}
+        return _empty_chapters_info()
         
     except Exception as e:
         logger.error(f"Ошибка анализа глав: {e}")
-        return {'total_all': 0, 'total_content': 0, 'all_files': [], 'content_files': [], 'skip_files': []}
+        return _empty_chapters_info()
 
 async def count_chapters_in_file(file_path: str, file_format: str) -> int:
-    """Подсчитывает количество глав в файле"""
+    """Подсчитывает количество глав в файле (в пуле потоков, чтобы не блокировать event loop)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _count_chapters_in_file_sync, file_path, file_format)
+
+def _count_chapters_in_file_sync(file_path: str, file_format: str) -> int:
     try:
         if file_format == 'txt':
-            # Пробуем разные кодировки
-            content = ""
-            encodings = ['utf-8', 'cp1251', 'latin-1', 'cp866']
-            for encoding in encodings:
-                try:
-                    with open(file_path, 'r', encoding=encoding) as f:
-                        content = f.read()
-                    break
-                except UnicodeDecodeError:
-                    continue
-            else:
-                # Если ничего не помогло, читаем в бинарном режиме
-                with open(file_path, 'rb') as f:
-                    raw_content = f.read()
-                    content = raw_content.decode('utf-8', errors='ignore')
+            # Кодировка определяется один раз, файл читается один раз
+            content, _ = read_text_file(file_path, markup=False)
             
             # Ищем заголовки глав
-            import re
             patterns = [
                 r'^\s*(Глава|Chapter|ГЛАВА|CHAPTER)\s+\d+',
                 r'^\s*(Часть|Part|ЧАСТЬ|PART)\s+\d+',
@@ -1754,138 +1623,40 @@ async def count_chapters_in_file(file_path: str, file_format: str) -> int:
                 return 5  # Fallback если docx не установлен
                 
         elif file_format == 'html':
-            # Пробуем разные кодировки для HTML
-            content = ""
-            encodings = ['utf-8', 'cp1251', 'latin-1']
-            for encoding in encodings:
-                try:
-                    with open(file_path, 'r', encoding=encoding) as f:
-                        content = f.read()
-                    break
-                except UnicodeDecodeError:
-                    continue
-            else:
-                with open(file_path, 'rb') as f:
-                    raw_content = f.read()
-                    content = raw_content.decode('utf-8', errors='ignore')
+            content, _ = read_text_file(file_path, markup=True)
             
-            import re
             # Ищем HTML заголовки
             headers = re.findall(r'<h[1-6][^>]*>(.*?)</h[1-6]>', content, re.IGNORECASE | re.DOTALL)
             return max(1, len(headers))
         
         elif file_format == 'epub':
-            # Используем точную логику TransGemini.py для EPUB файлов
+            # Используем точную логику TransGemini.py для EPUB файлов (индекс из кэша, если уже строился)
             try:
-                chapter_count = 0
-                with zipfile.ZipFile(file_path, 'r') as epub_zip:
-                    # Получаем HTML файлы так же, как в TransGemini
-                    html_files_in_epub = sorted([
-                        name for name in epub_zip.namelist()
-                        if name.lower().endswith(('.html', '.xhtml', '.htm'))
-                        and not name.startswith(('__MACOSX', 'META-INF/'))  # Исключаем служебные папки
-                    ])
-                    
-                    if not html_files_in_epub:
-                        logger.warning(f"В EPUB файле не найдено HTML/XHTML файлов")
-                        return 5
-                    
-                    logger.info(f"Всего HTML файлов в EPUB: {len(html_files_in_epub)}")
-                    for html_file in html_files_in_epub:
-                        logger.debug(f"HTML файл: {html_file}")
-                    
-                    # Фильтруем главы, исключая служебные файлы (как в TransGemini)
-                    content_files = []
-                    for file_path_in_epub in html_files_in_epub:
-                        filename_lower = Path(file_path_in_epub).name.lower()
-                        filename_base = Path(file_path_in_epub).stem.split('.')[0].lower()
-                        
-                        # Список служебных файлов (как в TransGemini)
-                        skip_indicators = [
-                            'toc', 'nav', 'ncx', 'cover', 'title', 'index', 'copyright', 'about', 'meta', 'opf',
-                            'masthead', 'colophon', 'imprint', 'acknowledgments', 'dedication',
-                            'glossary', 'bibliography', 'notes', 'annotations', 'epigraph', 'halftitle',
-                            'frontmatter', 'backmatter', 'preface', 'introduction', 'appendix', 'biography',
-                            'isbn', 'legal', 'notice', 'otherbooks', 'prelims', 'team', 'promo', 'bonus'
-                        ]
-                        
-                        # Список индикаторов контента (главы)
-                        content_indicators = [
-                            'chapter', 'part', 'section', 'content', 'text', 'page', 'body', 'main', 'article',
-                            'chp', 'chap', 'prt', 'sec', 'glava', 'prologue', 'epilogue'
-                        ]
-                        
-                        # Проверяем, является ли файл служебным
-                        is_skip_file = any(skip_word in filename_base for skip_word in skip_indicators)
-                        is_content_file = any(content_word in filename_base for content_word in content_indicators)
-                        
-                        # Также проверяем файлы с суффиксом _translated
-                        is_translated = filename_base.endswith('_translated')
-                        
-                        # Дополнительная проверка: исключаем очень короткие HTML файлы (менее 1KB)
-                        try:
-                            file_info = epub_zip.getinfo(file_path_in_epub)
-                            file_size = file_info.file_size
-                        except:
-                            file_size = 0
-                        
-                        # Если файл не служебный и не переведенный, и имеет достаточный размер
-                        if not is_skip_file and not is_translated and file_size > 1000:
-                            content_files.append(file_path_in_epub)
-                            logger.debug(f"Найдена глава: {file_path_in_epub} (размер: {file_size} байт)")
-                        else:
-                            logger.debug(f"Пропущен файл: {file_path_in_epub} (служебный: {is_skip_file}, переведенный: {is_translated}, размер: {file_size})")
-                    
-                    # Если после фильтрации осталось мало файлов, используем менее строгую фильтрацию
-                    if len(content_files) < 3:
-                        logger.info("Мало глав после строгой фильтрации, применяем более мягкие критерии")
-                        content_files = []
-                        for file_path_in_epub in html_files_in_epub:
-                            filename_lower = Path(file_path_in_epub).name.lower()
-                            filename_base = Path(file_path_in_epub).stem.split('.')[0].lower()
-                            
-                            # Более короткий список служебных файлов
-                            skip_indicators_short = ['toc', 'nav', 'cover', 'title', 'copyright', 'meta', 'opf']
-                            is_skip_file = any(skip_word in filename_base for skip_word in skip_indicators_short)
-                            is_translated = filename_base.endswith('_translated')
-                            
-                            try:
-                                file_info = epub_zip.getinfo(file_path_in_epub)
-                                file_size = file_info.file_size
-                            except:
-                                file_size = 0
-                            
-                            if not is_skip_file and not is_translated and file_size > 500:
-                                content_files.append(file_path_in_epub)
-                    
-                    chapter_count = len(content_files)
-                    logger.info(f"EPUB анализ: найдено {chapter_count} глав из {len(html_files_in_epub)} HTML файлов")
-                    
-                    return max(1, chapter_count)
+                index = build_chapter_index(file_path)
+                if not index.entries:
+                    logger.warning(f"В EPUB файле не найдено HTML/XHTML файлов")
+                    return 5
+                
+                chapter_count = count_chapters(index)
+                logger.info(f"EPUB анализ: найдено {chapter_count} глав из {len(index.entries)} HTML файлов")
+                return chapter_count
                     
             except Exception as e:
                 logger.error(f"Ошибка анализа EPUB: {e}")
                 # Fallback: пробуем прочитать как обычный файл
                 try:
                     # Некоторые EPUB читаются как текст
-                    encodings = ['utf-8', 'cp1251', 'latin-1']
-                    for encoding in encodings:
-                        try:
-                            with open(file_path, 'r', encoding=encoding) as f:
-                                content = f.read()
-                                patterns = [
-                                    r'(?:chapter|глава|часть)\s*\d+',
-                                    r'<h[1-6][^>]*>.*?</h[1-6]>',
-                                ]
-                                total_matches = 0
-                                for pattern in patterns:
-                                    matches = re.findall(pattern, content, re.IGNORECASE)
-                                    total_matches = max(total_matches, len(matches))
-                                if total_matches > 0:
-                                    return total_matches
-                            break
-                        except UnicodeDecodeError:
-                            continue
+                    content, _ = read_text_file(file_path, markup=True)
+                    patterns = [
+                        r'(?:chapter|глава|часть)\s*\d+',
+                        r'<h[1-6][^>]*>.*?</h[1-6]>',
+                    ]
+                    total_matches = 0
+                    for pattern in patterns:
+                        matches = re.findall(pattern, content, re.IGNORECASE)
+                        total_matches = max(total_matches, len(matches))
+                    if total_matches > 0:
+                        return total_matches
                 except:
                     pass
                 
@@ -1950,6 +1721,9 @@ async def show_all_chapters(update: Update, state: UserState):
         message_text += f"• Всего HTML файлов: `{chapters_info['total_all']}`\n"
         message_text += f"• Главы для перевода: `{chapters_info['total_content']}`\n"
         message_text += f"• Служебные файлы: `{len(chapters_info['skip_files'])}`\n"
+        content_tokens = sum(file_data.get('estimated_tokens', 0) for file_data in chapters_info['content_files'])
+        if content_tokens:
+            message_text += f"• Объем глав: ~`{content_tokens:,}` токенов\n"
         if chapters_info['nav_file']:
             message_text += f"• NAV файл (оглавление): `{Path(chapters_info['nav_file']).name}`\n"
         message_text += "\n"
@@ -2437,83 +2211,42 @@ async def start_translation(update: Update, state: UserState):
         
         await update_progress_simple(0, total_chapters, "Инициализация...")
         
-        # Проверяем, нужно ли использовать ротацию ключей
-        if state.use_key_rotation and len(state.api_keys) > 1:
-            # Используем run_translation_with_auto_restart для автоматической ротации ключей
-            logger.info(f"Используем ротацию с {len(state.api_keys)} API ключами")
-            
-            await update_progress_simple(0, 100, "Запуск с ротацией API ключей...")
-            
-            # Подготавливаем настройки для функции
-            settings = state.get_settings_dict()
-            
-            # Настраиваем папку вывода и имя файла
-            settings['output_folder'] = str(output_dir)
-            settings['output_format'] = state.output_format
-            
-            # Создаем отдельный поток для запуска функции с автоматической ротацией
-            # Это необходимо, так как run_translation_with_auto_restart - синхронная функция
-            def run_translation_thread():
-                try:
-                    run_translation_with_auto_restart(settings)
-                    logger.info("Перевод с ротацией ключей завершен успешно")
-                except Exception as e:
-                    logger.error(f"Ошибка при переводе с ротацией ключей: {e}")
-            
-            # Запускаем перевод в отдельном потоке
-            translation_thread = threading.Thread(target=run_translation_thread)
-            translation_thread.start()
-            
-            # Показываем прогресс во время ожидания
-            await update_progress_simple(0, 100, "Обработка файла...")
-            
-            # Ждем завершения перевода с обновлением прогресса
-            max_wait_time = 3600  # максимальное время ожидания в секундах (1 час)
-            waited_time = 0
-            check_interval = 10  # проверяем каждые 10 секунд
-            
-            while translation_thread.is_alive() and waited_time < max_wait_time:
-                await asyncio.sleep(check_interval)
-                waited_time += check_interval
-                
-                # Обновляем прогресс на основе времени (примерно)
-                estimated_progress = min(90, 10 + int((waited_time / 300) * 80))  # 10% + 80% за 5 минут
-                status = f"Обработка... ({waited_time}с)"
-                await update_progress_simple(estimated_progress, 100, status)
-            
-            # Проверяем, успешно ли завершился перевод
-            if translation_thread.is_alive():
-                logger.warning("Перевод с ротацией превысил максимальное время ожидания")
-                success = False
-                error_message = "Превышено максимальное время ожидания перевода"
-                await update_progress_simple(0, 100, "❌ Превышено время ожидания")
-            else:
-                # Проверяем наличие выходного файла
-                if output_path.exists():
-                    success = True
-                    error_message = None
-                    await update_progress_simple(100, 100, "✅ Перевод завершен!")
-                else:
-                    success = False
-                    error_message = "Не удалось найти выходной файл после перевода с ротацией ключей"
-                    await update_progress_simple(0, 100, "❌ Файл не найден")
+        # Ключи задания: весь список при ротации или один основной ключ
+        job_api_keys = state.api_keys if state.use_key_rotation and state.api_keys else ([state.api_key] if state.api_key else [])
+        model_id = MODELS.get(state.model, {}).get('id')
+
+        # Ключи, квота которых уже исчерпана (по общему журналу квот), пропускаем сразу
+        quota_ledger = get_default_ledger()
+        live_api_keys = [key for key in job_api_keys if not quota_ledger.is_exhausted(key, model_id)]
+        if len(live_api_keys) < len(job_api_keys):
+            logger.info(f"Пропущено ключей с исчерпанной квотой: {len(job_api_keys) - len(live_api_keys)} из {len(job_api_keys)}")
+
+        if not live_api_keys:
+            success = False
+            error_message = "Квота всех API ключей для этой модели исчерпана до сброса дневного лимита"
+            await update_progress_simple(0, total_chapters, "❌ Все ключи исчерпаны")
         else:
-            # Используем стандартный метод перевода с прогресс-баром
+            if len(live_api_keys) > 1:
+                logger.info(f"Используем ротацию с {len(live_api_keys)} API ключами")
+            api_key_manager = ApiKeyManager(live_api_keys, quota_ledger=quota_ledger, model_id=model_id)
+
             await update_progress_simple(0, total_chapters, "Начинаем обработку...")
-            
+
             success, error_message = await translate_file_with_transgemini(
                 input_file=state.file_path,
                 output_file=str(output_path),
                 input_format=state.file_format,
                 output_format=state.output_format,
                 target_language=state.target_language,
-                api_key=state.api_key,
+                api_key=live_api_keys[0],
                 model_name=state.model,
                 progress_callback=update_progress_simple,  # Передаем функцию прогресса
                 main_loop=main_loop,  # Передаем event loop
                 start_chapter=getattr(state, 'start_chapter', 1),
                 chapter_count=getattr(state, 'chapter_count', 0),
-                chapters_info=getattr(state, 'chapters_info', None)  # Передаем информацию о главах
+                chapters_info=getattr(state, 'chapters_info', None),  # Передаем информацию о главах
+                api_key_manager=api_key_manager,
+                glossary_data=state.glossary_data
             )
         
         end_time = time.time()
@@ -2757,7 +2490,8 @@ async def translate_file_with_transgemini(input_file: str, output_file: str,
                                         target_language: str, api_key: str, 
                                         model_name: str, progress_callback=None, main_loop=None,
                                         start_chapter: int = 1, chapter_count: int = 0,
-                                        chapters_info: dict = None) -> tuple[bool, str]:
+                                        chapters_info: dict = None, api_key_manager=None,
+                                        glossary_data: dict = None) -> tuple[bool, str]:
     """
     Асинхронная обертка для TransGemini.py Worker класса
     Использует точно такую же логику как TransGemini для сохранения структуры файлов
@@ -2773,8 +2507,7 @@ async def translate_file_with_transgemini(input_file: str, output_file: str,
     def run_worker():
         """Запускает Worker в синхронном режиме"""
         try:
-            # Импортируем необходимые компоненты из TransGemini
-            from TransGemini import Worker, MODELS
+            # Движок перевода без Qt: сигналы - обычные объекты Signal, run() вызывается напрямую
             
             # Получаем конфигурацию модели
             model_config = MODELS.get(model_name, MODELS.get("Gemini 2.0 Flash", MODELS[list(MODELS.keys())[0]]))
@@ -2803,61 +2536,30 @@ async def translate_file_with_transgemini(input_file: str, output_file: str,
             if input_type == 'epub':
                 # Для EPUB файлов нужно получить список HTML файлов внутри
                 try:
-                    with zipfile.ZipFile(input_file, 'r') as epub_zip:
-                        # Получаем все HTML файлы как в TransGemini
-                        html_files_in_epub = sorted([
-                            name for name in epub_zip.namelist()
-                            if name.lower().endswith(('.html', '.xhtml', '.htm'))
-                            and not name.startswith(('__MACOSX', 'META-INF/'))
-                        ])
-                        
-                        # Фильтруем главы, исключая служебные файлы (как в анализе)
-                        content_files = []
-                        for file_path_in_epub in html_files_in_epub:
-                            filename_base = Path(file_path_in_epub).stem.split('.')[0].lower()
-                            
-                            # Список служебных файлов (как в TransGemini)
-                            skip_indicators = ['toc', 'nav', 'ncx', 'cover', 'title', 'index', 'copyright', 'about', 'meta', 'opf',
-                                              'masthead', 'colophon', 'imprint', 'acknowledgments', 'dedication',
-                                              'glossary', 'bibliography', 'notes', 'annotations', 'epigraph', 'halftitle',
-                                              'frontmatter', 'backmatter', 'preface', 'introduction', 'appendix', 'biography',
-                                              'isbn', 'legal', 'notice', 'otherbooks', 'prelims', 'team', 'promo', 'bonus']
-                            
-                            is_skip_file = any(skip_word in filename_base for skip_word in skip_indicators)
-                            is_translated = filename_base.endswith('_translated')
-                            
-                            # Проверяем размер файла
-                            try:
-                                file_info = epub_zip.getinfo(file_path_in_epub)
-                                file_size = file_info.file_size
-                            except:
-                                file_size = 0
-                            
-                            # Если файл не служебный и не переведенный, и имеет достаточный размер
-                            if not is_skip_file and not is_translated and file_size > 500:
-                                content_files.append(file_path_in_epub)
-                        
-                        logger.info(f"📝 Найдено {len(content_files)} HTML файлов для обработки в EPUB")
-                        
-                        # Ограничиваем количество файлов если указано
-                        if chapter_count > 0:
-                            # Берем файлы начиная с start_chapter
-                            start_idx = max(0, start_chapter - 1)
-                            end_idx = min(len(content_files), start_idx + chapter_count)
-                            selected_files = content_files[start_idx:end_idx]
-                            logger.info(f"📝 Выбрано {len(selected_files)} файлов (главы {start_chapter}-{start_chapter + len(selected_files) - 1})")
-                        else:
-                            selected_files = content_files
-                            logger.info(f"📝 Выбраны все {len(selected_files)} файлов")
-                        
-                        # Добавляем каждый HTML файл как отдельную задачу
-                        for html_file in selected_files:
-                            files_to_process_data.append(('epub', input_file, html_file))
+                    # Тот же отбор, что и при анализе глав (индекс берется из кэша по хэшу файла)
+                    content_files = translatable_paths(build_chapter_index(input_file))
+                    
+                    logger.info(f"📝 Найдено {len(content_files)} HTML файлов для обработки в EPUB")
+                    
+                    # Ограничиваем количество файлов если указано
+                    if chapter_count > 0:
+                        # Берем файлы начиная с start_chapter
+                        start_idx = max(0, start_chapter - 1)
+                        end_idx = min(len(content_files), start_idx + chapter_count)
+                        selected_files = content_files[start_idx:end_idx]
+                        logger.info(f"📝 Выбрано {len(selected_files)} файлов (главы {start_chapter}-{start_chapter + len(selected_files) - 1})")
+                    else:
+                        selected_files = content_files
+                        logger.info(f"📝 Выбраны все {len(selected_files)} файлов")
+                    
+                    # Добавляем каждый HTML файл как отдельную задачу
+                    for html_file in selected_files:
+                        files_to_process_data.append(('epub', input_file, html_file))
+                    
+                    if not files_to_process_data:
+                        logger.error("❌ Не найдено HTML файлов для обработки в EPUB")
+                        return False, "В EPUB файле не найдено подходящих HTML файлов для перевода"
                         
-                        if not files_to_process_data:
-                            logger.error("❌ Не найдено HTML файлов для обработки в EPUB")
-                            return False, "В EPUB файле не найдено подходящих HTML файлов для перевода"
-                            
                 except Exception as e:
                     logger.error(f"❌ Ошибка анализа EPUB файла: {e}")
                     return False, f"Ошибка анализа EPUB файла: {str(e)}"
@@ -2873,7 +2575,7 @@ async def translate_file_with_transgemini(input_file: str, output_file: str,
             # Для EPUB файлов используем промежуточный формат HTML, затем соберем EPUB отдельно
             worker_output_format = 'html' if output_format == 'epub' else output_format
             
-            worker = Worker(
+            worker = TranslationWorker(
                 api_key=api_key,
                 out_folder=output_dir,
                 prompt_template=prompt_template,
@@ -2886,7 +2588,10 @@ async def translate_file_with_transgemini(input_file: str, output_file: str,
                 chunk_window=500,
                 temperature=0.1,
                 chunk_delay_seconds=0.5,  # Уменьшенная задержка между чанками для быстрого перевода
-                proxy_string=None
+                proxy_string=None,
+                api_key_manager=api_key_manager,  # Ключ выбирается планировщиком на каждый запрос
+                glossary=glossary_data,  # К каждому чанку добавляются только встреченные в нем термины
+                image_profile="telegram"  # Изображения ужимаются, чтобы результат влез в лимит отправки
             )
             
             logger.info("Worker создан, запускаем обработку...")
@@ -3030,8 +2735,6 @@ async def translate_file_with_transgemini(input_file: str, output_file: str,
                     logger.info(f"   {i+1}. Type: {ftype}, File: {Path(fpath).name}, HTML: {html_path}")
                 
                 try:
-                    # Импортируем функцию сборки EPUB из TransGemini
-                    from TransGemini import write_to_epub
                     
                     # Создаем маппинг переведенных файлов
                     translation_mapping = {}
@@ -3476,11 +3179,11 @@ async def send_translated_file(update: Update, state: UserState, translated_file
                 await update.message.reply_text("❌ Переведенный файл не найден!")
             return
         
-        # Проверяем размер файла (ограничение Telegram - 50MB)
+        # Проверяем размер файла (ограничение Telegram - 50MB; изображения уже ужаты профилем "telegram")
         file_size = file_path.stat().st_size
-        if file_size > 50 * 1024 * 1024:  # 50 MB
+        if file_size > TELEGRAM_MAX_UPLOAD_BYTES:
             error_msg = (f"❌ Файл слишком большой ({file_size / 1024 / 1024:.1f} MB). "
-                        f"Максимальный размер для Telegram: 50 MB")
+                        f"Максимальный размер для Telegram: {TELEGRAM_MAX_UPLOAD_BYTES // 1024 // 1024} MB")
             
             if hasattr(update, 'edit_message_text'):
                 await update.edit_message_text(error_msg)
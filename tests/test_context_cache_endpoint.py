@@ -0,0 +1,109 @@
+# --- START OF FILE tests/test_context_cache_endpoint.py ---
+"""Запрос с кэшем системной инструкции через настоящий SDK против локального фейкового API.
+
+Фейковый сервер отвечает и на cachedContents (адрес - TRANSGEMINI_CACHE_ENDPOINT), и на
+generateContent (SDK настраивается на REST-транспорт с тем же хостом). Нужен google-generativeai.
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import json
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ContextCache import CACHE_ENDPOINT_ENV_VAR, CONTEXT_CACHE_MIN_CHARS, ContextCacheManager
+from transgemini_core.deps import GENAI_AVAILABLE, genai
+
+CACHE_NAME = "cachedContents/fake-cache"
+MODEL_ID = "gemini-fake"
+API_KEY = "test-key-0000"
+SYSTEM_PROMPT = "Переведи текст на русский язык, сохраняя разметку. " * (CONTEXT_CACHE_MIN_CHARS // 40)
+
+
+class _FakeGeminiHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args): pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = self.path.split("?", 1)[0]
+        self.server.requests.append((path, body))
+        if path.endswith("/cachedContents"):
+            self._reply(200, {"name": CACHE_NAME, "model": body.get("model"), "expireTime": "2099-01-01T00:00:00Z"})
+        elif path.endswith(":generateContent"):
+            cached = body.get("cachedContent") or body.get("cached_content")
+            text = f"cached:{cached}" if cached else "plain"
+            self._reply(200, {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP", "index": 0}]})
+        else:
+            self._reply(404, {"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}})
+
+    def do_PATCH(self):
+        self.do_POST()
+
+    def do_DELETE(self):
+        self._reply(200, {})
+
+
+@unittest.skipUnless(GENAI_AVAILABLE, "google-generativeai не установлен")
+class ContextCacheEndpointTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeGeminiHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{self.server.server_port}"
+        env = mock.patch.dict(os.environ, {CACHE_ENDPOINT_ENV_VAR: f"{base_url}/v1beta"})
+        env.start(); self.addCleanup(env.stop)
+
+        from transgemini_core.worker import TranslationWorker
+        self.logs = []
+        self.worker = TranslationWorker(
+            api_key=API_KEY, out_folder=".", prompt_template=SYSTEM_PROMPT + "\n{text}", files_to_process_data=[],
+            model_config={'id': MODEL_ID}, max_concurrent_requests=1, output_format='txt',
+            chunking_enabled_gui=False, chunk_limit=1000, chunk_window=100, temperature=1.0, chunk_delay_seconds=0,
+            context_cache=ContextCacheManager(log_callback=self.logs.append))
+        self.worker.log_message.connect(self.logs.append)
+        self.assertTrue(self.worker.setup_client())
+        # setup_client настраивает SDK на настоящий API; переводим его на фейковый сервер
+        genai.configure(api_key=API_KEY, transport="rest", client_options={"api_endpoint": base_url})
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def _generate_requests(self):
+        return [body for path, body in self.server.requests if path.endswith(":generateContent")]
+
+    def test_cached_request_sends_cache_name_instead_of_instruction(self):
+        result = self.worker._generate_content_with_retry("Hello", "test")
+        self.assertEqual(result, f"cached:{CACHE_NAME}")
+        (request,) = self._generate_requests()
+        self.assertNotIn("systemInstruction", request)
+        self.assertNotIn("system_instruction", request)
+
+    def test_sdk_rejecting_cached_request_falls_back_without_cache(self):
+        original_prepare = genai.GenerativeModel._prepare_request
+        def prepare_request(model, **kwargs):
+            if getattr(model, "_cached_content", None):
+                raise TypeError("bad argument type for built-in operation")
+            return original_prepare(model, **kwargs)
+        with mock.patch.object(genai.GenerativeModel, "_prepare_request", prepare_request):
+            self.assertEqual(self.worker._generate_content_with_retry("Hello", "test"), "plain")
+            self.assertEqual(self.worker._generate_content_with_retry("Again", "test"), "plain")
+        # Кэш отключен после первой ошибки: второй чанк уже не пытается его использовать
+        self.assertEqual(sum(1 for path, _ in self.server.requests if path.endswith("/cachedContents")), 1)
+        self.assertTrue(all("systemInstruction" in body or "system_instruction" in body for body in self._generate_requests()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+# --- START OF FILE transgemini_core/__init__.py ---
+"""Ядро TransGemini без Qt: чанкинг, плейсхолдеры, работа с API, чтение/запись форматов, сессии.
+
+Подмодули импортируются при первом обращении к их именам (`from transgemini_core import
+TranslationWorker`), а тяжелые зависимости (lxml, ebooklib, Pillow, python-docx, bs4,
+google-generativeai) - при первом реальном использовании, см. transgemini_core.deps.
+"""
+
+import importlib
+
+from .config import (
+    MODELS, DEFAULT_MODEL_NAME, MODEL_FALLBACK_CASCADES, get_model_cascade,
+    MAX_RETRIES, RETRY_DELAY_SECONDS, API_TIMEOUT_SECONDS,
+    DEFAULT_CHARACTER_LIMIT_FOR_CHUNK, DEFAULT_CHUNK_SEARCH_WINDOW, MIN_CHUNK_SIZE, CHUNK_HTML_SOURCE,
+    OUTPUT_FORMATS, DEFAULT_OUTPUT_FORMAT_DISPLAY,
+)
+
+_LAZY_EXPORTS = {
+    "deps": ("DOCX_AVAILABLE", "LXML_AVAILABLE", "EBOOKLIB_AVAILABLE", "PILLOW_AVAILABLE", "BS4_AVAILABLE", "GENAI_AVAILABLE"),
+    "capabilities": ("MissingDependencyError", "get_capabilities", "check_dependencies", "require_dependencies", "format_dependency_report"),
+    "placeholders": ("IMAGE_PLACEHOLDER_PREFIX", "IMAGE_PLACEHOLDER_PATTERN", "create_image_placeholder", "find_image_placeholders",
+                     "scan_image_placeholders", "count_image_placeholders", "replace_image_placeholders", "PlaceholderDiff", "reconcile_placeholders"),
+    "utils": ("TRANSLATED_SUFFIX", "add_translated_suffix", "format_size", "get_image_extension_from_data", "convert_emf_to_png", "extract_number_from_path",
+              "detect_image_format", "convert_image_to_png", "recompress_image_file", "CONVERTIBLE_IMAGE_FORMATS"),
+    "image_pipeline": ("ConvertedImageCache", "ConversionTask", "get_conversion_pool", "shutdown_conversion_pool",
+                       "OUTPUT_IMAGE_PROFILES", "DEFAULT_OUTPUT_IMAGE_PROFILE", "TELEGRAM_MAX_UPLOAD_BYTES", "apply_output_image_profile"),
+    "chunking": ("split_text_into_chunks",),
+    "encoding": ("detect_encoding", "detect_file_encoding", "decode_bytes", "read_text_file"),
+    "api": ("ApiKeyManager", "RATE_LIMIT_WINDOW_SECONDS", "RateLimitTracker"),
+    "session": ("TranslationSessionManager",),
+    "glossary": ("ContextManager", "GlossaryMatcher", "DynamicGlossaryFilter"),
+    "image_store": ("ImageStore", "image_id_for_bytes"),
+    "readers": ("read_docx_with_images", "process_html_images"),
+    "writers": ("write_markdown_to_docx", "process_text_with_placeholders", "write_to_html", "write_to_fb2"),
+    "epub_writer": ("EpubCreator", "generate_nav_html", "generate_ncx_manual", "parse_nav_for_ncx_data", "parse_ncx_for_nav_data", "update_nav_content", "update_ncx_content", "write_to_epub"),
+    "worker": ("OperationCancelledError", "TranslationWorker"),
+    "signals": ("Signal",),
+    "epub_structure": ("find_epub_toc_paths", "list_epub_html_files", "is_translated_html", "is_likely_content_html"),
+    "chapter_index": ("ChapterEntry", "ChapterIndex", "build_chapter_index", "content_entries", "translatable_paths", "count_chapters"),
+    "cli": ("run_batch",),
+    "work_queue": ("WorkQueue", "SQLiteWorkQueue", "RedisWorkQueue", "open_work_queue"),
+    "distributed": ("DistributedCoordinator", "DistributedWorker"),
+}
+_NAME_TO_MODULE = {name: module for module, names in _LAZY_EXPORTS.items() for name in names}
+
+
+def __getattr__(name):
+    module_name = _NAME_TO_MODULE.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f"{__name__}.{module_name}"), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_NAME_TO_MODULE))
@@ -0,0 +1,9 @@
+# --- START OF FILE transgemini_core/__main__.py ---
+"""Точка входа `python -m transgemini_core` - пакетный перевод без GUI (см. transgemini_core.cli)."""
+
+import sys
+
+from .cli import main
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,420 @@
+# --- START OF FILE transgemini_core/api.py ---
+
+import re
+import time
+import threading
+from collections import deque
+
+from .config import (
+    KEY_COOLDOWN_BASE_SECONDS, KEY_COOLDOWN_MAX_SECONDS, KEY_HEALTH_WINDOW_SECONDS,
+    KEY_LATENCY_REFERENCE_SECONDS, KEY_LATENCY_SMOOTHING,
+)
+
+
+class ApiKeyManager:
+    """Планировщик пула API ключей: выбирает ключ с наибольшим запасом по живой оценке здоровья.
+
+    Оценка строится из сглаженной задержки ответов, доли ответов 429 за последнее окно,
+    остатка квоты из RateLimitTracker и числа запросов, уже выполняющихся на ключе.
+    Ключ, получивший 429, уходит на временный cooldown, а не выбывает навсегда.
+    Если задан quota_ledger, исчерпанные и приостановленные ключи видны всем процессам
+    и пропускаются сразу, без повторных неудачных запросов.
+    """
+    def __init__(self, api_keys, rate_limit_tracker=None, quota_ledger=None, model_id=None):
+        if not api_keys:
+            raise ValueError("Список API ключей не может быть пустым.")
+        self.api_keys = list(dict.fromkeys(api_keys))  # Убираем дубликаты, сохраняя порядок
+        self.rate_limit_tracker = rate_limit_tracker
+        self.quota_ledger = quota_ledger
+        self.model_id = model_id
+        self.usage_counts = {key: 0 for key in self.api_keys}
+        self.exhausted_keys = set()  # Ключи с полностью исчерпанной квотой
+        self.key_stats = {
+            key: {
+                'latency': None,        # Сглаженная задержка ответа (сек.)
+                'events': deque(),      # (timestamp, был_ли_429) за окно KEY_HEALTH_WINDOW_SECONDS
+                'cooldown_until': 0.0,  # time.monotonic(), до которого ключ не выдается
+                'cooldown_streak': 0,   # Подряд идущие 429 - растят длительность cooldown
+                'in_flight': 0,         # Запросы, выполняющиеся на ключе прямо сейчас
+            }
+            for key in self.api_keys
+        }
+        self.lock = threading.Lock()
+
+    def _health_score(self, key, now):
+        """Возвращает оценку здоровья ключа (чем больше, тем лучше) или None, если ключ недоступен."""
+        if key in self.exhausted_keys:
+            return None
+        stats = self.key_stats[key]
+        if stats['cooldown_until'] > now:
+            return None
+        if self.quota_ledger is not None and self.quota_ledger.blocked_until(key, self.model_id):
+            return None
+        # Окно RPM/TPM уже заполнено - запрос на этом ключе гарантированно получит 429
+        if self.rate_limit_tracker is not None and self.rate_limit_tracker.should_wait(key, threshold=0, model_id=self.model_id)[0]:
+            return None
+
+        events = stats['events']
+        while events and now - events[0][0] > KEY_HEALTH_WINDOW_SECONDS:
+            events.popleft()
+        rate_limited = sum(1 for _, was_429 in events if was_429)
+        success_factor = 1.0 - rate_limited / (len(events) + 1)
+
+        latency = stats['latency'] if stats['latency'] is not None else KEY_LATENCY_REFERENCE_SECONDS
+        latency_factor = KEY_LATENCY_REFERENCE_SECONDS / (KEY_LATENCY_REFERENCE_SECONDS + latency)
+
+        quota_factor = 1.0
+        if self.rate_limit_tracker is not None:
+            headroom = self.rate_limit_tracker.get_headroom(key, self.model_id)
+            if headroom is not None:
+                quota_factor = max(0.01, headroom)
+
+        return success_factor * latency_factor * quota_factor / (1 + stats['in_flight'])
+
+    def get_next_available_key(self, reserve=False):
+        """Возвращает ключ с наибольшим запасом или None, если все ключи на cooldown/исчерпаны.
+
+        При reserve=True ключ учитывается как занятый до вызова release_key().
+        """
+        with self.lock:
+            now = time.monotonic()
+            best_key, best_rank = None, None
+            for key in self.api_keys:
+                score = self._health_score(key, now)
+                if score is None:
+                    continue
+                # При равной оценке предпочитаем менее нагруженный ключ, чтобы пул работал равномерно
+                rank = (score, -self.usage_counts[key])
+                if best_rank is None or rank > best_rank:
+                    best_key, best_rank = key, rank
+            if best_key is None:
+                return None
+            self.usage_counts[best_key] += 1
+            if reserve:
+                self.key_stats[best_key]['in_flight'] += 1
+            return best_key
+
+    def release_key(self, key):
+        """Снимает с ключа отметку о выполняющемся запросе."""
+        with self.lock:
+            if key in self.key_stats and self.key_stats[key]['in_flight'] > 0:
+                self.key_stats[key]['in_flight'] -= 1
+
+    def report_success(self, key, latency_seconds):
+        """Учитывает успешный ответ и его задержку."""
+        with self.lock:
+            stats = self.key_stats.get(key)
+            if stats is None:
+                return
+            now = time.monotonic()
+            if stats['latency'] is None:
+                stats['latency'] = latency_seconds
+            else:
+                stats['latency'] += KEY_LATENCY_SMOOTHING * (latency_seconds - stats['latency'])
+            stats['events'].append((now, False))
+            stats['cooldown_streak'] = 0
+        if self.quota_ledger is not None:
+            self.quota_ledger.record_request(key, self.model_id)
+
+    def report_rate_limited(self, key, retry_after=None):
+        """Учитывает ответ 429 и отправляет ключ на временный cooldown."""
+        with self.lock:
+            stats = self.key_stats.get(key)
+            if stats is None:
+                return 0
+            now = time.monotonic()
+            stats['events'].append((now, True))
+            stats['cooldown_streak'] += 1
+            if retry_after is None:
+                retry_after = KEY_COOLDOWN_BASE_SECONDS * (2 ** (stats['cooldown_streak'] - 1))
+            cooldown = min(max(0.0, float(retry_after)), KEY_COOLDOWN_MAX_SECONDS)
+            stats['cooldown_until'] = max(stats['cooldown_until'], now + cooldown)
+            print(f"[API KEY] Ключ ...{key[-4:]} получил 429, пауза {cooldown:.0f} сек.")
+        if self.quota_ledger is not None:
+            self.quota_ledger.mark_cooldown(key, self.model_id, cooldown)
+        return cooldown
+
+    def mark_key_exhausted(self, key, until=None, reason=""):
+        """Помечает ключ как исчерпанный (квота полностью израсходована) - до сброса квоты, если ведется журнал"""
+        with self.lock:
+            if key not in self.api_keys:
+                return
+            self.exhausted_keys.add(key)
+            print(f"[API KEY] Ключ ...{key[-4:]} помечен как исчерпанный")
+        if self.quota_ledger is not None:
+            self.quota_ledger.mark_exhausted(key, self.model_id, until=until, reason=reason)
+
+    def _is_exhausted(self, key):
+        return key in self.exhausted_keys or (self.quota_ledger is not None and self.quota_ledger.is_exhausted(key, self.model_id))
+
+    def has_available_keys(self):
+        """Проверяет, есть ли ключи, которые не исчерпаны (ключи на cooldown считаются доступными)"""
+        with self.lock:
+            return any(not self._is_exhausted(key) for key in self.api_keys)
+
+    def seconds_until_available(self):
+        """Возвращает, сколько секунд ждать до освобождения ближайшего ключа (0 - ключ есть сейчас), или None, если все исчерпаны."""
+        with self.lock:
+            now = time.monotonic()
+            wall_now = time.time()
+            waits = []
+            for key in self.api_keys:
+                if self._is_exhausted(key):
+                    continue
+                wait = max(0.0, self.key_stats[key]['cooldown_until'] - now)
+                if self.quota_ledger is not None:
+                    shared_deadline = self.quota_ledger.blocked_until(key, self.model_id)
+                    if shared_deadline:
+                        wait = max(wait, shared_deadline - wall_now)
+                if self.rate_limit_tracker is not None:
+                    wait = max(wait, self.rate_limit_tracker.should_wait(key, threshold=0, model_id=self.model_id)[1])
+                waits.append(wait)
+            return min(waits) if waits else None
+
+    def get_health_score(self, key):
+        """Возвращает текущую оценку здоровья ключа (0, если ключ недоступен)."""
+        with self.lock:
+            if key not in self.key_stats:
+                return 0.0
+            return self._health_score(key, time.monotonic()) or 0.0
+
+    def reset_usage(self):
+        """Сбрасывает счетчики использования и cooldown."""
+        with self.lock:
+            for key in self.api_keys:
+                self.usage_counts[key] = 0
+                self.key_stats[key]['cooldown_until'] = 0.0
+                self.key_stats[key]['cooldown_streak'] = 0
+                self.key_stats[key]['events'].clear()
+            # НЕ сбрасываем exhausted_keys - они остаются исчерпанными
+
+    def get_usage_report(self):
+        """Возвращает отчет об использовании ключей."""
+        with self.lock:
+            now = time.monotonic()
+            reports = []
+            for key in self.api_keys:
+                key_short = f"...{key[-4:]}"
+                stats = self.key_stats[key]
+                if self._is_exhausted(key):
+                    status = "ИСЧЕРПАН"
+                elif stats['cooldown_until'] > now:
+                    status = f"{self.usage_counts[key]} запр., пауза {stats['cooldown_until'] - now:.0f} сек."
+                else:
+                    status = f"{self.usage_counts[key]} запр., оценка {self._health_score(key, now):.2f}"
+                reports.append(f"{key_short}: {status}")
+            return ", ".join(reports)
+
+RATE_LIMIT_WINDOW_SECONDS = 60 # Окно, в котором считаются RPM/TPM
+_RETRY_DELAY_PATTERNS = (
+    re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)"),
+    re.compile(r"retryDelay\W+(\d+(?:\.\d+)?)s"),
+    re.compile(r"retry in (\d+(?:\.\d+)?)\s*s", re.IGNORECASE),
+)
+_QUOTA_VALUE_PATTERN = re.compile(r"quota_value\W+(\d+)")
+_QUOTA_ID_PATTERN = re.compile(r"quota_id\W+([A-Za-z0-9_\-]+)")
+
+class RateLimitTracker:
+    """Отслеживает лимиты API по ключам и моделям: скользящее окно запросов и токенов,
+    usage_metadata ответов, заголовки и детали ошибок 429 (retry_delay, quota_value).
+    Позволяет ждать ДО отправки запроса, а не после получения 429."""
+    def __init__(self):
+        self.limits = {}  # {(api_key, model_id): {'limit': X, 'remaining': Y, 'reset': Z, 'rpm': N}}
+        self.model_limits = {}  # {model_id: {'rpm': X, 'tpm': Y}}
+        self.windows = {}  # {(api_key, model_id): deque([[timestamp, tokens], ...])}
+        self.token_totals = {}  # {(api_key, model_id): {'prompt': N, 'candidates': N, 'total': N}}
+        self.lock = threading.Lock()
+
+    def set_model_limits(self, model_id, requests_per_minute=None, tokens_per_minute=None):
+        """Задает известные лимиты модели (из таблицы MODELS)"""
+        with self.lock:
+            self.model_limits[model_id] = {'rpm': requests_per_minute or None, 'tpm': tokens_per_minute or None}
+
+    def _window(self, slot, now):
+        window = self.windows.setdefault(slot, deque())
+        while window and now - window[0][0] >= RATE_LIMIT_WINDOW_SECONDS:
+            window.popleft()
+        return window
+
+    def _rpm_locked(self, slot):
+        return self.limits.get(slot, {}).get('rpm') or self.model_limits.get(slot[1], {}).get('rpm')
+
+    def update_from_headers(self, api_key, headers, model_id=None):
+        """Обновляет информацию о лимитах из заголовков ответа"""
+        with self.lock:
+            slot = (api_key, model_id)
+            if slot not in self.limits:
+                self.limits[slot] = {}
+                
+            # Пробуем разные варианты названий заголовков
+            rate_limit_headers = {
+                'limit': ['x-ratelimit-limit', 'ratelimit-limit', 'x-rate-limit-limit'],
+                'remaining': ['x-ratelimit-remaining', 'ratelimit-remaining', 'x-rate-limit-remaining'],
+                'reset': ['x-ratelimit-reset', 'ratelimit-reset', 'x-rate-limit-reset']
+            }
+            
+            for key, possible_names in rate_limit_headers.items():
+                for header_name in possible_names:
+                    if header_name in headers:
+                        try:
+                            self.limits[slot][key] = int(headers[header_name])
+                        except (ValueError, TypeError):
+                            pass
+                        break
+
+    def record_request(self, api_key, model_id=None, estimated_tokens=0):
+        """Регистрирует отправляемый запрос в окне; возвращает запись для уточнения токенов после ответа"""
+        with self.lock:
+            entry = [time.monotonic(), estimated_tokens]
+            self._window((api_key, model_id), entry[0]).append(entry)
+            return entry
+
+    def try_acquire(self, api_key, model_id=None, estimated_tokens=0):
+        """Атомарно занимает слот в окне, если лимит позволяет. Возвращает (запись, 0) или (None, секунды_ожидания)"""
+        with self.lock:
+            slot = (api_key, model_id)
+            now = time.monotonic()
+            wait_time = self._wait_time_locked(slot, now, estimated_tokens, threshold=0)
+            if wait_time > 0:
+                return None, wait_time
+            entry = [now, estimated_tokens]
+            self._window(slot, now).append(entry)
+            return entry, 0
+
+    def update_from_response(self, api_key, response, model_id=None, request_entry=None):
+        """Учитывает usage_metadata ответа: накапливает токены и уточняет запись в окне"""
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is None:
+            return None
+        prompt_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+        candidate_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+        total_tokens = getattr(usage, 'total_token_count', 0) or (prompt_tokens + candidate_tokens)
+        with self.lock:
+            totals = self.token_totals.setdefault((api_key, model_id), {'prompt': 0, 'candidates': 0, 'total': 0})
+            totals['prompt'] += prompt_tokens
+            totals['candidates'] += candidate_tokens
+            totals['total'] += total_tokens
+            if request_entry is not None:
+                request_entry[1] = total_tokens
+        return total_tokens
+
+    @staticmethod
+    def parse_error_details(error):
+        """Извлекает из ошибки API (обычно 429) задержку повтора, лимит и идентификатор квоты"""
+        retry_after = None
+        quota_value = None
+        quota_id = None
+        for detail in getattr(error, 'details', None) or []:
+            retry_delay = getattr(detail, 'retry_delay', None)
+            if retry_delay is not None and retry_after is None:
+                if hasattr(retry_delay, 'total_seconds'):
+                    retry_after = retry_delay.total_seconds()
+                else:
+                    retry_after = (getattr(retry_delay, 'seconds', 0) or 0) + (getattr(retry_delay, 'nanos', 0) or 0) / 1e9
+            for violation in getattr(detail, 'violations', None) or []:
+                quota_id = quota_id or getattr(violation, 'quota_id', None) or None
+                quota_value = quota_value or getattr(violation, 'quota_value', None) or None
+        error_text = str(error)
+        if retry_after is None:
+            for pattern in _RETRY_DELAY_PATTERNS:
+                match = pattern.search(error_text)
+                if match:
+                    retry_after = float(match.group(1))
+                    break
+        if quota_value is None:
+            match = _QUOTA_VALUE_PATTERN.search(error_text)
+            if match: quota_value = int(match.group(1))
+        if quota_id is None:
+            match = _QUOTA_ID_PATTERN.search(error_text)
+            if match: quota_id = match.group(1)
+        return retry_after, quota_value, quota_id
+
+    def update_from_error(self, api_key, error, model_id=None):
+        """Учитывает ошибку 429: сбрасывает остаток до нуля до момента повтора и запоминает реальный RPM.
+        Возвращает рекомендуемую задержку (сек.) или None, если API ее не сообщил"""
+        retry_after, quota_value, quota_id = self.parse_error_details(error)
+        with self.lock:
+            info = self.limits.setdefault((api_key, model_id), {})
+            if quota_value and quota_id and 'perminute' in quota_id.lower() and 'request' in quota_id.lower():
+                info['rpm'] = int(quota_value)
+            if retry_after is not None:
+                info['remaining'] = 0
+                info['reset'] = time.time() + retry_after
+        return retry_after
+
+    def block_until(self, api_key, until, model_id=None):
+        """Запрещает запросы ключа к модели до момента until (epoch), например до сброса дневной квоты"""
+        with self.lock:
+            info = self.limits.setdefault((api_key, model_id), {})
+            info['remaining'] = 0
+            info['reset'] = max(info.get('reset', 0) or 0, until)
+
+    def _wait_time_locked(self, slot, now, estimated_tokens, threshold):
+        wait_time = 0.0
+        info = self.limits.get(slot, {})
+        remaining = info.get('remaining')
+        reset_time = info.get('reset', 0)
+        if remaining is not None and remaining <= threshold and reset_time:
+            wait_time = max(wait_time, reset_time - time.time())
+
+        window = self._window(slot, now)
+        rpm = self._rpm_locked(slot)
+        if rpm and len(window) >= rpm:
+            wait_time = max(wait_time, window[len(window) - rpm][0] + RATE_LIMIT_WINDOW_SECONDS - now)
+
+        tpm = self.model_limits.get(slot[1], {}).get('tpm')
+        if tpm and window:
+            excess = sum(tokens for _, tokens in window) + estimated_tokens - tpm
+            if excess > 0:
+                for timestamp, tokens in window:
+                    excess -= tokens
+                    if excess <= 0:
+                        wait_time = max(wait_time, timestamp + RATE_LIMIT_WINDOW_SECONDS - now)
+                        break
+        return max(0.0, wait_time)
+
+    def get_remaining_requests(self, api_key, model_id=None):
+        """Возвращает количество оставшихся запросов (по заголовкам/ошибкам или по окну RPM)"""
+        with self.lock:
+            slot = (api_key, model_id)
+            info = self.limits.get(slot, {})
+            if info.get('remaining') is not None and info.get('reset', 0) > time.time():
+                return info['remaining']
+            rpm = self._rpm_locked(slot)
+            if rpm:
+                return max(0, rpm - len(self._window(slot, time.monotonic())))
+            return info.get('remaining', None)
+
+    def get_headroom(self, api_key, model_id=None):
+        """Возвращает долю оставшихся запросов (0..1) или None, если данных о лимите нет"""
+        remaining = self.get_remaining_requests(api_key, model_id)
+        with self.lock:
+            slot = (api_key, model_id)
+            limit = self._rpm_locked(slot) or self.limits.get(slot, {}).get('limit')
+        if remaining is None or not limit:
+            return None
+        return max(0.0, min(1.0, remaining / limit))
+
+    def should_wait(self, api_key, threshold=2, model_id=None, estimated_tokens=0):
+        """Определяет, нужно ли ждать перед следующим запросом. Возвращает (нужно_ждать, секунды)"""
+        with self.lock:
+            wait_time = self._wait_time_locked((api_key, model_id), time.monotonic(), estimated_tokens, threshold)
+        return wait_time > 0, wait_time
+
+    def get_token_usage(self, api_key, model_id=None):
+        """Возвращает накопленное число токенов (prompt/candidates/total) по ключу и модели"""
+        with self.lock:
+            return dict(self.token_totals.get((api_key, model_id), {'prompt': 0, 'candidates': 0, 'total': 0}))
+
+    def get_status(self, api_key, model_id=None):
+        """Возвращает строку со статусом лимитов"""
+        remaining = self.get_remaining_requests(api_key, model_id)
+        with self.lock:
+            slot = (api_key, model_id)
+            limit = self._rpm_locked(slot) or self.limits.get(slot, {}).get('limit')
+            tokens = self.token_totals.get(slot, {}).get('total', 0)
+        if remaining is None:
+            return "Нет данных о лимитах"
+        if limit:
+            return f"{remaining}/{limit} запросов осталось, токенов: {tokens}"
+        return f"{remaining} запросов осталось, токенов: {tokens}"
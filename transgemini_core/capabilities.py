@@ -0,0 +1,194 @@
+# --- START OF FILE transgemini_core/capabilities.py ---
+"""Реестр доступных зависимостей и проверка окружения без установки пакетов.
+
+Наличие модулей проверяется через find_spec один раз, результат кэшируется в памяти
+процесса и на диске (по отпечатку окружения: интерпретатор и mtime каталогов
+site-packages), поэтому повторные запуски в том же контейнере не сканируют sys.path.
+Ничего не устанавливается: при нехватке обязательных пакетов выдается отчет с командой
+pip install, а require_dependencies() сразу прерывает запуск.
+
+Проверка из консоли (код возврата 1, если не хватает обязательных пакетов):
+    python -m transgemini_core.capabilities --profile bot
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import tempfile
+import threading
+
+from .lazy import is_module_available
+
+CAPABILITIES_CACHE_ENV_VAR = "TRANSGEMINI_CAPABILITIES_CACHE" # Путь к файлу кэша; "off" - не использовать диск
+DEFAULT_CAPABILITIES_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".transgemini", "capabilities.json")
+
+# Имя модуля -> имя пакета для pip
+PACKAGE_NAMES = {
+    "PyQt6": "PyQt6",
+    "telegram": "python-telegram-bot",
+    "google.generativeai": "google-generativeai",
+    "docx": "python-docx",
+    "lxml": "lxml",
+    "ebooklib": "EbookLib",
+    "PIL": "Pillow",
+    "bs4": "beautifulsoup4",
+    "socks": "PySocks",
+    "redis": "redis",
+}
+
+# Флаги возможностей ядра (DOCX_AVAILABLE и т.д.) -> модуль
+CAPABILITY_MODULES = {
+    "DOCX": "docx",
+    "LXML": "lxml",
+    "EBOOKLIB": "ebooklib",
+    "PILLOW": "PIL",
+    "BS4": "bs4",
+    "GENAI": "google.generativeai",
+}
+
+_FORMAT_MODULES = ("docx", "lxml", "ebooklib", "PIL", "bs4", "socks")
+
+# Что нужно для запуска каждой точки входа: без required запуск прерывается, без optional отключаются форматы
+DEPENDENCY_PROFILES = {
+    "core": {"required": ("google.generativeai",), "optional": _FORMAT_MODULES},
+    "gui": {"required": ("PyQt6", "google.generativeai"), "optional": _FORMAT_MODULES},
+    "bot": {"required": ("telegram", "google.generativeai"), "optional": _FORMAT_MODULES},
+    "launcher": {"required": ("PyQt6", "google.generativeai", "ebooklib", "bs4", "lxml"), "optional": ()},
+}
+
+
+class MissingDependencyError(ImportError):
+    """Не установлены обязательные пакеты; в сообщении - команда для их установки."""
+    def __init__(self, missing_modules, profile=None):
+        self.missing_modules = list(missing_modules)
+        self.profile = profile
+        packages = " ".join(PACKAGE_NAMES.get(name, name) for name in self.missing_modules)
+        target = f" для '{profile}'" if profile else ""
+        super().__init__(f"Не установлены обязательные пакеты{target}: {', '.join(self.missing_modules)}. "
+                         f"Установите их заранее: pip install {packages}")
+
+
+def _environment_fingerprint():
+    """Отпечаток окружения: меняется при смене интерпретатора или установке/удалении пакетов."""
+    parts = [sys.executable, sys.version]
+    for entry in sys.path:
+        if "site-packages" not in entry and "dist-packages" not in entry:
+            continue
+        try:
+            parts.append(f"{entry}:{os.stat(entry).st_mtime_ns}")
+        except OSError:
+            parts.append(f"{entry}:-")
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def _cache_path():
+    path = os.environ.get(CAPABILITIES_CACHE_ENV_VAR, DEFAULT_CAPABILITIES_CACHE_PATH)
+    return None if path.lower() in ("", "0", "off", "none") else path
+
+
+def _read_cache(path, fingerprint):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("fingerprint") != fingerprint or not isinstance(data.get("modules"), dict):
+        return None
+    if any(name not in data["modules"] for name in PACKAGE_NAMES):
+        return None
+    return {name: bool(data["modules"][name]) for name in PACKAGE_NAMES}
+
+
+def _write_cache(path, fingerprint, modules):
+    cache_dir = os.path.dirname(os.path.abspath(path))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".capabilities_", dir=cache_dir)
+    except OSError:
+        return # Кэш на диске - только ускорение (например, файловая система только для чтения)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"fingerprint": fingerprint, "modules": modules}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except OSError:
+        try: os.remove(tmp_path)
+        except OSError: pass
+
+
+_capabilities = None
+_capabilities_lock = threading.Lock()
+
+def get_capabilities(refresh=False):
+    """Возвращает {имя модуля: установлен ли} для всех известных зависимостей (с кэшем)."""
+    global _capabilities
+    with _capabilities_lock:
+        if _capabilities is not None and not refresh:
+            return _capabilities
+        path = _cache_path()
+        fingerprint = _environment_fingerprint()
+        modules = _read_cache(path, fingerprint) if path and not refresh else None
+        if modules is None:
+            modules = {name: is_module_available(name) for name in PACKAGE_NAMES}
+            if path:
+                _write_cache(path, fingerprint, modules)
+        _capabilities = modules
+        return modules
+
+
+def get_capability_flags():
+    """Возвращает {"DOCX": bool, "LXML": bool, ...} для флагов *_AVAILABLE."""
+    modules = get_capabilities()
+    return {flag: modules[module_name] for flag, module_name in CAPABILITY_MODULES.items()}
+
+
+def check_dependencies(profile="core"):
+    """Только проверяет окружение: возвращает (отсутствующие обязательные, отсутствующие необязательные)."""
+    modules = get_capabilities()
+    spec = DEPENDENCY_PROFILES[profile]
+    missing_required = [name for name in spec["required"] if not modules.get(name, False)]
+    missing_optional = [name for name in spec["optional"] if not modules.get(name, False)]
+    return missing_required, missing_optional
+
+
+def format_dependency_report(profile="core"):
+    """Возвращает текстовый отчет о зависимостях профиля."""
+    modules = get_capabilities()
+    spec = DEPENDENCY_PROFILES[profile]
+    lines = [f"Зависимости ({profile}):"]
+    for kind, names in (("обязательный", spec["required"]), ("необязательный", spec["optional"])):
+        for name in names:
+            status = "OK" if modules.get(name, False) else "НЕТ"
+            lines.append(f"  [{status}] {PACKAGE_NAMES.get(name, name)} ({name}, {kind})")
+    missing_required, missing_optional = check_dependencies(profile)
+    missing = missing_required + missing_optional
+    if missing:
+        lines.append("Установка: pip install " + " ".join(PACKAGE_NAMES.get(name, name) for name in missing))
+    return "\n".join(lines)
+
+
+def require_dependencies(profile="core"):
+    """Прерывает запуск (MissingDependencyError), если не хватает обязательных пакетов профиля.
+
+    Возвращает список отсутствующих необязательных модулей, чтобы вызывающий мог о них сообщить.
+    """
+    missing_required, missing_optional = check_dependencies(profile)
+    if missing_required:
+        raise MissingDependencyError(missing_required, profile)
+    return missing_optional
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Проверка зависимостей TransGemini (без установки пакетов).")
+    parser.add_argument("--profile", choices=sorted(DEPENDENCY_PROFILES), default="core")
+    parser.add_argument("--refresh", action="store_true", help="Пересчитать реестр, игнорируя кэш")
+    args = parser.parse_args(argv)
+    get_capabilities(refresh=args.refresh)
+    print(format_dependency_report(args.profile))
+    missing_required, _ = check_dependencies(args.profile)
+    return 1 if missing_required else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
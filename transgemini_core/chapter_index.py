@@ -0,0 +1,124 @@
+# --- START OF FILE transgemini_core/chapter_index.py ---
+"""Компактный индекс глав EPUB: пути, размеры, категории, длина текста и оценка токенов.
+
+Строится за один проход по архиву и кэшируется по хэшу содержимого, так что повторная
+загрузка той же книги и повторные запросы (меню бота, подсчет глав, выбор файлов для
+перевода) используют готовый индекс. Функция синхронная и тяжелая: из asyncio ее
+вызывают через run_in_executor.
+"""
+
+import os
+import re
+import html
+import hashlib
+import zipfile
+import threading
+import collections
+from pathlib import Path
+
+from .encoding import decode_bytes
+from .epub_structure import list_epub_html_files, is_likely_content_html, _SKIP_INDICATORS
+from .utils import TRANSLATED_SUFFIX
+
+CHARS_PER_TOKEN = 4 # Та же грубая оценка, что и для окна TPM в воркере
+_INDEX_CACHE_MAX_ENTRIES = 64
+_HASH_BLOCK_BYTES = 1024 * 1024
+# Отбор файлов для перевода в боте: служебные по имени, переведенные и почти пустые - мимо
+TRANSLATABLE_MIN_SIZE = 500
+# Подсчет глав: сначала строгий отбор, а если глав меньше CHAPTER_COUNT_MIN_STRICT - мягкий
+CHAPTER_COUNT_STRICT_MIN_SIZE = 1000
+CHAPTER_COUNT_MIN_STRICT = 3
+_SHORT_SKIP_INDICATORS = ['toc', 'nav', 'cover', 'title', 'copyright', 'meta', 'opf']
+
+_NON_TEXT_BLOCK_RE = re.compile(r'<(script|style|head)\b.*?</\1\s*>|<!--.*?-->', re.IGNORECASE | re.DOTALL)
+_TAG_RE = re.compile(r'<[^>]*>')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# category: 'nav' (оглавление), 'content' (глава) или 'skip' (служебный файл)
+ChapterEntry = collections.namedtuple("ChapterEntry", "path size category text_length estimated_tokens")
+ChapterIndex = collections.namedtuple("ChapterIndex", "digest nav_path entries")
+
+_index_cache = collections.OrderedDict() # digest -> ChapterIndex
+_digest_cache = {} # (realpath, mtime_ns, size) -> digest, чтобы не хэшировать файл при каждом обращении
+_cache_lock = threading.Lock()
+
+
+def _file_digest(path):
+    stat_result = os.stat(path)
+    key = (os.path.realpath(path), stat_result.st_mtime_ns, stat_result.st_size)
+    with _cache_lock:
+        digest = _digest_cache.get(key)
+    if digest is None:
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(_HASH_BLOCK_BYTES), b''): hasher.update(block)
+        digest = hasher.hexdigest()
+        with _cache_lock:
+            if len(_digest_cache) >= _INDEX_CACHE_MAX_ENTRIES * 4: _digest_cache.clear()
+            _digest_cache[key] = digest
+    return digest
+
+
+def html_text_length(html_bytes):
+    """Длина видимого текста HTML: без тегов, скриптов и стилей, пробелы схлопнуты."""
+    text, _ = decode_bytes(html_bytes, markup=True)
+    text = _TAG_RE.sub(' ', _NON_TEXT_BLOCK_RE.sub(' ', text))
+    return len(_WHITESPACE_RE.sub(' ', html.unescape(text)).strip())
+
+
+def _filename_base(html_path):
+    return Path(html_path).stem.split('.')[0].lower()
+
+
+def _build_index(epub_path, digest):
+    with zipfile.ZipFile(epub_path, 'r') as epub_zip:
+        html_files = list_epub_html_files(epub_zip)
+        nav_path = next((name for name in html_files if 'nav' in Path(name).name.lower()), None)
+        entries = []
+        for html_path in html_files:
+            info = epub_zip.getinfo(html_path)
+            if html_path == nav_path: category = 'nav'
+            elif is_likely_content_html(html_path): category = 'content'
+            else: category = 'skip'
+            text_length = html_text_length(epub_zip.read(html_path)) if info.file_size else 0
+            entries.append(ChapterEntry(html_path, info.file_size, category, text_length, text_length // CHARS_PER_TOKEN))
+    return ChapterIndex(digest, nav_path, tuple(entries))
+
+
+def build_chapter_index(epub_path):
+    """Индекс глав EPUB (из кэша, если книга с тем же содержимым уже разбиралась)."""
+    digest = _file_digest(epub_path)
+    with _cache_lock:
+        index = _index_cache.get(digest)
+        if index is not None:
+            _index_cache.move_to_end(digest)
+            return index
+    index = _build_index(epub_path, digest)
+    with _cache_lock:
+        _index_cache[digest] = index
+        while len(_index_cache) > _INDEX_CACHE_MAX_ENTRIES: _index_cache.popitem(last=False)
+    return index
+
+
+def content_entries(index):
+    """Главы для перевода по умолчанию (логика выбора TransGemini)."""
+    return [entry for entry in index.entries if entry.category == 'content']
+
+
+def _passes_filter(entry, skip_indicators, min_size):
+    filename_base = _filename_base(entry.path)
+    return not any(skip in filename_base for skip in skip_indicators) \
+        and not filename_base.endswith(TRANSLATED_SUFFIX) and entry.size > min_size
+
+
+def translatable_paths(index, min_size=TRANSLATABLE_MIN_SIZE):
+    """Пути HTML, которые бот отдает на перевод: не служебные по имени, не переведенные, больше min_size байт."""
+    return [entry.path for entry in index.entries if _passes_filter(entry, _SKIP_INDICATORS, min_size)]
+
+
+def count_chapters(index):
+    """Оценка числа глав: строгий отбор, а для книг, где он почти ничего не оставил, - мягкий."""
+    count = sum(1 for entry in index.entries if _passes_filter(entry, _SKIP_INDICATORS, CHAPTER_COUNT_STRICT_MIN_SIZE))
+    if count < CHAPTER_COUNT_MIN_STRICT:
+        count = sum(1 for entry in index.entries if _passes_filter(entry, _SHORT_SKIP_INDICATORS, TRANSLATABLE_MIN_SIZE))
+    return max(1, count)
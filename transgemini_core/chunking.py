@@ -0,0 +1,109 @@
+# --- START OF FILE transgemini_core/chunking.py ---
+
+import re
+
+from .placeholders import IMAGE_PLACEHOLDER_PREFIX
+
+_PARAGRAPH_BREAK_RE = re.compile(r'\n\n')
+_SENTENCE_END_RE = re.compile(r"[.!?]\s+")
+_LINE_BREAK_RE = re.compile(r'\n')
+_SPACE_RE = re.compile(r' ')
+# Сколько текста вокруг пробела смотрим, чтобы не резать внутри плейсхолдера
+_PLACEHOLDER_CONTEXT_BEFORE = 50
+_PLACEHOLDER_CONTEXT_AFTER = 5
+
+
+def _find_split_index(text, start_index, text_len, limit_chars, search_window, min_chunk_size, target_size):
+    """Конец чанка, начинающегося в start_index: абзац > предложение > строка > пробел ближе всего к целевому размеру."""
+    if text_len - start_index <= limit_chars:
+        return text_len
+
+    ideal_end_index = min(start_index + target_size, text_len)
+    search_start = max(start_index + min_chunk_size, ideal_end_index - search_window)
+    search_end = min(ideal_end_index + search_window, text_len)
+    split_index = -1
+
+    potential_splits = []
+
+    search_slice = text[search_start:search_end]
+    if search_slice:
+        for match in _PARAGRAPH_BREAK_RE.finditer(search_slice):
+             potential_splits.append((abs((search_start + match.end()) - ideal_end_index), search_start + match.end(), 1))
+        for match in _SENTENCE_END_RE.finditer(search_slice):
+             potential_splits.append((abs((search_start + match.end()) - ideal_end_index), search_start + match.end(), 2))
+        for match in _LINE_BREAK_RE.finditer(search_slice):
+              potential_splits.append((abs((search_start + match.end()) - ideal_end_index), search_start + match.end(), 3))
+
+        for match in _SPACE_RE.finditer(search_slice):
+            current_split_pos = search_start + match.end()
+            preceding_text = text[max(0, current_split_pos - _PLACEHOLDER_CONTEXT_BEFORE):current_split_pos]
+            following_text = text[current_split_pos:min(text_len, current_split_pos + _PLACEHOLDER_CONTEXT_AFTER)]
+            if f"<||{IMAGE_PLACEHOLDER_PREFIX}" in preceding_text and "||>" not in following_text:
+                 continue # Likely inside a placeholder, don't split here
+            potential_splits.append((abs(current_split_pos - ideal_end_index), current_split_pos, 4))
+
+
+    potential_splits.sort()
+
+    if potential_splits:
+         split_index = potential_splits[0][1]
+
+         if split_index <= start_index + min_chunk_size:
+             split_index = -1 # Ignore this split point
+
+    if split_index == -1:
+         if ideal_end_index > start_index + min_chunk_size:
+             split_index = ideal_end_index
+         else: # Force split at limit or end of text
+             split_index = min(start_index + limit_chars, text_len)
+
+    split_index = min(split_index, text_len)
+    if split_index <= start_index:
+
+         split_index = min(start_index + limit_chars, text_len)
+         if split_index <= start_index: # Final fallback if limit is tiny or zero
+             split_index = text_len
+    return split_index
+
+
+def split_text_into_chunks(text, limit_chars, search_window, min_chunk_size):
+    """Splits text into chunks, respecting paragraphs and sentences where possible."""
+    chunks = []
+    start_index = 0
+    text_len = len(text)
+    target_size = max(min_chunk_size, limit_chars - search_window // 2)
+
+    while start_index < text_len:
+        split_index = _find_split_index(text, start_index, text_len, limit_chars, search_window, min_chunk_size, target_size)
+        chunks.append(text[start_index:split_index])
+        start_index = split_index
+
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def iter_chunks_from_blocks(blocks, limit_chars, search_window, min_chunk_size):
+    """То же, что split_text_into_chunks, но лениво по потоку кусков текста (например, iter_text_file_blocks).
+
+    В памяти держится только окно ~limit_chars + search_window символов: граница очередного
+    чанка ищется, как только в окне набрано достаточно текста, чтобы результат не отличался
+    от разбиения всего текста целиком.
+    """
+    target_size = max(min_chunk_size, limit_chars - search_window // 2)
+    lookahead = max(limit_chars, target_size) + search_window + _PLACEHOLDER_CONTEXT_AFTER # Дальше этого _find_split_index не заглядывает
+    blocks = iter(blocks)
+    window, start_index, exhausted = "", 0, False
+    while True:
+        pending = []
+        pending_len = len(window) - start_index
+        while not exhausted and pending_len <= lookahead:
+            block = next(blocks, None)
+            if block is None: exhausted = True
+            else: pending.append(block); pending_len += len(block)
+        if pending: window = "".join([window, *pending])
+        window_len = len(window)
+        if start_index >= window_len: return
+        split_index = _find_split_index(window, start_index, window_len, limit_chars, search_window, min_chunk_size, target_size)
+        chunk = window[start_index:split_index]
+        if chunk.strip(): yield chunk
+        keep_from = max(0, split_index - _PLACEHOLDER_CONTEXT_BEFORE) # Контекст для проверки плейсхолдера у следующей границы
+        window, start_index = window[keep_from:], split_index - keep_from
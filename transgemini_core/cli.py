@@ -0,0 +1,522 @@
+# --- START OF FILE transgemini_core/cli.py ---
+"""Пакетный перевод из консоли, без Qt и диалогов.
+
+Принимает файлы, каталоги (TXT/DOCX/EPUB ищутся рекурсивно) или манифест, запускает
+TranslationWorker со всеми переданными ключами и пишет рядом с результатами JSON-отчет
+по каждому входному файлу. Код возврата отражает итог (см. EXIT_*).
+
+    python -m transgemini_core books/ -o out/ --format epub --api-keys-file keys.txt
+    python -m transgemini_core --manifest nightly.json -o out/ --format txt --report out/report.json
+
+Манифест - JSON-список путей или объектов {"path": ..., "html": [...]} (html - выбранные
+части EPUB), либо текстовый файл с путем на каждой строке. Относительные пути
+считаются от каталога манифеста.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import datetime
+import tempfile
+import threading
+
+from QuotaLedger import get_default_ledger
+
+from .capabilities import MissingDependencyError, require_dependencies, format_dependency_report
+from .config import MODELS, DEFAULT_MODEL_NAME, DEFAULT_CHARACTER_LIMIT_FOR_CHUNK, DEFAULT_CHUNK_SEARCH_WINDOW, OUTPUT_FORMATS, DEFAULT_PROMPT_TEMPLATE, get_model_cascade
+from .utils import TRANSLATED_SUFFIX
+from .image_pipeline import OUTPUT_IMAGE_PROFILES, DEFAULT_OUTPUT_IMAGE_PROFILE
+
+EXIT_OK = 0
+EXIT_FAILED = 1 # Ни одна задача не выполнена (или не удалось инициализировать API)
+EXIT_USAGE = 2 # Неверные аргументы или конфигурация (как у argparse)
+EXIT_PARTIAL = 3 # Часть задач завершилась ошибкой
+EXIT_NO_INPUT = 4 # Не найдено ни одного входного файла
+EXIT_MISSING_DEPENDENCIES = 5
+EXIT_API_STOPPED = 10 # Остановка из-за квоты/недоступности API (как у Worker.py)
+EXIT_INTERRUPTED = 130
+
+INPUT_TYPES = {'.txt': 'txt', '.docx': 'docx', '.epub': 'epub'}
+REPORT_FILENAME = "transgemini_report.json"
+API_KEY_ENV_VARS = ("GOOGLE_API_KEY", "GEMINI_API_KEY") # Можно перечислить несколько ключей через запятую
+LOG_TAGS_QUIET = ("[FAIL]", "[ERROR]", "[CRITICAL]", "[WARN]", "[SUCCESS]", "[CANCELLED]", "ИТОГ")
+
+
+class UsageError(Exception):
+    """Ошибка аргументов/входных данных, которую нужно показать пользователю без трассировки."""
+
+
+def load_api_keys(cli_keys, keys_file):
+    """Собирает ключи из аргументов, файла (ключ на строку, # - комментарий) и переменных окружения."""
+    keys = list(cli_keys or [])
+    if keys_file:
+        try:
+            with open(keys_file, 'r', encoding='utf-8') as f:
+                keys += [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+        except OSError as e:
+            raise UsageError(f"Не удалось прочитать файл ключей {keys_file}: {e}")
+    if not keys:
+        for env_var in API_KEY_ENV_VARS:
+            keys += [key.strip() for key in os.environ.get(env_var, "").split(",") if key.strip()]
+    return list(dict.fromkeys(keys))
+
+
+def _scan_directory(directory):
+    found = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() in INPUT_TYPES and not stem.endswith(TRANSLATED_SUFFIX): # Результаты прошлых запусков не берем
+                found.append(os.path.join(root, name))
+    return found
+
+
+def _read_manifest(manifest_path):
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            raw = f.read()
+    except OSError as e:
+        raise UsageError(f"Не удалось прочитать манифест {manifest_path}: {e}")
+    if manifest_path.lower().endswith('.json'):
+        try:
+            data = json.loads(raw)
+        except ValueError as e:
+            raise UsageError(f"Манифест {manifest_path} не является корректным JSON: {e}")
+        if isinstance(data, dict):
+            data = data.get('files', [])
+        if not isinstance(data, list):
+            raise UsageError(f"Манифест {manifest_path}: ожидался список файлов.")
+        entries = []
+        for item in data:
+            if isinstance(item, str):
+                item = {'path': item}
+            if not isinstance(item, dict) or not item.get('path'):
+                raise UsageError(f"Манифест {manifest_path}: некорректная запись {item!r}")
+            entries.append({'path': os.path.join(base_dir, item['path']), 'html': item.get('html')})
+        return entries
+    return [{'path': os.path.join(base_dir, line.strip()), 'html': None}
+            for line in raw.splitlines() if line.strip() and not line.lstrip().startswith('#')]
+
+
+def collect_inputs(paths, manifest_path=None):
+    """Возвращает список записей {'path', 'type', 'html'} без дубликатов, в порядке указания."""
+    raw_entries = _read_manifest(manifest_path) if manifest_path else []
+    for path in paths or []:
+        if os.path.isdir(path):
+            raw_entries += [{'path': found, 'html': None} for found in _scan_directory(path)]
+        else:
+            raw_entries.append({'path': path, 'html': None})
+    entries, seen = [], set()
+    for entry in raw_entries:
+        path = os.path.abspath(entry['path'])
+        if path in seen:
+            continue
+        seen.add(path)
+        entries.append({'path': path, 'type': INPUT_TYPES.get(os.path.splitext(path)[1].lower()), 'html': entry.get('html')})
+    return entries
+
+
+def _select_epub_html(epub_path, requested_html, epub_select, log):
+    """Возвращает (HTML-части для перевода, данные сборки) или (None, ошибка)."""
+    import zipfile
+    from .epub_structure import find_epub_toc_paths, list_epub_html_files, is_likely_content_html, is_translated_html
+    nav_path, ncx_path, opf_dir, nav_id, ncx_id = find_epub_toc_paths(epub_path, log_callback=log)
+    if opf_dir is None:
+        return None, "Не удалось определить структуру OPF"
+    try:
+        with zipfile.ZipFile(epub_path, 'r') as epub_zip:
+            html_files = list_epub_html_files(epub_zip)
+    except zipfile.BadZipFile as e:
+        return None, f"Поврежденный EPUB: {e}"
+    if requested_html:
+        missing = [html_path for html_path in requested_html if html_path not in html_files]
+        if missing:
+            return None, f"В EPUB нет частей: {', '.join(missing)}"
+        selected = [html_path for html_path in requested_html if html_path != nav_path]
+    else:
+        candidates = [html_path for html_path in html_files if html_path != nav_path and not is_translated_html(html_path)]
+        selected = candidates
+        if epub_select == 'auto':
+            # Как в диалоге выбора GUI; если эвристика ничего не нашла - берем все части
+            selected = [html_path for html_path in candidates if is_likely_content_html(html_path)] or candidates
+    build_metadata = {
+        'nav_path_in_zip': nav_path, 'ncx_path_in_zip': ncx_path,
+        'opf_dir': opf_dir, 'nav_item_id': nav_id, 'ncx_item_id': ncx_id
+    }
+    return selected, build_metadata
+
+
+def build_worker_data(entries, output_format, epub_select, log):
+    """Готовит files_to_process_data для TranslationWorker.
+
+    Возвращает (данные для Worker, записи отчета для файлов, которые обработать нельзя).
+    В режиме EPUB->EPUB данные - словарь {путь EPUB: {'html_paths', 'build_metadata'}}, как в GUI.
+    """
+    rejected = []
+    if output_format == 'epub':
+        epub_groups = {}
+        for entry in entries:
+            if entry['type'] != 'epub':
+                rejected.append({'input': entry['path'], 'status': 'skipped', 'error': "Вывод в EPUB возможен только из EPUB"})
+                continue
+            html_paths, build_metadata = _select_epub_html(entry['path'], entry['html'], epub_select, log)
+            if html_paths is None:
+                rejected.append({'input': entry['path'], 'status': 'failed', 'error': build_metadata})
+                continue
+            epub_groups[entry['path']] = {'html_paths': html_paths, 'build_metadata': build_metadata}
+        return epub_groups, rejected
+
+    file_tuples = []
+    for entry in entries:
+        if entry['type'] is None:
+            rejected.append({'input': entry['path'], 'status': 'skipped', 'error': "Неподдерживаемый тип файла"})
+        elif entry['type'] == 'epub':
+            html_paths, error = _select_epub_html(entry['path'], entry['html'], epub_select, log)
+            if html_paths is None:
+                rejected.append({'input': entry['path'], 'status': 'failed', 'error': error})
+                continue
+            file_tuples += [('epub', entry['path'], html_path) for html_path in html_paths]
+        else:
+            file_tuples.append((entry['type'], entry['path'], None))
+    return file_tuples, rejected
+
+
+def _make_batch_worker_class():
+    from .worker import TranslationWorker
+
+    class BatchTranslationWorker(TranslationWorker):
+        """TranslationWorker, который дополнительно собирает результаты задач для отчета."""
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.task_results = {}
+            self._results_lock = threading.Lock()
+
+        def _record(self, key, **fields):
+            with self._results_lock:
+                self.task_results.setdefault(key, {}).update(fields)
+
+        def process_single_file(self, file_info_tuple):
+            key = tuple(file_info_tuple)
+            try:
+                result = super().process_single_file(file_info_tuple)
+            except Exception as e:
+                self._record(key, status='failed', error=f"{type(e).__name__}: {e}")
+                raise
+            _, success, message = result
+            out_path = self.output_path_for(file_info_tuple)
+            self._record(key, status='ok' if success else 'failed',
+                         output=out_path if success and os.path.exists(out_path) else None,
+                         error=None if success else message, note=message if success else None)
+            return result
+
+        def process_single_epub_html(self, epub_path, html_path):
+            try:
+                result = super().process_single_epub_html(epub_path, html_path)
+            except Exception as e:
+                result = (False, None, None, None, False, f"{type(e).__name__}: {e}")
+                self._record_part(epub_path, html_path, result)
+                raise
+            self._record_part(epub_path, html_path, result)
+            return result
+
+        def _record_part(self, epub_path, html_path, result):
+            prep_success, _, _, _, is_original, warning = result
+            state = 'failed' if not prep_success else 'original' if is_original else 'translated'
+            with self._results_lock:
+                book = self.task_results.setdefault((epub_path,), {})
+                book.setdefault('parts', {})[html_path] = state
+                if warning and state != 'translated':
+                    book.setdefault('warnings', []).append(f"{html_path}: {warning}")
+
+        def build_translated_epub(self, original_epub_path, translated_items_list, build_metadata):
+            key = (original_epub_path,)
+            try:
+                result = super().build_translated_epub(original_epub_path, translated_items_list, build_metadata)
+            except Exception as e:
+                self._record(key, build='failed', error=f"{type(e).__name__}: {e}")
+                raise
+            _, success, message = result
+            out_path = self.epub_output_path(original_epub_path)
+            self._record(key, build='ok' if success else 'failed',
+                         output=out_path if success and os.path.exists(out_path) else None,
+                         error=None if success else message)
+            return result
+
+    return BatchTranslationWorker
+
+
+def _collect_items(worker, worker_data, rejected, output_format):
+    """Собирает записи отчета по всем входам (в порядке задач), включая не дошедшие до обработки."""
+    items = list(rejected)
+    if output_format == 'epub':
+        for epub_path, epub_data in worker_data.items():
+            record = worker.task_results.get((epub_path,), {})
+            parts = record.get('parts', {})
+            counts = {state: sum(1 for value in parts.values() if value == state) for state in ('translated', 'original', 'failed')}
+            counts['not_processed'] = len(epub_data['html_paths']) - len(parts)
+            if record.get('build') == 'ok':
+                status = 'ok' if counts['original'] == 0 and counts['failed'] == 0 and counts['not_processed'] == 0 else 'partial'
+            elif record.get('build') == 'failed' or counts['failed']:
+                status = 'failed'
+            else:
+                status = 'not_processed'
+            items.append({'input': epub_path, 'status': status, 'output': record.get('output'),
+                          'error': record.get('error'), 'parts': counts, 'warnings': record.get('warnings', [])})
+    else:
+        for file_info_tuple in worker_data:
+            record = worker.task_results.get(tuple(file_info_tuple), {})
+            items.append({'input': file_info_tuple[1], 'part': file_info_tuple[2],
+                          'status': record.get('status', 'not_processed'), 'output': record.get('output'),
+                          'error': record.get('error'), 'note': record.get('note')})
+    return items
+
+
+def _exit_code_for(items, worker, interrupted, setup_failed):
+    if interrupted:
+        return EXIT_INTERRUPTED
+    if setup_failed:
+        return EXIT_FAILED
+    if getattr(worker, '_critical_error_occurred', False):
+        return EXIT_API_STOPPED
+    done = [item for item in items if item['status'] in ('ok', 'partial', 'exists')]
+    if len(done) == len(items) and all(item['status'] != 'partial' for item in items):
+        return EXIT_OK
+    return EXIT_PARTIAL if done else EXIT_FAILED
+
+
+def write_report(report_path, report):
+    """Атомарно записывает JSON-отчет."""
+    report_dir = os.path.dirname(os.path.abspath(report_path))
+    os.makedirs(report_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".transgemini_report_", dir=report_dir)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, report_path)
+    except Exception:
+        try: os.remove(tmp_path)
+        except OSError: pass
+        raise
+
+
+def load_prompt_template(prompt_file=None):
+    """Читает промпт из файла (по умолчанию - промпт GUI) и проверяет плейсхолдер {text}."""
+    prompt_template = DEFAULT_PROMPT_TEMPLATE
+    if prompt_file:
+        try:
+            with open(prompt_file, 'r', encoding='utf-8') as f:
+                prompt_template = f.read()
+        except OSError as e:
+            raise UsageError(f"Не удалось прочитать промпт {prompt_file}: {e}")
+    if "{text}" not in prompt_template:
+        raise UsageError("Промпт должен содержать плейсхолдер {text}.")
+    return prompt_template
+
+
+def load_glossary(glossary_file=None):
+    """Загружает JSON-глоссарий {"оригинал": "перевод"} или возвращает None."""
+    if not glossary_file:
+        return None
+    try:
+        with open(glossary_file, 'r', encoding='utf-8') as f:
+            glossary = json.load(f)
+    except (OSError, ValueError) as e:
+        raise UsageError(f"Не удалось загрузить глоссарий {glossary_file}: {e}")
+    if not isinstance(glossary, dict):
+        raise UsageError("Глоссарий должен быть JSON-объектом {\"оригинал\": \"перевод\"}.")
+    return glossary
+
+
+def resolve_model_name(model_arg):
+    if model_arg in MODELS:
+        return model_arg
+    for name, config in MODELS.items():
+        if config['id'] in (model_arg, f"models/{model_arg}"):
+            return name
+    raise UsageError(f"Неизвестная модель: {model_arg}. Доступны: {', '.join(MODELS)}")
+
+
+def build_parser():
+    format_codes = sorted(set(OUTPUT_FORMATS.values()))
+    parser = argparse.ArgumentParser(prog="python -m transgemini_core",
+                                     description="Пакетный перевод файлов TXT/DOCX/EPUB через Gemini API без GUI.")
+    parser.add_argument("inputs", nargs="*", help="Файлы или каталоги (TXT/DOCX/EPUB ищутся рекурсивно)")
+    parser.add_argument("--manifest", help="JSON или текстовый список входных файлов")
+    parser.add_argument("-o", "--output-dir", help="Каталог для результатов (обязателен, кроме --check-deps)")
+    parser.add_argument("-f", "--format", dest="output_format", choices=format_codes, default="txt", help="Формат вывода (epub - пересборка EPUB->EPUB)")
+    parser.add_argument("--model", default=DEFAULT_MODEL_NAME, help="Имя модели из списка GUI или ее id")
+    parser.add_argument("--fallback-models", action="store_true", help="Отдавать чанки запасным моделям каскада при нехватке лимитов")
+    parser.add_argument("--api-key", action="append", default=[], help="API ключ (можно несколько раз)")
+    parser.add_argument("--api-keys-file", help="Файл с ключами, по одному на строку")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="Параллельных запросов (по умолчанию: RPM модели x число ключей, не больше 4 x ядер CPU)")
+    parser.add_argument("--prompt-file", help="Файл с промптом (должен содержать {text}); по умолчанию - промпт GUI")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--chunking", action=argparse.BooleanOptionalAction, default=None, help="Делить большие файлы на чанки (по умолчанию - по модели)")
+    parser.add_argument("--chunk-limit", type=int, default=DEFAULT_CHARACTER_LIMIT_FOR_CHUNK)
+    parser.add_argument("--chunk-window", type=int, default=DEFAULT_CHUNK_SEARCH_WINDOW)
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="Пауза между чанками, сек.")
+    parser.add_argument("--epub-select", choices=("auto", "all"), default="auto",
+                        help="Какие части EPUB переводить, если они не заданы в манифесте: auto - главы (как в GUI), all - все, кроме оглавления")
+    parser.add_argument("--glossary", help="JSON-глоссарий {\"оригинал\": \"перевод\"}")
+    parser.add_argument("--learn-glossary", action="store_true", help="Пополнять глоссарий терминами из готовых чанков")
+    parser.add_argument("--no-context-cache", action="store_true", help="Не кэшировать системную инструкцию")
+    parser.add_argument("--image-profile", choices=sorted(OUTPUT_IMAGE_PROFILES), default=DEFAULT_OUTPUT_IMAGE_PROFILE,
+                        help="Изображения в DOCX/HTML/FB2: original - как есть, archive - до 2400px, telegram - ужать под 50 MB")
+    parser.add_argument("--proxy", help="Прокси (http://, socks5://...)")
+    parser.add_argument("--skip-existing", action="store_true", help="Пропускать файлы, для которых результат уже есть")
+    parser.add_argument("--report", help=f"Путь JSON-отчета (по умолчанию <output-dir>/{REPORT_FILENAME})")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Выводить только ошибки, предупреждения и итоги")
+    parser.add_argument("--check-deps", action="store_true", help="Только проверить зависимости и выйти")
+    return parser
+
+
+def run_batch(args):
+    """Выполняет пакетный перевод по разобранным аргументам и возвращает код возврата."""
+    started_at = time.time()
+    quiet = args.quiet
+
+    def log(message):
+        if quiet and not any(tag in message for tag in LOG_TAGS_QUIET):
+            return
+        print(f"{datetime.datetime.now():%H:%M:%S} {message}", file=sys.stderr, flush=True)
+
+    model_name = resolve_model_name(args.model)
+    model_config = MODELS[model_name]
+    api_keys = load_api_keys(args.api_key, args.api_keys_file)
+    if not api_keys:
+        raise UsageError("Не задан ни один API ключ (--api-key, --api-keys-file или GOOGLE_API_KEY).")
+    prompt_template = load_prompt_template(args.prompt_file)
+    glossary = load_glossary(args.glossary)
+
+    entries = collect_inputs(args.inputs, args.manifest)
+    if not entries:
+        log("[ERROR] Не найдено входных файлов.")
+        return EXIT_NO_INPUT
+    missing = [entry['path'] for entry in entries if not os.path.isfile(entry['path'])]
+    if missing:
+        raise UsageError("Файлы не найдены: " + ", ".join(missing))
+    os.makedirs(args.output_dir, exist_ok=True)
+    report_path = args.report or os.path.join(args.output_dir, REPORT_FILENAME)
+
+    worker_data, rejected = build_worker_data(entries, args.output_format, args.epub_select, log)
+    chunking = args.chunking if args.chunking is not None else model_config.get('needs_chunking', True)
+    concurrency = args.concurrency or max(1, min(model_config.get('rpm', 1) * len(api_keys), (os.cpu_count() or 1) * 4))
+    model_cascade = get_model_cascade(model_name, enabled=args.fallback_models)
+
+    from .api import ApiKeyManager
+    BatchTranslationWorker = _make_batch_worker_class()
+    worker = BatchTranslationWorker(
+        api_keys[0], args.output_dir, prompt_template, worker_data,
+        model_config, concurrency, args.output_format,
+        chunking, args.chunk_limit, args.chunk_window,
+        args.temperature, args.chunk_delay,
+        proxy_string=args.proxy or None,
+        api_key_manager=ApiKeyManager(api_keys, quota_ledger=get_default_ledger(), model_id=model_config['id']),
+        fallback_model_configs=[config for _, config in model_cascade[1:]],
+        glossary=glossary,
+        context_cache=False if args.no_context_cache else None,
+        learn_glossary=args.learn_glossary,
+        image_profile=args.image_profile,
+    )
+    skipped_existing = []
+    if args.skip_existing:
+        if args.output_format == 'epub':
+            for epub_path in [path for path in worker_data if os.path.exists(worker.epub_output_path(path))]:
+                skipped_existing.append({'input': epub_path, 'status': 'exists', 'output': worker.epub_output_path(epub_path)})
+                del worker_data[epub_path]
+        else:
+            kept = []
+            for file_info_tuple in worker_data:
+                out_path = worker.output_path_for(file_info_tuple)
+                if os.path.exists(out_path):
+                    skipped_existing.append({'input': file_info_tuple[1], 'part': file_info_tuple[2], 'status': 'exists', 'output': out_path})
+                else:
+                    kept.append(file_info_tuple)
+            worker_data[:] = kept
+        if skipped_existing:
+            log(f"[INFO] Пропущено (результат уже есть): {len(skipped_existing)}")
+
+    log(f"Модель: {model_name}, ключей: {len(api_keys)}, параллельных запросов: {concurrency}, формат: .{args.output_format}, входов: {len(entries)}")
+    worker.log_message.connect(log)
+    outcome = {}
+    worker.finished.connect(lambda success_count, error_count, errors: outcome.update(success=success_count, errors=error_count, error_list=list(errors)))
+
+    interrupted = threading.Event()
+    def handle_signal(signum, frame):
+        # Первый сигнал - дождаться начатых задач и собрать готовое, второй - прервать сразу
+        if not worker.is_finishing:
+            log("[WARN] Получен сигнал остановки: завершаем начатые задачи (повторный сигнал - немедленная отмена)...")
+            worker.finish_processing()
+        else:
+            worker.cancel()
+        interrupted.set()
+    previous_handlers = {}
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            previous_handlers[signum] = signal.signal(signum, handle_signal)
+        except (ValueError, OSError): # Не главный поток или платформа без сигнала
+            pass
+
+    runner = threading.Thread(target=worker.run, name="TransGeminiBatch", daemon=True)
+    try:
+        runner.start()
+        while runner.is_alive():
+            runner.join(0.5)
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+    setup_failed = worker.total_tasks == 0 and outcome.get('errors', 0) > 0
+    items = skipped_existing + _collect_items(worker, worker_data, rejected, args.output_format)
+    exit_code = _exit_code_for(items, worker, interrupted.is_set(), setup_failed)
+    statuses = {}
+    for item in items:
+        statuses[item['status']] = statuses.get(item['status'], 0) + 1
+    report = {
+        'started_at': datetime.datetime.fromtimestamp(started_at).isoformat(timespec='seconds'),
+        'finished_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'duration_seconds': round(time.time() - started_at, 1),
+        'model': model_name,
+        'fallback_models': [name for name, _ in model_cascade[1:]],
+        'output_format': args.output_format,
+        'output_dir': os.path.abspath(args.output_dir),
+        'api_keys': len(api_keys),
+        'concurrency': concurrency,
+        'exit_code': exit_code,
+        'interrupted': interrupted.is_set(),
+        'api_stopped': bool(getattr(worker, '_critical_error_occurred', False)),
+        'totals': {'items': len(items), **statuses,
+                   'tasks_succeeded': outcome.get('success', 0), 'tasks_failed': outcome.get('errors', 0)},
+        'items': items,
+        'errors': outcome.get('error_list', []),
+    }
+    write_report(report_path, report)
+    log(f"ИТОГ: {', '.join(f'{status}: {count}' for status, count in sorted(statuses.items()))}. Отчет: {report_path} (код {exit_code})")
+    return exit_code
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.check_deps:
+        print(format_dependency_report("core"))
+        return EXIT_OK
+    if not args.inputs and not args.manifest:
+        parser.error("укажите входные файлы/каталоги или --manifest")
+    if not args.output_dir:
+        parser.error("укажите каталог для результатов: -o/--output-dir")
+    try:
+        require_dependencies("core")
+        return run_batch(args)
+    except MissingDependencyError as e:
+        print(f"[ERROR] {e}", file=sys.stderr)
+        return EXIT_MISSING_DEPENDENCIES
+    except UsageError as e:
+        print(f"[ERROR] {e}", file=sys.stderr)
+        return EXIT_USAGE
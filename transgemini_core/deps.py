@@ -0,0 +1,32 @@
+# --- START OF FILE transgemini_core/deps.py ---
+
+import warnings
+
+from .lazy import lazy_import
+from .capabilities import get_capability_flags
+
+# Флаги берутся из кэшированного реестра возможностей; сами пакеты здесь не импортируются
+_flags = get_capability_flags()
+DOCX_AVAILABLE = _flags["DOCX"]
+LXML_AVAILABLE = _flags["LXML"]
+EBOOKLIB_AVAILABLE = _flags["EBOOKLIB"]
+PILLOW_AVAILABLE = _flags["PILLOW"]
+BS4_AVAILABLE = _flags["BS4"]
+GENAI_AVAILABLE = _flags["GENAI"]
+
+
+def _configure_bs4(module):
+    warnings.filterwarnings("ignore", category=module.XMLParsedAsHTMLWarning)
+
+
+# Тяжелые зависимости ядра: импортируются при первом обращении
+bs4 = lazy_import("bs4", on_load=_configure_bs4)
+etree = lazy_import("lxml.etree")
+epub = lazy_import("ebooklib.epub")
+Image = lazy_import("PIL.Image")
+docx = lazy_import("docx")
+docx_shared = lazy_import("docx.shared")
+genai = lazy_import("google.generativeai")
+genai_client = lazy_import("google.generativeai.client")  # Отдельные клиенты для ключей из ApiKeyManager
+google_exceptions = lazy_import("google.api_core.exceptions")
+redis = lazy_import("redis")  # Только для распределенного режима с Redis-очередью
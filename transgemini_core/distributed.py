@@ -0,0 +1,573 @@
+# --- START OF FILE transgemini_core/distributed.py ---
+"""Распределенный режим: координатор раскладывает задание по очереди, воркеры на разных хостах переводят.
+
+Координатор (DistributedCoordinator) превращает files_to_process_data (в формате Worker:
+список кортежей или словарь EPUB->EPUB) в элементы очереди - по файлу или по HTML-части
+EPUB, загружает входные файлы в blob-хранилище очереди и ждет, пока элементы не будут
+выполнены. Воркеры (DistributedWorker) не хранят состояния: берут элементы в аренду,
+переводят их TranslationWorker-ом со своими ключами и отдают результат обратно в очередь.
+Если воркер упал, его аренда истекает и элемент получает другой воркер. Итоговые файлы
+собирает координатор: EPUB - через write_to_epub, остальные форматы - из blob-ов воркеров.
+
+    python -m transgemini_core.distributed worker --queue redis://host:6379/0 --api-keys-file keys.txt
+    python -m transgemini_core.distributed submit books/ -o out/ --format epub --queue redis://host:6379/0
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import socket
+import signal
+import hashlib
+import zipfile
+import argparse
+import datetime
+import tempfile
+import threading
+from pathlib import Path
+
+from .work_queue import DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS, open_work_queue
+from .utils import add_translated_suffix
+from .image_store import ImageStore
+
+IDLE_POLL_SECONDS = 5 # Пауза воркера при пустой очереди
+API_ERROR_PAUSE_SECONDS = 120 # Пауза воркера после критической ошибки API (квота/недоступность)
+PROGRESS_POLL_SECONDS = 5
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _encode_content(value):
+    """Содержимое HTML-части для JSON: строка (перевод) или bytes (оригинал)."""
+    if isinstance(value, bytes):
+        return {"b64": base64.b64encode(value).decode("ascii")}
+    return {"text": value}
+
+
+def _decode_content(value):
+    if not value:
+        return None
+    return base64.b64decode(value["b64"]) if "b64" in value else value["text"]
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".part_", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        try: os.remove(tmp_path)
+        except OSError: pass
+        raise
+
+
+class DistributedCoordinator:
+    """Ставит задание в очередь, ждет выполнения и собирает результат в папке вывода.
+
+    job_settings - параметры перевода, одинаковые для всех воркеров: output_format, model_config,
+    fallback_model_configs, prompt_template, temperature, chunking_enabled, chunk_limit,
+    chunk_window, chunk_delay_seconds, glossary, image_profile. Ключи API, прокси и параллельность
+    задает каждый воркер сам.
+    """
+    def __init__(self, queue, log_callback=None):
+        self.queue = queue
+        self.log_callback = log_callback or print
+
+    def submit(self, files_to_process_data, job_settings, job_id=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Загружает входные файлы и ставит элементы в очередь. Возвращает job_id."""
+        job_id = job_id or uuid.uuid4().hex[:12]
+        epub_mode = isinstance(files_to_process_data, dict)
+        sources = {}
+
+        def upload(path):
+            if path not in sources:
+                with open(path, "rb") as f:
+                    data = f.read()
+                sources[path] = {"blob": _digest(data), "name": os.path.basename(path)}
+                self.queue.put_blob(job_id, sources[path]["blob"], data)
+            return sources[path]
+
+        items = []
+        spec = dict(job_settings, mode="epub" if epub_mode else "files", sources=sources, max_attempts=max_attempts)
+        if epub_mode:
+            spec["epubs"] = {}
+            for epub_path, epub_data in files_to_process_data.items():
+                source = upload(epub_path)
+                part_items = {}
+                for html_path in epub_data["html_paths"]:
+                    item_id = f"{len(items):06d}"
+                    items.append((item_id, {"kind": "epub_html", "blob": source["blob"], "name": source["name"], "html": html_path}))
+                    part_items[html_path] = item_id
+                spec["epubs"][epub_path] = {"items": part_items, "build_metadata": epub_data["build_metadata"]}
+        else:
+            spec["files"] = []
+            for input_type, filepath, html_path in files_to_process_data:
+                source = upload(filepath)
+                item_id = f"{len(items):06d}"
+                items.append((item_id, {"kind": "file", "type": input_type, "blob": source["blob"], "name": source["name"], "html": html_path}))
+                spec["files"].append({"item": item_id, "input": [input_type, filepath, html_path]})
+        self.queue.create_job(job_id, spec, max_attempts=max_attempts)
+        self.queue.enqueue(job_id, items)
+        self.log_callback(f"[INFO] Задание {job_id}: {len(items)} элементов в очереди, входных файлов: {len(sources)}.")
+        return job_id
+
+    def wait(self, job_id, poll_seconds=PROGRESS_POLL_SECONDS, timeout=None, should_stop=None):
+        """Ждет, пока все элементы не будут выполнены или не исчерпают попытки. Возвращает прогресс."""
+        started = time.monotonic()
+        last_progress = None
+        while True:
+            self.queue.requeue_expired() # Даже если все воркеры упали, истекшие аренды будут видны в прогрессе
+            progress = self.queue.job_progress(job_id)
+            if progress != last_progress:
+                self.log_callback(f"[INFO] Задание {job_id}: готово {progress['done']}, ошибок {progress['failed']}, "
+                                  f"в работе {progress['leased']}, в очереди {progress['pending']}")
+                last_progress = progress
+            if progress["pending"] + progress["leased"] == 0:
+                return progress
+            if should_stop is not None and should_stop():
+                return progress
+            if timeout is not None and time.monotonic() - started > timeout:
+                return progress
+            time.sleep(poll_seconds)
+
+    def assemble(self, job_id, out_folder):
+        """Собирает результаты в out_folder. Возвращает (успешно, ошибок, список ошибок), как Worker.finished."""
+        spec = self.queue.get_job(job_id)
+        if spec is None:
+            raise ValueError(f"Задание {job_id} не найдено в очереди")
+        results = self.queue.job_results(job_id)
+        os.makedirs(out_folder, exist_ok=True)
+        if spec["mode"] == "epub":
+            return self._assemble_epubs(job_id, spec, results, out_folder)
+        success_count, errors = 0, []
+        for entry in spec["files"]:
+            input_type, filepath, html_path = entry["input"]
+            label = os.path.basename(filepath) + (f" -> {html_path}" if html_path else "")
+            record = results.get(entry["item"], {})
+            if record.get("state") != "done":
+                errors.append(f"{label}: {record.get('error') or 'не выполнено'}")
+                continue
+            data = self.queue.get_blob(job_id, record["result"]["blob"])
+            if data is None:
+                errors.append(f"{label}: результат отсутствует в очереди")
+                continue
+            _write_atomic(os.path.join(out_folder, record["result"]["output_name"]), data)
+            success_count += 1
+        return success_count, len(errors), errors
+
+    def _assemble_epubs(self, job_id, spec, results, out_folder):
+        success_count, errors = 0, []
+        for epub_path, epub_spec in spec["epubs"].items():
+            epub_name = Path(epub_path).name
+            # Путь epub_path - с машины, отправившей задание; исходная книга берется из blob-а очереди
+            source = spec["sources"][epub_path]
+            data = self.queue.get_blob(job_id, source["blob"])
+            if data is None:
+                errors.append(f"Сборка EPUB: {epub_name}: исходный файл отсутствует в очереди")
+                self.log_callback(f"[FAIL] EPUB Rebuild: {epub_name}: исходный файл отсутствует в очереди")
+                continue
+            with tempfile.TemporaryDirectory(prefix="transgemini_assemble_") as tmp_dir:
+                local_epub_path = os.path.join(tmp_dir, source["name"])
+                with open(local_epub_path, "wb") as f:
+                    f.write(data)
+                success, book_errors = self._assemble_epub(epub_name, local_epub_path, epub_spec, results, out_folder)
+            errors.extend(book_errors)
+            if success:
+                success_count += 1
+        failed_books = len(spec["epubs"]) - success_count
+        return success_count, failed_books, errors
+
+    def _assemble_epub(self, epub_name, local_epub_path, epub_spec, results, out_folder):
+        from .epub_writer import write_to_epub
+        processed_parts, errors = [], []
+        with zipfile.ZipFile(local_epub_path, "r") as epub_zip:
+            for html_path, item_id in epub_spec["items"].items():
+                record = results.get(item_id, {})
+                result = record.get("result")
+                if record.get("state") == "done" and result:
+                    processed_parts.append({
+                        "original_filename": html_path, "content_to_write": _decode_content(result["content"]),
+                        "image_map": result.get("image_map") or {}, "is_original_content": result["is_original"],
+                        "translation_warning": result.get("warning") if result["is_original"] else None,
+                    })
+                    if result["is_original"] and result.get("warning"):
+                        errors.append(f"{epub_name} -> {html_path}: {result['warning']}")
+                else:
+                    # Часть не удалась ни у одного воркера: в книгу идет оригинал
+                    reason = record.get("error") or "не выполнено"
+                    processed_parts.append({"original_filename": html_path, "content_to_write": epub_zip.read(html_path),
+                                            "image_map": {}, "is_original_content": True, "translation_warning": reason})
+                    errors.append(f"{epub_name} -> {html_path}: {reason}")
+        out_path = os.path.join(out_folder, add_translated_suffix(epub_name))
+        self.log_callback(f"[INFO] EPUB Rebuild: {epub_name}: сборка из {len(processed_parts)} частей...")
+        success, error = write_to_epub(out_path=out_path, processed_epub_parts=processed_parts,
+                                       original_epub_path=local_epub_path, build_metadata=epub_spec["build_metadata"],
+                                       book_title_override=Path(epub_name).stem)
+        if success:
+            self.log_callback(f"[SUCCESS] EPUB Rebuild: {epub_name}: сохранен {out_path}")
+        else:
+            errors.append(f"Сборка EPUB: {epub_name}: {error}")
+            self.log_callback(f"[FAIL] EPUB Rebuild: {epub_name}: {error}")
+        return success, errors
+
+
+class DistributedWorker:
+    """Воркер без состояния: берет элементы из очереди и переводит их своими ключами.
+
+    Для каждого задания создается один TranslationWorker (настройки - из spec задания,
+    ключи/прокси - свои), входные файлы кэшируются локально по хэшу. Аренды всех элементов
+    в работе продлеваются фоновым потоком; если аренда потеряна, результат не будет принят.
+    """
+    def __init__(self, queue, api_keys, concurrency=1, proxy_string=None, cache_dir=None,
+                 lease_seconds=DEFAULT_LEASE_SECONDS, worker_id=None, log_callback=None, exit_when_idle=False):
+        if not api_keys:
+            raise ValueError("Воркеру нужен хотя бы один API ключ.")
+        self.queue = queue
+        self.api_keys = list(api_keys)
+        self.concurrency = max(1, int(concurrency))
+        self.proxy_string = proxy_string
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), "transgemini_worker")
+        self.lease_seconds = lease_seconds
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.log_callback = log_callback or print
+        self.exit_when_idle = exit_when_idle
+        self.completed_count = 0
+        self.failed_count = 0
+        self._engines = {}
+        self._engines_lock = threading.Lock()
+        self._blob_locks = {}
+        self._in_flight = {} # {(job_id, item_id): LeasedItem}
+        self._in_flight_lock = threading.Lock()
+        self._paused_until = 0.0
+        self._stopping = threading.Event()
+        self._key_manager = None
+        self._context_cache = None
+
+    def stop(self, graceful=True):
+        """Перестает брать элементы; при graceful=False прерывает и текущие (их аренда вернет элементы в очередь)."""
+        self._stopping.set()
+        if not graceful:
+            with self._engines_lock:
+                engines = list(self._engines.values())
+            for engine in engines:
+                engine.cancel()
+
+    def _engine_for(self, job_id):
+        with self._engines_lock:
+            engine = self._engines.get(job_id)
+            if engine is not None:
+                return engine
+            spec = self.queue.get_job(job_id)
+            if spec is None:
+                raise RuntimeError(f"Задание {job_id} удалено из очереди")
+            from QuotaLedger import get_default_ledger
+            from ContextCache import ContextCacheManager
+            from .api import ApiKeyManager
+            from .worker import TranslationWorker
+            if self._key_manager is None:
+                # Пул ключей и кэш инструкций общие для всех заданий этого воркера
+                self._key_manager = ApiKeyManager(self.api_keys, quota_ledger=get_default_ledger(), model_id=spec["model_config"]["id"])
+                self._context_cache = ContextCacheManager(log_callback=self.log_callback)
+            engine = TranslationWorker(
+                self.api_keys[0], os.path.join(self.cache_dir, "jobs", job_id), spec["prompt_template"], [],
+                spec["model_config"], self.concurrency, spec["output_format"],
+                spec["chunking_enabled"], spec["chunk_limit"], spec["chunk_window"],
+                spec["temperature"], spec["chunk_delay_seconds"],
+                proxy_string=self.proxy_string, api_key_manager=self._key_manager,
+                fallback_model_configs=spec.get("fallback_model_configs"), glossary=spec.get("glossary"),
+                context_cache=self._context_cache, image_profile=spec.get("image_profile"),
+            )
+            engine.log_message.connect(self.log_callback)
+            if not engine.setup_client():
+                raise RuntimeError("Не удалось инициализировать Gemini API клиент")
+            os.makedirs(engine.out_folder, exist_ok=True)
+            # Изображения задания общие для всех его элементов, которые достались этому воркеру
+            engine.image_store = ImageStore(os.path.join(engine.out_folder, "images"))
+            self._engines[job_id] = engine
+            return engine
+
+    def _local_input(self, item):
+        """Скачивает входной файл задания (один раз на хэш) и возвращает локальный путь с исходным именем."""
+        blob_key = item.payload["blob"]
+        local_path = os.path.join(self.cache_dir, "inputs", blob_key, item.payload["name"])
+        with self._engines_lock:
+            blob_lock = self._blob_locks.setdefault(blob_key, threading.Lock())
+        with blob_lock:
+            if not os.path.exists(local_path):
+                data = self.queue.get_blob(item.job_id, blob_key)
+                if data is None:
+                    raise RuntimeError(f"Входной файл {item.payload['name']} отсутствует в очереди")
+                _write_atomic(local_path, data)
+        return local_path
+
+    def _process(self, item):
+        """Выполняет элемент. Возвращает (результат, None) или (None, ошибка)."""
+        engine = self._engine_for(item.job_id)
+        local_path = self._local_input(item)
+        payload = item.payload
+        if payload["kind"] == "epub_html":
+            prep_success, _, content, image_map, is_original, warning = engine.process_single_epub_html(local_path, payload["html"])
+            if not prep_success:
+                return None, warning or "Не удалось подготовить HTML часть"
+            if is_original and warning and item.attempt < self._max_attempts(item.job_id):
+                # Перевод не удался, но попытки остались: пусть попробует другой воркер/ключ
+                return None, warning
+            return {"content": _encode_content(content), "image_map": image_map or {},
+                    "is_original": is_original, "warning": warning}, None
+        file_info_tuple = (payload["type"], local_path, payload["html"])
+        _, success, message = engine.process_single_file(file_info_tuple)
+        if not success:
+            return None, message or "Неизвестная ошибка"
+        out_path = engine.output_path_for(file_info_tuple)
+        with open(out_path, "rb") as f:
+            data = f.read()
+        os.remove(out_path)
+        blob_key = _digest(data)
+        self.queue.put_blob(item.job_id, blob_key, data)
+        return {"output_name": os.path.basename(out_path), "blob": blob_key}, None
+
+    def _max_attempts(self, job_id):
+        return self.queue.get_job(job_id).get("max_attempts", DEFAULT_MAX_ATTEMPTS)
+
+    def _handle(self, item):
+        from .deps import google_exceptions
+        label = f"{item.payload['name']}" + (f" -> {item.payload['html']}" if item.payload.get("html") else "")
+        self.log_callback(f"[INFO] {self.worker_id}: взят {item.job_id}/{item.item_id} ({label}), попытка {item.attempt}")
+        try:
+            result, error = self._process(item)
+        except (google_exceptions.ServiceUnavailable, google_exceptions.RetryError, google_exceptions.ResourceExhausted) as critical_api_error:
+            # Квота/недоступность API у этого воркера: отдаем элемент другим и делаем паузу
+            self._paused_until = time.monotonic() + API_ERROR_PAUSE_SECONDS
+            result, error = None, f"Критическая ошибка API ({type(critical_api_error).__name__}): {critical_api_error}"
+            self.log_callback(f"[CRITICAL] {label}: {error}. Пауза воркера {API_ERROR_PAUSE_SECONDS} сек.")
+        except Exception as e:
+            result, error = None, f"{type(e).__name__}: {e}"
+        if result is not None:
+            accepted = self.queue.complete(item, result)
+            self.completed_count += 1 if accepted else 0
+            self.log_callback(f"[SUCCESS] {label}: результат отправлен" if accepted else f"[WARN] {label}: аренда потеряна, результат отброшен")
+        else:
+            self.failed_count += 1
+            if self.queue.fail(item, error, retry=True):
+                self.log_callback(f"[FAIL] {label}: {error}")
+
+    def _lease_loop(self):
+        while not self._stopping.is_set():
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                self._stopping.wait(min(pause, IDLE_POLL_SECONDS))
+                continue
+            try:
+                item = self.queue.lease(self.worker_id, self.lease_seconds)
+            except Exception as e: # Очередь недоступна: ждем и пробуем снова, свои элементы вернутся по истечении аренды
+                self.log_callback(f"[WARN] {self.worker_id}: ошибка очереди: {e}")
+                self._stopping.wait(IDLE_POLL_SECONDS)
+                continue
+            if item is None:
+                if self.exit_when_idle and not self._in_flight:
+                    return
+                self._stopping.wait(IDLE_POLL_SECONDS)
+                continue
+            with self._in_flight_lock:
+                self._in_flight[(item.job_id, item.item_id)] = item
+            try:
+                self._handle(item)
+            finally:
+                with self._in_flight_lock:
+                    self._in_flight.pop((item.job_id, item.item_id), None)
+
+    def _heartbeat_loop(self, done):
+        interval = max(1.0, self.lease_seconds / 3)
+        while not done.wait(interval):
+            with self._in_flight_lock:
+                items = list(self._in_flight.values())
+            for item in items:
+                try:
+                    if not self.queue.extend(item, self.lease_seconds):
+                        self.log_callback(f"[WARN] {item.job_id}/{item.item_id}: аренда потеряна (элемент отдан другому воркеру)")
+                except Exception as e:
+                    self.log_callback(f"[WARN] Не удалось продлить аренду {item.job_id}/{item.item_id}: {e}")
+
+    def run(self):
+        """Обрабатывает очередь до stop() (или до опустошения при exit_when_idle). Возвращает (выполнено, ошибок)."""
+        self.log_callback(f"[INFO] Воркер {self.worker_id}: ключей {len(self.api_keys)}, параллельных элементов {self.concurrency}.")
+        heartbeat_done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat_loop, args=(heartbeat_done,), name="LeaseHeartbeat", daemon=True)
+        heartbeat.start()
+        loops = [threading.Thread(target=self._lease_loop, name=f"QueueWorker-{i}", daemon=True) for i in range(self.concurrency)]
+        for loop in loops:
+            loop.start()
+        try:
+            for loop in loops:
+                while loop.is_alive():
+                    loop.join(0.5)
+        finally:
+            heartbeat_done.set()
+            if self._context_cache is not None:
+                self._context_cache.release_all()
+            for engine in self._engines.values():
+                if engine.learn_glossary:
+                    engine.glossary.flush()
+        self.log_callback(f"[INFO] Воркер {self.worker_id} остановлен: выполнено {self.completed_count}, ошибок {self.failed_count}.")
+        return self.completed_count, self.failed_count
+
+
+def _install_stop_handlers(on_first, on_second):
+    state = {"signals": 0}
+    def handle_signal(signum, frame):
+        state["signals"] += 1
+        (on_first if state["signals"] == 1 else on_second)()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            signal.signal(signum, handle_signal)
+        except (ValueError, OSError):
+            pass
+    return state
+
+
+def _log(message):
+    print(f"{datetime.datetime.now():%H:%M:%S} {message}", file=sys.stderr, flush=True)
+
+
+def _run_worker(args):
+    from .cli import UsageError, load_api_keys
+    api_keys = load_api_keys(args.api_key, args.api_keys_file)
+    if not api_keys:
+        raise UsageError("Не задан ни один API ключ (--api-key, --api-keys-file или GOOGLE_API_KEY).")
+    worker = DistributedWorker(open_work_queue(args.queue), api_keys, concurrency=args.concurrency,
+                               proxy_string=args.proxy, cache_dir=args.cache_dir, lease_seconds=args.lease_seconds,
+                               worker_id=args.worker_id, log_callback=_log, exit_when_idle=args.exit_when_idle)
+    state = _install_stop_handlers(lambda: worker.stop(graceful=True), lambda: worker.stop(graceful=False))
+    worker.run()
+    return 130 if state["signals"] else 0
+
+
+def _run_submit(args):
+    from . import cli
+    model_name = cli.resolve_model_name(args.model)
+    entries = cli.collect_inputs(args.inputs, args.manifest)
+    if not entries:
+        _log("[ERROR] Не найдено входных файлов.")
+        return cli.EXIT_NO_INPUT
+    missing = [entry["path"] for entry in entries if not os.path.isfile(entry["path"])]
+    if missing:
+        raise cli.UsageError("Файлы не найдены: " + ", ".join(missing))
+    from .config import MODELS, get_model_cascade
+    model_config = MODELS[model_name]
+    worker_data, rejected = cli.build_worker_data(entries, args.output_format, args.epub_select, _log)
+    for item in rejected:
+        _log(f"[WARN] {item['input']}: {item['error']}")
+    job_settings = {
+        "output_format": args.output_format, "model_config": model_config,
+        "fallback_model_configs": [config for _, config in get_model_cascade(model_name, enabled=args.fallback_models)[1:]],
+        "prompt_template": cli.load_prompt_template(args.prompt_file), "temperature": args.temperature,
+        "chunking_enabled": args.chunking if args.chunking is not None else model_config.get("needs_chunking", True),
+        "chunk_limit": args.chunk_limit, "chunk_window": args.chunk_window, "chunk_delay_seconds": args.chunk_delay,
+        "glossary": cli.load_glossary(args.glossary), "image_profile": args.image_profile,
+    }
+    coordinator = DistributedCoordinator(open_work_queue(args.queue), log_callback=_log)
+    job_id = coordinator.submit(worker_data, job_settings, job_id=args.job_id, max_attempts=args.max_attempts)
+    print(job_id, flush=True)
+    if args.no_wait:
+        return cli.EXIT_OK
+    stop_requested = threading.Event()
+    _install_stop_handlers(stop_requested.set, lambda: sys.exit(cli.EXIT_INTERRUPTED))
+    progress = coordinator.wait(job_id, should_stop=stop_requested.is_set)
+    if stop_requested.is_set():
+        _log(f"[WARN] Ожидание прервано; задание {job_id} остается в очереди (собрать: assemble --job {job_id}).")
+        return cli.EXIT_INTERRUPTED
+    return _finish_job(coordinator, job_id, args.output_dir, progress, rejected, keep_job=args.keep_job)
+
+
+def _finish_job(coordinator, job_id, output_dir, progress, rejected=(), keep_job=False):
+    from . import cli
+    success_count, error_count, errors = coordinator.assemble(job_id, output_dir)
+    _log(f"ИТОГ: задание {job_id}: успешно {success_count}, ошибок {error_count}" + (f", пропущено {len(rejected)}" if rejected else ""))
+    for error in errors:
+        _log(f"[WARN] {error}")
+    if not keep_job:
+        coordinator.queue.delete_job(job_id)
+    if success_count and not error_count and not rejected and not progress["failed"]:
+        return cli.EXIT_OK
+    return cli.EXIT_PARTIAL if success_count else cli.EXIT_FAILED
+
+
+def build_parser():
+    from . import cli
+    parser = argparse.ArgumentParser(prog="python -m transgemini_core.distributed",
+                                     description="Распределенный перевод: координатор и воркеры через общую очередь.")
+    parser.add_argument("--queue", required=True, help="Очередь: redis://host:6379/0 или sqlite:///путь/к/queue.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    worker = commands.add_parser("worker", help="Брать элементы из очереди и переводить")
+    worker.add_argument("--api-key", action="append", default=[])
+    worker.add_argument("--api-keys-file")
+    worker.add_argument("--concurrency", type=int, default=1, help="Элементов одновременно на этом хосте")
+    worker.add_argument("--proxy")
+    worker.add_argument("--cache-dir", help="Каталог для входных файлов и промежуточных результатов")
+    worker.add_argument("--lease-seconds", type=int, default=DEFAULT_LEASE_SECONDS)
+    worker.add_argument("--worker-id")
+    worker.add_argument("--exit-when-idle", action="store_true", help="Завершиться, когда очередь опустеет")
+
+    submit = commands.add_parser("submit", help="Поставить файлы в очередь, дождаться и собрать результат")
+    submit.add_argument("inputs", nargs="*")
+    submit.add_argument("--manifest")
+    submit.add_argument("-o", "--output-dir", required=True)
+    submit.add_argument("-f", "--format", dest="output_format", choices=sorted(set(cli.OUTPUT_FORMATS.values())), default="txt")
+    submit.add_argument("--model", default=cli.DEFAULT_MODEL_NAME)
+    submit.add_argument("--fallback-models", action="store_true")
+    submit.add_argument("--prompt-file")
+    submit.add_argument("--temperature", type=float, default=1.0)
+    submit.add_argument("--chunking", action=argparse.BooleanOptionalAction, default=None)
+    submit.add_argument("--chunk-limit", type=int, default=cli.DEFAULT_CHARACTER_LIMIT_FOR_CHUNK)
+    submit.add_argument("--chunk-window", type=int, default=cli.DEFAULT_CHUNK_SEARCH_WINDOW)
+    submit.add_argument("--chunk-delay", type=float, default=0.0)
+    submit.add_argument("--epub-select", choices=("auto", "all"), default="auto")
+    submit.add_argument("--glossary")
+    submit.add_argument("--image-profile", choices=sorted(cli.OUTPUT_IMAGE_PROFILES), default=cli.DEFAULT_OUTPUT_IMAGE_PROFILE)
+    submit.add_argument("--job-id")
+    submit.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS)
+    submit.add_argument("--no-wait", action="store_true", help="Только поставить в очередь (собрать позже: assemble)")
+    submit.add_argument("--keep-job", action="store_true", help="Не удалять задание из очереди после сборки")
+
+    status = commands.add_parser("status", help="Прогресс задания")
+    status.add_argument("--job", required=True)
+
+    assemble = commands.add_parser("assemble", help="Дождаться и собрать ранее поставленное задание")
+    assemble.add_argument("--job", required=True)
+    assemble.add_argument("-o", "--output-dir", required=True)
+    assemble.add_argument("--keep-job", action="store_true")
+    return parser
+
+
+def main(argv=None):
+    from . import cli
+    args = build_parser().parse_args(argv)
+    try:
+        if args.command == "status":
+            print(json.dumps(open_work_queue(args.queue).job_progress(args.job)))
+            return cli.EXIT_OK
+        if args.command == "assemble":
+            coordinator = DistributedCoordinator(open_work_queue(args.queue), log_callback=_log)
+            return _finish_job(coordinator, args.job, args.output_dir, coordinator.wait(args.job), keep_job=args.keep_job)
+        if args.command == "worker":
+            cli.require_dependencies("core")
+            return _run_worker(args)
+        return _run_submit(args)
+    except cli.MissingDependencyError as e:
+        print(f"[ERROR] {e}", file=sys.stderr)
+        return cli.EXIT_MISSING_DEPENDENCIES
+    except (cli.UsageError, ValueError) as e:
+        print(f"[ERROR] {e}", file=sys.stderr)
+        return cli.EXIT_USAGE
+
+
+if __name__ == "__main__":
+    sys.exit(main())
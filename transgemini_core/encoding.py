@@ -0,0 +1,164 @@
+# --- START OF FILE transgemini_core/encoding.py ---
+"""Определение кодировки входных файлов: BOM, объявление в XML/HTML, статистика по образцу.
+
+Одно место вместо перебора utf-8 -> cp1251 -> latin-1 в каждом читателе: кодировка решается
+по первым SAMPLE_BYTES байтам, результат кэшируется по (путь, mtime, размер), и файл читается
+ровно один раз уже нужным кодеком.
+"""
+
+import os
+import re
+import codecs
+import threading
+
+SAMPLE_BYTES = 256 * 1024 # Образец для статистики
+_DECLARATION_BYTES = 4096 # Объявление кодировки ищем только в начале разметки
+_CACHE_MAX_ENTRIES = 512
+_MARKUP_EXTENSIONS = ('.html', '.htm', '.xhtml', '.xml', '.opf', '.ncx')
+
+# UTF-32 LE проверяется раньше UTF-16 LE: его BOM начинается с тех же FF FE
+_BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+_XML_DECLARATION_RE = re.compile(rb'^\s*<\?xml[^>]*?\bencoding\s*=\s*["\']([A-Za-z0-9._:-]+)["\']')
+# И <meta charset="...">, и <meta http-equiv="Content-Type" content="text/html; charset=...">
+_META_CHARSET_RE = re.compile(rb'<meta\b[^>]*?\bcharset\s*=\s*["\']?\s*([A-Za-z0-9._:-]+)', re.IGNORECASE)
+# Таблицы для bytes.translate: остаток после удаления - байты >= 0x80 и латинские буквы соответственно
+_ASCII_BYTES = bytes(range(0x80))
+_NON_LETTER_BYTES = bytes(byte for byte in range(256) if not (0x41 <= byte <= 0x5A or 0x61 <= byte <= 0x7A))
+# Частые строчные буквы русского текста: по ним различаются cp1251, koi8-r и cp866
+_FREQUENT_CYRILLIC = frozenset('оеаинтсрвлкмдпуяыьгзбчйжшюцщэфъё')
+_CYRILLIC_CANDIDATES = ('cp1251', 'koi8-r', 'cp866')
+# Доля байтов >= 0x80 среди букв, начиная с которой текст считаем кириллическим, а не западноевропейским
+_CYRILLIC_HIGH_BYTE_SHARE = 0.3
+_UTF_FAMILY = ('utf-8', 'utf-8-sig', 'ascii')
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _decodes(sample, encoding, complete):
+    """Декодируется ли образец без ошибок. Незавершенная последовательность в конце неполного образца - не ошибка."""
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(sample, final=complete)
+        return True
+    except (UnicodeDecodeError, LookupError):
+        return False
+
+
+def _declared_encoding(sample):
+    head = sample[:_DECLARATION_BYTES]
+    match = _XML_DECLARATION_RE.match(head) or _META_CHARSET_RE.search(head)
+    if not match: return None
+    try: return codecs.lookup(match.group(1).decode('ascii')).name
+    except LookupError: return None
+
+
+def _guess_utf16(sample):
+    """UTF-16 без BOM: пробелы, латиница и разметка дают нулевые байты только на четных либо только на нечетных позициях."""
+    if len(sample) < 4: return None
+    even_zeros, odd_zeros = sample[0::2].count(0), sample[1::2].count(0)
+    min_zeros = len(sample) // 40 # Хотя бы пробелы: ~5% символов
+    if odd_zeros >= min_zeros and even_zeros * 10 < odd_zeros: return 'utf-16-le'
+    if even_zeros >= min_zeros and odd_zeros * 10 < even_zeros: return 'utf-16-be'
+    return None
+
+
+def _cyrillic_score(sample, encoding):
+    text = sample.decode(encoding, errors='replace')
+    return sum(text.count(char) for char in _FREQUENT_CYRILLIC)
+
+
+def detect_encoding(data, markup=False, complete=None):
+    """Кодировка байтов data (проверяются первые SAMPLE_BYTES).
+
+    Порядок: BOM; объявление <?xml encoding>/<meta charset> (если markup и образец им
+    декодируется); корректный UTF-8; UTF-16 без BOM; кириллические однобайтовые кодировки
+    по частоте строчных букв; cp1252; latin-1 (декодирует что угодно).
+    complete - весь ли файл в data (по умолчанию - если он уместился в образец).
+    """
+    for bom, encoding in _BOMS:
+        if data.startswith(bom): return encoding
+
+    sample = data[:SAMPLE_BYTES]
+    if complete is None: complete = len(data) <= SAMPLE_BYTES
+    is_ascii = sample.isascii()
+    valid_utf8 = _decodes(sample, 'utf-8', complete)
+
+    if markup:
+        declared = _declared_encoding(sample)
+        # Однобайтовое объявление при корректном не-ASCII UTF-8 - почти всегда ошибка автора файла
+        if declared and not declared.startswith('utf-16') and _decodes(sample, declared, complete) \
+                and (declared.startswith('utf') or is_ascii or not valid_utf8):
+            return declared
+
+    if valid_utf8 and 0 not in sample: return 'utf-8'
+    utf16 = _guess_utf16(sample)
+    if utf16 and _decodes(sample, utf16, complete): return utf16
+    if valid_utf8: return 'utf-8'
+
+    high_bytes = len(sample.translate(None, _ASCII_BYTES))
+    ascii_letters = len(sample.translate(None, _NON_LETTER_BYTES))
+    if high_bytes >= _CYRILLIC_HIGH_BYTE_SHARE * (high_bytes + ascii_letters):
+        return max(_CYRILLIC_CANDIDATES, key=lambda encoding: _cyrillic_score(sample, encoding))
+    if _decodes(sample, 'cp1252', complete): return 'cp1252'
+    return 'latin-1'
+
+
+def _is_markup_path(filepath):
+    return str(filepath).lower().endswith(_MARKUP_EXTENSIONS)
+
+
+def _cache_key(filepath, member=None, stat_result=None):
+    stat_result = stat_result or os.stat(filepath)
+    return (os.path.realpath(filepath), stat_result.st_mtime_ns, stat_result.st_size, member)
+
+
+def _cached(key, detect):
+    with _cache_lock:
+        encoding = _cache.get(key)
+    if encoding is None:
+        encoding = detect()
+        with _cache_lock:
+            if len(_cache) >= _CACHE_MAX_ENTRIES: _cache.pop(next(iter(_cache))) # Самая старая запись
+            _cache[key] = encoding
+    return encoding
+
+
+def detect_file_encoding(filepath, markup=None):
+    """Кодировка файла по первым SAMPLE_BYTES байтам; кэшируется, пока не изменились mtime и размер."""
+    if markup is None: markup = _is_markup_path(filepath)
+    with open(filepath, 'rb') as f:
+        stat_result = os.fstat(f.fileno())
+        return _cached(_cache_key(filepath, stat_result=stat_result),
+                       lambda: detect_encoding(f.read(SAMPLE_BYTES), markup, complete=stat_result.st_size <= SAMPLE_BYTES))
+
+
+def decode_bytes(data, markup=False, filepath=None, member=None):
+    """Декодирует уже прочитанные байты: (текст, кодировка).
+
+    filepath/member задают ключ кэша - например, EPUB и путь HTML внутри него, - чтобы
+    повторная обработка того же файла не определяла кодировку заново.
+    """
+    detect = lambda: detect_encoding(data, markup)
+    encoding = _cached(_cache_key(filepath, member), detect) if filepath else detect()
+    return data.decode(encoding, errors='replace'), encoding
+
+
+def read_text_file(filepath, markup=None):
+    """Читает текстовый файл один раз: (текст, кодировка). Переводы строк - как у open(..., 'r')."""
+    if markup is None: markup = _is_markup_path(filepath)
+    with open(filepath, 'rb') as f:
+        stat_result = os.fstat(f.fileno())
+        data = f.read()
+    encoding = _cached(_cache_key(filepath, stat_result=stat_result), lambda: detect_encoding(data, markup))
+    text = data.decode(encoding, errors='replace')
+    if '\r' in text: text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text, encoding
+
+
+def is_utf8_encoding(encoding):
+    """UTF-8 (с BOM или без) или ASCII - то, что раньше читалось без предупреждений."""
+    return encoding in _UTF_FAMILY
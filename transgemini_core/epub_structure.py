@@ -0,0 +1,134 @@
+# --- START OF FILE transgemini_core/epub_structure.py ---
+
+import os
+import re
+import zipfile
+from pathlib import Path
+
+from .deps import etree
+from .utils import TRANSLATED_SUFFIX
+
+EPUB_HTML_EXTENSIONS = ('.html', '.xhtml', '.htm')
+
+_SKIP_INDICATORS = ['toc', 'nav', 'ncx', 'cover', 'title', 'index', 'copyright', 'about', 'meta', 'opf',
+                    'masthead', 'colophon', 'imprint', 'acknowledgments', 'dedication',
+                    'glossary', 'bibliography', 'notes', 'annotations', 'epigraph', 'halftitle',
+                    'frontmatter', 'backmatter', 'preface', 'introduction', 'appendix', 'biography',
+                    'isbn', 'legal', 'notice', 'otherbooks', 'prelims', 'team', 'promo', 'bonus']
+_SKIP_DIR_INDICATORS = ['toc', 'nav', 'meta', 'frontmatter', 'backmatter', 'index', 'notes']
+_CONTENT_INDICATORS = ['chapter', 'part', 'section', 'content', 'text', 'page', 'body', 'main', 'article',
+                       'chp', 'chap', 'prt', 'sec', 'glava', 'prologue', 'epilogue']
+
+
+def find_epub_toc_paths(epub_path, log_callback=print):
+    """Finds NAV, NCX paths, OPF directory, and NAV/NCX item IDs within an EPUB."""
+
+    nav_path_in_zip = None; ncx_path_in_zip = None
+    opf_dir_in_zip = None; opf_path_in_zip = None
+    nav_item_id = None; ncx_item_id = None
+    try:
+        with zipfile.ZipFile(epub_path, 'r') as zipf:
+
+            try:
+                container_data = zipf.read('META-INF/container.xml')
+
+                container_root = etree.fromstring(container_data)
+
+                cnt_ns = {'oebps': 'urn:oasis:names:tc:opendocument:xmlns:container'}
+                opf_path_rel = container_root.xpath('//oebps:rootfile/@full-path', namespaces=cnt_ns)[0]
+                opf_path_in_zip = opf_path_rel.replace('\\', '/') # Normalize path separator
+                opf_dir_in_zip = os.path.dirname(opf_path_in_zip)
+                if opf_dir_in_zip == '.': opf_dir_in_zip = "" # Use empty string for root
+            except (KeyError, IndexError, etree.XMLSyntaxError) as container_err:
+
+                print(f"[WARN] EPUB {Path(epub_path).name}: container.xml не найден/некорректен ({container_err}). Поиск OPF...")
+                found_opf = False
+                for name in zipf.namelist():
+
+                    if name.lower().endswith('.opf') and not name.lower().startswith('meta-inf/') and name.lower() != 'mimetype':
+                         opf_path_in_zip = name.replace('\\', '/')
+
+                         opf_dir_in_zip = os.path.dirname(opf_path_in_zip)
+
+                         if opf_dir_in_zip == '.': opf_dir_in_zip = ""
+
+                         print(f"[INFO] EPUB {Path(epub_path).name}: Найден OPF: {opf_path_in_zip} (в директории: '{opf_dir_in_zip or '<root>'}')")
+                         found_opf = True; break # Take the first one found
+                if not found_opf:
+                    log_callback(f"[ERROR] EPUB {Path(epub_path).name}: Не удалось найти OPF файл (ни через container.xml, ни поиском).")
+
+                    return None, None, None, None, None # Critical failure
+
+            if opf_path_in_zip is None or opf_dir_in_zip is None:
+                 log_callback(f"[ERROR] EPUB {Path(epub_path).name}: OPF путь или директория не определены.")
+                 return None, None, None, None, None
+
+            opf_data = zipf.read(opf_path_in_zip)
+            opf_root = etree.fromstring(opf_data) # Use lxml for parsing OPF
+            ns = {'opf': 'http://www.idpf.org/2007/opf'} # OPF namespace
+
+            ncx_id_from_spine = None
+            spine_node = opf_root.find('opf:spine', ns)
+            if spine_node is not None:
+                ncx_id_from_spine = spine_node.get('toc') # 'toc' attribute points to NCX ID
+
+            manifest_node = opf_root.find('opf:manifest', ns)
+            if manifest_node is not None:
+                for item in manifest_node.findall('opf:item', ns):
+                    item_id = item.get('id'); item_href = item.get('href');
+                    item_media_type = item.get('media-type'); item_properties = item.get('properties')
+
+                    if item_href: # Ensure href exists
+
+                        item_path_abs = os.path.normpath(os.path.join(opf_dir_in_zip, item_href)).replace('\\', '/')
+
+                        if item_properties and 'nav' in item_properties.split():
+                            if nav_path_in_zip is None: # Take the first one found
+                                nav_path_in_zip = item_path_abs
+                                nav_item_id = item_id
+                            else: print(f"[WARN] EPUB {Path(epub_path).name}: Найдено несколько элементов с 'properties=nav'. Используется первый: {nav_path_in_zip}")
+
+                        if item_media_type == 'application/x-dtbncx+xml' or (ncx_id_from_spine and item_id == ncx_id_from_spine):
+                            if ncx_path_in_zip is None: # Take the first one found
+                                 ncx_path_in_zip = item_path_abs
+                                 ncx_item_id = item_id
+                            else: print(f"[WARN] EPUB {Path(epub_path).name}: Найдено несколько NCX файлов. Используется первый: {ncx_path_in_zip}")
+
+        log_parts = [f"OPF_Dir='{opf_dir_in_zip or '<root>'}'"]
+        if nav_path_in_zip: log_parts.append(f"NAV='{nav_path_in_zip}'(ID={nav_item_id})")
+        if ncx_path_in_zip: log_parts.append(f"NCX='{ncx_path_in_zip}'(ID={ncx_item_id})")
+        log_callback(f"Структура {Path(epub_path).name}: {', '.join(log_parts)}")
+
+        return nav_path_in_zip, ncx_path_in_zip, opf_dir_in_zip, nav_item_id, ncx_item_id
+
+    except (KeyError, IndexError, etree.XMLSyntaxError, zipfile.BadZipFile) as e:
+        log_callback(f"[ERROR] Не удалось найти/прочитать структуру OPF/TOC в {os.path.basename(epub_path)}: {e}")
+        return None, None, None, None, None # Return None for all on error
+
+
+def list_epub_html_files(epub_zip):
+    """Returns sorted HTML/XHTML paths inside an opened EPUB zip (service folders excluded)."""
+    return sorted([
+        name for name in epub_zip.namelist()
+        if name.lower().endswith(EPUB_HTML_EXTENSIONS)
+        and not name.startswith(('__MACOSX', 'META-INF/')) # Exclude common non-content paths
+    ])
+
+
+def is_translated_html(html_path):
+    return Path(html_path).stem.endswith(TRANSLATED_SUFFIX)
+
+
+def is_likely_content_html(html_path):
+    """Heuristic used for default selection: chapter-like files yes, TOC/cover/notes and similar no."""
+    path = Path(html_path.lower())
+    filename_base = path.stem.split('.')[0] # Get stem before first dot
+    is_likely_skip = any(skip in filename_base for skip in _SKIP_INDICATORS)
+    is_likely_skip = is_likely_skip or any(skip in str(path.parent) for skip in _SKIP_DIR_INDICATORS)
+    if is_likely_skip:
+        return False
+    is_likely_content = any(indicator in filename_base for indicator in _CONTENT_INDICATORS)
+    is_chapter_like = re.fullmatch(r'(ch|gl|chap|chapter|part|section|sec|glava)[\d_-]+.*', filename_base) or \
+                      re.fullmatch(r'[\d]+', filename_base) or \
+                      re.match(r'^[ivxlcdm]+$', filename_base)
+    return bool(is_likely_content or is_chapter_like)
@@ -0,0 +1,277 @@
+# --- START OF FILE transgemini_core/glossary.py ---
+
+import os
+import json
+import threading
+from collections import OrderedDict, deque
+
+from .config import GLOSSARY_SAVE_DEBOUNCE_SECONDS
+
+
+class ContextManager:
+    """Управляет долгосрочным контекстом: глоссарием, резюме и т.д."""
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        self.glossary_file = os.path.join(output_folder, 'context_glossary.json')
+        self.glossary = {}
+        self.learned_terms = {} # Термины, выученные по ходу перевода (отдельный маленький индекс)
+        self._known_terms = set()
+        # Индексы держатся здесь, а не в общем кэше DynamicGlossaryFilter: выученные термины меняются
+        # после каждого чанка и не должны вытеснять индекс большого основного глоссария
+        self._glossary_matcher = None # ((id, размер) словаря, GlossaryMatcher)
+        self._learned_matcher = None
+        self._lock = threading.Lock()
+        self._save_timer = None
+        self.load_glossary()
+
+    def load_glossary(self):
+        """Загружает глоссарий из файла"""
+        try:
+            if os.path.exists(self.glossary_file):
+                with open(self.glossary_file, 'r', encoding='utf-8') as f:
+                    self.glossary = json.load(f)
+        except Exception as e:
+            print(f"Ошибка загрузки глоссария: {e}")
+            self.glossary = {}
+        self.learned_terms = {}
+        self._known_terms = {self._normalize_term(term) for term in self.glossary}
+        self._glossary_matcher = self._learned_matcher = None
+
+    def save_glossary(self):
+        """Сохраняет глоссарий (вместе с выученными терминами) в файл"""
+        try:
+            with self._lock:
+                merged_glossary = {**self.glossary, **self.learned_terms}
+            os.makedirs(self.output_folder, exist_ok=True)
+            with open(self.glossary_file, 'w', encoding='utf-8') as f:
+                json.dump(merged_glossary, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            print(f"Ошибка сохранения глоссария: {e}")
+
+    @staticmethod
+    def _normalize_term(term):
+        return " ".join(str(term).split()).casefold()
+
+    def update_terms(self, terms):
+        """Добавляет термины в основной глоссарий (существующие не перезаписываются)"""
+        with self._lock:
+            for original, translation in terms.items():
+                normalized = self._normalize_term(original)
+                if normalized and normalized not in self._known_terms:
+                    self._known_terms.add(normalized)
+                    self.glossary[original] = translation
+                    self._glossary_matcher = None
+
+    def learn_terms(self, terms):
+        """Добавляет выученные термины в индекс в памяти и планирует отложенное сохранение. Возвращает число новых"""
+        added = {}
+        with self._lock:
+            for original, translation in terms.items():
+                normalized = self._normalize_term(original)
+                if not normalized or normalized in self._known_terms:
+                    continue
+                self._known_terms.add(normalized)
+                added[original] = translation
+            if added:
+                # Новый словарь, а не изменение на месте: потоки, читающие индекс, видят целостную версию
+                self.learned_terms = {**self.learned_terms, **added}
+        if added:
+            self.schedule_save()
+        return len(added)
+
+    def schedule_save(self, delay=GLOSSARY_SAVE_DEBOUNCE_SECONDS):
+        """Откладывает запись на диск: серия изменений сохраняется одним вызовом"""
+        with self._lock:
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(delay, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush(self):
+        """Немедленно сохраняет отложенные изменения"""
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+        self.save_glossary()
+
+    @staticmethod
+    def _matcher_for(cached, terms):
+        """(ключ, индекс) для словаря terms: прежний, если словарь тот же, иначе построенный заново"""
+        key = (id(terms), len(terms))
+        if cached is not None and cached[0] == key:
+            return cached
+        return key, GlossaryMatcher(terms)
+
+    def get_terms_for_text(self, text_content):
+        """Возвращает термины основного и выученного глоссариев, встречающиеся в тексте"""
+        glossary, learned_terms = self.glossary, self.learned_terms
+        relevant_terms = {}
+        if glossary:
+            self._glossary_matcher = self._matcher_for(self._glossary_matcher, glossary)
+            relevant_terms = DynamicGlossaryFilter.filter_glossary(text_content, glossary, matcher=self._glossary_matcher[1])
+        if learned_terms:
+            self._learned_matcher = self._matcher_for(self._learned_matcher, learned_terms)
+            relevant_terms = {**relevant_terms, **DynamicGlossaryFilter.filter_glossary(text_content, learned_terms, matcher=self._learned_matcher[1])}
+        return relevant_terms
+
+    def get_glossary_as_json_str(self):
+        """Возвращает глоссарий как строку JSON"""
+        return json.dumps(self.glossary, ensure_ascii=False, indent=2)
+        
+    def set_glossary_from_json_str(self, json_str):
+        """Устанавливает глоссарий из строки JSON"""
+        try:
+            self.glossary = json.loads(json_str)
+            self.learned_terms = {}
+            self._known_terms = {self._normalize_term(term) for term in self.glossary}
+            self._glossary_matcher = self._learned_matcher = None
+            self.save_glossary()
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Неверный формат JSON: {e}")
+
+    def format_glossary_for_prompt(self, text_content=None):
+        """Форматирует глоссарий для промпта с возможной фильтрацией"""
+        if not self.glossary and not self.learned_terms:
+            return ""
+            
+        # Если указан контент, применяем динамическую фильтрацию
+        glossary_to_use = {**self.glossary, **self.learned_terms}
+        if text_content:
+            glossary_to_use = self.get_terms_for_text(text_content)
+            
+        if not glossary_to_use:
+            return ""
+            
+        return f"\n\n**ГЛОССАРИЙ:**\n" + DynamicGlossaryFilter.format_terms(glossary_to_use)
+
+class GlossaryMatcher:
+    """Мультишаблонный индекс терминов глоссария (автомат Ахо-Корасик).
+
+    Строится один раз на глоссарий и за один проход по тексту находит все термины,
+    которые прошли бы проверки DynamicGlossaryFilter: прямое вхождение термина,
+    вхождение слова (> 2 символов) составного термина, вхождение любой 4-символьной
+    подстроки термина длиннее 3 символов.
+    """
+    def __init__(self, terms):
+        self.terms = tuple(terms)
+        self.always_matching = [] # Пустой термин входит в любой текст
+        self._goto = [{}]         # Переходы автомата по символу
+        self._fail = [0]          # Суффиксные ссылки
+        self._term_ids = [()]     # Термины, чьи шаблоны заканчиваются в состоянии
+        self._output_link = [0]   # Ближайшее по суффиксной ссылке состояние с терминами
+
+        needle_terms = {}
+        for term_index, original in enumerate(self.terms):
+            needles = self._needles_for_term(original)
+            if "" in needles:
+                self.always_matching.append(term_index)
+                needles.discard("")
+            for needle in needles:
+                needle_terms.setdefault(needle, []).append(term_index)
+        for needle, term_indices in needle_terms.items():
+            self._add_needle(needle, term_indices)
+        self._build_links()
+
+    @staticmethod
+    def _needles_for_term(original):
+        original_lower = original.lower()
+        needles = {original_lower}
+        if ' ' in original_lower:
+            needles.update(word for word in original_lower.split() if len(word) > 2)
+        if len(original) > 3:
+            needles.update(original_lower[i:i+4] for i in range(len(original_lower) - 3))
+        return needles
+
+    def _add_needle(self, needle, term_indices):
+        state = 0
+        for char in needle:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._term_ids.append(())
+                self._output_link.append(0)
+                self._goto[state][char] = next_state
+            state = next_state
+        self._term_ids[state] = tuple(term_indices)
+
+    def _build_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                fail_state = self._fail[next_state]
+                self._output_link[next_state] = fail_state if self._term_ids[fail_state] else self._output_link[fail_state]
+                queue.append(next_state)
+
+    def find_term_indices(self, text_lower):
+        """Возвращает отсортированные индексы терминов, найденных в тексте (текст уже в нижнем регистре)."""
+        goto, fail, output_link, term_ids = self._goto, self._fail, self._output_link, self._term_ids
+        visited = set()
+        state = 0
+        for char in text_lower:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            # Цепочку выходных ссылок проходим только до уже встреченного состояния
+            match_state = state if term_ids[state] else output_link[state]
+            while match_state and match_state not in visited:
+                visited.add(match_state)
+                match_state = output_link[match_state]
+        found = set(self.always_matching)
+        for matched_state in visited:
+            found.update(term_ids[matched_state])
+        return sorted(found)
+
+class DynamicGlossaryFilter:
+    """Класс для динамической фильтрации глоссария по содержимому текста"""
+
+    _MATCHER_CACHE_SIZE = 4
+    _matcher_cache = OrderedDict() # {hash(кортеж терминов): GlossaryMatcher}, от давно использованных к недавним
+    _matcher_cache_lock = threading.Lock()
+
+    @classmethod
+    def get_matcher(cls, full_glossary):
+        """Возвращает скомпилированный индекс для глоссария; пересобирается, только если изменился набор терминов."""
+        terms = tuple(full_glossary)
+        signature = hash(terms)
+        with cls._matcher_cache_lock:
+            matcher = cls._matcher_cache.get(signature)
+            if matcher is not None and matcher.terms == terms:
+                cls._matcher_cache.move_to_end(signature)
+                return matcher
+        matcher = GlossaryMatcher(terms)
+        with cls._matcher_cache_lock:
+            cls._matcher_cache[signature] = matcher
+            cls._matcher_cache.move_to_end(signature)
+            while len(cls._matcher_cache) > cls._MATCHER_CACHE_SIZE:
+                cls._matcher_cache.popitem(last=False) # Вытесняется самый давно использованный
+        return matcher
+
+    @staticmethod
+    def format_terms(glossary):
+        """Форматирует термины глоссария построчно: '  оригинал = перевод'"""
+        return "\n".join(f"  {original} = {translation}" for original, translation in glossary.items())
+
+    @staticmethod
+    def filter_glossary(text_content, full_glossary, min_relevance_score=0.1, matcher=None):
+        """
+        Фильтрует глоссарий, оставляя только релевантные для данного текста термины.
+        matcher - готовый индекс этого глоссария (иначе берется из общего кэша)
+        """
+        if not full_glossary or not text_content:
+            return full_glossary
+
+        if matcher is None: matcher = DynamicGlossaryFilter.get_matcher(full_glossary)
+        return {
+            matcher.terms[term_index]: full_glossary[matcher.terms[term_index]]
+            for term_index in matcher.find_term_indices(text_content.lower())
+        }
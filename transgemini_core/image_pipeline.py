@@ -0,0 +1,225 @@
+# --- START OF FILE transgemini_core/image_pipeline.py ---
+"""Конвертация изображений в пуле процессов с дисковым кэшем результатов.
+
+EMF/WMF/TIFF/WebP, которые не умеют показывать DOCX/FB2/читалки, перекодируются в PNG.
+Pillow держит GIL на декодировании, поэтому конвертация идет в отдельных процессах, а
+готовый PNG кладется в кэш по хэшу исходных байт: повторный запуск на том же документе
+(или другой документ с той же диаграммой) конвертацию не повторяет.
+"""
+
+import os
+import sys
+import atexit
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .utils import convert_image_to_png, recompress_image_file
+
+IMAGE_CACHE_ENV_VAR = "TRANSGEMINI_IMAGE_CACHE" # Каталог кэша; "off" - не использовать диск
+DEFAULT_IMAGE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".transgemini", "image_cache")
+IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024 # Сверх лимита удаляются давно не использованные файлы
+CONVERSION_POOL_ENV_VAR = "TRANSGEMINI_IMAGE_WORKERS" # Число процессов; 0 - конвертировать в текущем потоке
+
+TELEGRAM_MAX_UPLOAD_BYTES = 50 * 1024 * 1024 # Лимит Bot API на отправку документа
+
+# Профили изображений в выходных файлах (DOCX/HTML/FB2). max_dimension - большая сторона в px,
+# jpeg_quality - качество для непрозрачных изображений, target_bytes - бюджет на весь файл:
+# если изображения (с учетом Base64) в него не влезают, они пережимаются ступенями сильнее.
+OUTPUT_IMAGE_PROFILES = {
+    "original": None, # Изображения как есть
+    "archive": {"max_dimension": 2400, "jpeg_quality": 90, "target_bytes": None},
+    "telegram": {"max_dimension": 1600, "jpeg_quality": 80, "target_bytes": TELEGRAM_MAX_UPLOAD_BYTES - 2 * 1024 * 1024},
+}
+DEFAULT_OUTPUT_IMAGE_PROFILE = "original"
+# Ступени ужатия под target_bytes: множитель max_dimension и снижение качества JPEG
+PROFILE_SHRINK_STEPS = ((1.0, 0), (0.75, 10), (0.5, 20), (0.35, 30), (0.25, 35))
+MIN_PROFILE_DIMENSION = 320
+
+_pool_lock = threading.Lock()
+_pool = None
+_pool_disabled = False
+
+
+def _pool_size():
+    configured = os.environ.get(CONVERSION_POOL_ENV_VAR)
+    if configured is not None:
+        try: return max(0, int(configured))
+        except ValueError: pass
+    return max(1, min(4, (os.cpu_count() or 2) - 1))
+
+
+def get_conversion_pool():
+    """Общий на процесс пул конвертации (создается при первой конвертации); None - конвертируем на месте."""
+    global _pool, _pool_disabled
+    with _pool_lock:
+        if _pool is not None or _pool_disabled: return _pool
+        workers = _pool_size()
+        if workers == 0 or getattr(multiprocessing.current_process(), "daemon", False):
+            _pool_disabled = True; return None # Демон-процессы не могут порождать дочерние
+        try:
+            # fork из многопоточного процесса (Qt, asyncio, пул переводчиков) может зависнуть на чужих блокировках
+            method = "forkserver" if sys.platform != "win32" and "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+        except (OSError, ValueError, NotImplementedError) as e:
+            print(f"[WARN] ImagePipeline: Пул процессов недоступен ({e}), конвертация в текущем потоке.")
+            _pool_disabled = True
+        return _pool
+
+
+def shutdown_conversion_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None: pool.shutdown(wait=True, cancel_futures=True)
+
+atexit.register(shutdown_conversion_pool)
+
+
+class ConversionTask:
+    """Конвертация одного изображения: в пуле процессов или, без пула, при первом result()."""
+    def __init__(self, data):
+        self._data = data
+        self._future = None
+        pool = get_conversion_pool()
+        if pool is not None:
+            try: self._future = pool.submit(convert_image_to_png, data)
+            except (BrokenProcessPool, RuntimeError) as e:
+                print(f"[WARN] ImagePipeline: Пул процессов не принял задачу ({e}), конвертация в текущем потоке.")
+
+    def result(self):
+        if self._future is not None:
+            try: return self._future.result()
+            except BrokenProcessPool as e:
+                print(f"[WARN] ImagePipeline: Процесс конвертации упал ({e}), повтор в текущем потоке.")
+        return convert_image_to_png(self._data)
+
+
+class ConvertedImageCache:
+    """Дисковый кэш сконвертированных изображений: <каталог>/<ключ>.<png|jpg>."""
+    def __init__(self, cache_dir=None, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        if cache_dir is None: cache_dir = os.environ.get(IMAGE_CACHE_ENV_VAR, DEFAULT_IMAGE_CACHE_DIR)
+        self.cache_dir = None if cache_dir == "off" else os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        if self.cache_dir:
+            try: os.makedirs(self.cache_dir, exist_ok=True)
+            except OSError as e:
+                print(f"[WARN] ImagePipeline: Кэш изображений отключен, каталог недоступен: {e}")
+                self.cache_dir = None
+
+    def path_for(self, image_id, ext='png'):
+        return os.path.join(self.cache_dir, f"{image_id}.{ext}") if self.cache_dir else None
+
+    def get(self, image_id, exts=('png',)):
+        for ext in exts:
+            path = self.path_for(image_id, ext)
+            if path and os.path.exists(path):
+                try: os.utime(path) # mtime = время последнего использования для prune()
+                except OSError: pass
+                return path
+        return None
+
+    def put(self, image_id, data, ext='png'):
+        """Сохраняет файл в кэш и возвращает путь (None - кэш отключен или запись не удалась)."""
+        path = self.path_for(image_id, ext)
+        if not path: return None
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f: f.write(data)
+            os.replace(tmp_path, path)
+            return path
+        except OSError as e:
+            print(f"[WARN] ImagePipeline: Не удалось записать кэш {path}: {e}")
+            try: os.remove(tmp_path)
+            except OSError: pass
+            return None
+
+    def prune(self):
+        """Удаляет самые старые файлы, пока кэш больше max_bytes."""
+        if not self.cache_dir: return
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file() and entry.name.endswith((".png", ".jpg"))]
+            stats = sorted(((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries))
+        except OSError: return
+        total = sum(size for _, size, _ in stats)
+        for _, size, path in stats:
+            if total <= self.max_bytes: break
+            try: os.remove(path); total -= size
+            except OSError: pass
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''): digest.update(block)
+    return digest.hexdigest()[:32]
+
+
+def _run_recompress(path, max_dimension, jpeg_quality):
+    pool = get_conversion_pool()
+    if pool is not None:
+        try: return pool.submit(recompress_image_file, path, max_dimension, jpeg_quality)
+        except (BrokenProcessPool, RuntimeError): pass
+    return recompress_image_file(path, max_dimension, jpeg_quality) # Без пула - сразу результат
+
+
+def apply_output_image_profile(image_map, profile, text="", base64_embedded=False, cache=None, log_callback=print):
+    """Возвращает копию image_map, где изображения пережаты под профиль (исходные файлы не меняются).
+
+    Учитываются только изображения, плейсхолдеры которых есть в text (если он передан).
+    base64_embedded=True - формат встраивает изображения в Base64 (HTML, FB2): к бюджету
+    профиля они идут с коэффициентом 4/3. Результаты кэшируются по (хэш файла, профиль, ступень).
+    """
+    settings = OUTPUT_IMAGE_PROFILES.get(profile)
+    if profile not in OUTPUT_IMAGE_PROFILES: log_callback(f"[WARN] ImagePipeline: Неизвестный профиль изображений '{profile}', изображения без изменений.")
+    if not settings or not image_map: return image_map
+    from .placeholders import count_image_placeholders
+    used = set(count_image_placeholders(text)) if text else set(image_map)
+    sources = {} # UUID -> (путь, хэш файла); одинаковые файлы пережимаются один раз
+    for img_uuid in used:
+        img_path = image_map.get(img_uuid, {}).get('saved_path')
+        if img_path and os.path.exists(img_path): sources[img_uuid] = img_path
+    if not sources: return image_map
+    cache = cache if cache is not None else ConvertedImageCache()
+    digests = {path: _file_digest(path) for path in set(sources.values())}
+    inflation = 4 / 3 if base64_embedded else 1.0
+    budget = settings["target_bytes"] - len(text.encode('utf-8')) if settings["target_bytes"] else None
+
+    results = {}
+    for step, (scale, quality_drop) in enumerate(PROFILE_SHRINK_STEPS):
+        max_dimension = max(MIN_PROFILE_DIMENSION, int(settings["max_dimension"] * scale))
+        jpeg_quality = max(40, settings["jpeg_quality"] - quality_drop)
+        pending = {}
+        for path, digest in digests.items():
+            cache_key = f"{digest}_{profile}_{step}"
+            cached_path = cache.get(cache_key, exts=('jpg', 'png'))
+            if cached_path: results[path] = cached_path
+            else: pending[path] = (cache_key, _run_recompress(path, max_dimension, jpeg_quality))
+        for path, (cache_key, job) in pending.items():
+            outcome = job.result() if hasattr(job, 'result') else job
+            if outcome is None: results[path] = path; continue # Пережатие не уменьшило файл
+            data, ext = outcome
+            results[path] = cache.put(cache_key, data, ext)
+            if results[path] is None: # Кэш отключен: файл рядом с исходным
+                results[path] = f"{os.path.splitext(path)[0]}_{profile}_{step}.{ext}"
+                with open(results[path], 'wb') as f: f.write(data)
+        total = sum(os.path.getsize(path) for path in results.values())
+        if budget is None or total * inflation <= budget or step == len(PROFILE_SHRINK_STEPS) - 1:
+            break
+        log_callback(f"[INFO] ImagePipeline: Изображения ({total * inflation / 1024 / 1024:.1f} MB) не влезают в профиль '{profile}', ужимаю сильнее...")
+    original_total = sum(os.path.getsize(path) for path in digests)
+    if budget is not None and total * inflation > budget:
+        log_callback(f"[WARN] ImagePipeline: Даже после ужатия изображения занимают {total * inflation / 1024 / 1024:.1f} MB.")
+    log_callback(f"[INFO] ImagePipeline: Профиль '{profile}': изображения {original_total / 1024 / 1024:.1f} MB -> {total / 1024 / 1024:.1f} MB.")
+
+    profiled_map = dict(image_map)
+    for img_uuid, path in sources.items():
+        new_path = results.get(path, path)
+        if new_path == path: continue
+        entry = dict(image_map[img_uuid])
+        entry['saved_path'] = new_path
+        entry['content_type'] = 'image/png' if new_path.endswith('.png') else 'image/jpeg'
+        profiled_map[img_uuid] = entry
+    return profiled_map
@@ -0,0 +1,144 @@
+# --- START OF FILE transgemini_core/image_store.py ---
+"""Хранилище изображений задачи с адресацией по содержимому.
+
+Идентификатор изображения - первые 32 hex-символа SHA-256 его исходных байт, он же UUID
+в плейсхолдере <||img_placeholder_...||>. Одна и та же обложка или виньетка в сотне
+глав извлекается, конвертируется и сохраняется на диск один раз, а все плейсхолдеры
+ссылаются на одну запись; writers (FB2, HTML) встраивают ее тоже один раз.
+EMF/WMF/TIFF/WebP конвертируются в PNG в пуле процессов (image_pipeline), готовые PNG
+берутся из дискового кэша по тому же идентификатору.
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from .utils import CONVERTIBLE_IMAGE_FORMATS, get_image_extension_from_data
+from .image_pipeline import ConversionTask, ConvertedImageCache
+
+IMAGE_ID_LENGTH = 32 # Совпадает с длиной UUID в плейсхолдере
+
+
+def image_id_for_bytes(data):
+    return hashlib.sha256(data).hexdigest()[:IMAGE_ID_LENGTH]
+
+
+class ImageStore:
+    """Потокобезопасное хранилище: image_id -> {'saved_path', 'content_type', 'original_filename'}.
+
+    root_dir=None - собственный временный каталог, удаляемый в cleanup(); иначе файлы
+    пишутся в переданный каталог и его жизнью управляет вызывающий. conversion_cache -
+    ConvertedImageCache для PNG после конвертации (по умолчанию ~/.transgemini/image_cache).
+    """
+    def __init__(self, root_dir=None, conversion_cache=None):
+        self._owns_dir = root_dir is None
+        self.root_dir = root_dir or tempfile.mkdtemp(prefix="transgemini_images_")
+        os.makedirs(self.root_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._failed_ids = set() # Изображения, которые не удалось сконвертировать (не пробуем снова)
+        self._id_locks = {}
+        self._sources = {} # Ключ источника (например, (путь EPUB, src)) -> image_id или None
+        self._pending = {} # image_id -> ConversionTask, запущенная prefetch() до add()
+        self.conversion_cache = conversion_cache if conversion_cache is not None else ConvertedImageCache()
+        self.converted_count = 0
+        self.conversion_cache_hits = 0
+        self.stored_count = 0
+        self.reused_count = 0
+
+    def lookup_source(self, source_key):
+        """Возвращает (известен ли источник, image_id или None) без чтения самих байт."""
+        with self._lock:
+            if source_key in self._sources:
+                self.reused_count += 1
+                return True, self._sources[source_key]
+            return False, None
+
+    @staticmethod
+    def _detect_format(data, ext_hint):
+        hint = (ext_hint or '').lower()
+        hint = {'tif': 'tiff', 'jpeg': 'jpg'}.get(hint, hint)
+        return get_image_extension_from_data(data, fallback_ext=hint or 'jpg')
+
+    def prefetch(self, data, ext_hint=None):
+        """Заранее запускает конвертацию (не блокируется); add() тех же байт заберет результат."""
+        image_id = image_id_for_bytes(data)
+        if self._detect_format(data, ext_hint) not in CONVERTIBLE_IMAGE_FORMATS: return image_id
+        with self._lock:
+            if image_id in self._entries or image_id in self._failed_ids or image_id in self._pending: return image_id
+        if self.conversion_cache.get(image_id): return image_id
+        task = ConversionTask(data)
+        with self._lock: self._pending.setdefault(image_id, task)
+        return image_id
+
+    def add(self, data, original_filename=None, ext_hint=None, source_key=None):
+        """Добавляет изображение и возвращает image_id (None - формат не удалось сконвертировать)."""
+        image_id = image_id_for_bytes(data)
+        with self._lock:
+            id_lock = self._id_locks.setdefault(image_id, threading.Lock())
+        with id_lock: # Одинаковые новые изображения из разных потоков конвертируются один раз
+            with self._lock:
+                known = image_id in self._entries or image_id in self._failed_ids
+            if known:
+                with self._lock: self.reused_count += 1
+            else:
+                entry = self._store(image_id, data, original_filename, ext_hint)
+                with self._lock:
+                    if entry is None: self._failed_ids.add(image_id)
+                    else: self._entries[image_id] = entry; self.stored_count += 1
+        with self._lock:
+            result = image_id if image_id in self._entries else None
+            if source_key is not None:
+                self._sources[source_key] = result
+        return result
+
+    def _store(self, image_id, data, original_filename, ext_hint):
+        img_ext = self._detect_format(data, ext_hint)
+        with self._lock: task = self._pending.pop(image_id, None)
+        if img_ext in CONVERTIBLE_IMAGE_FORMATS:
+            cached_path = self.conversion_cache.get(image_id)
+            if cached_path:
+                with self._lock: self.conversion_cache_hits += 1
+                return self._entry(cached_path, 'png', original_filename)
+            png_data = (task or ConversionTask(data)).result()
+            if png_data:
+                with self._lock: self.converted_count += 1
+                cached_path = self.conversion_cache.put(image_id, png_data)
+                if cached_path: return self._entry(cached_path, 'png', original_filename)
+                data, img_ext = png_data, 'png'
+            elif img_ext == 'emf':
+                print(f"[WARN] ImageStore: Failed to convert EMF '{original_filename}', skipping.")
+                return None
+            else:
+                print(f"[WARN] ImageStore: Failed to convert {img_ext.upper()} '{original_filename}', keeping original.")
+        saved_path = os.path.join(self.root_dir, f"{image_id}.{img_ext}")
+        if not os.path.exists(saved_path):
+            tmp_path = f"{saved_path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f: f.write(data)
+            os.replace(tmp_path, saved_path)
+        return self._entry(saved_path, img_ext, original_filename)
+
+    @staticmethod
+    def _entry(saved_path, img_ext, original_filename):
+        return {'saved_path': saved_path, 'content_type': f"image/{'jpeg' if img_ext == 'jpg' else img_ext}",
+                'original_filename': original_filename or os.path.basename(saved_path)}
+
+    def image_map_entry(self, image_id, original_filename=None, **extra):
+        """Запись для image_map (новый dict: поля вхождения, например width/height, не портят общую запись)."""
+        with self._lock:
+            entry = dict(self._entries[image_id])
+        if original_filename: entry['original_filename'] = original_filename
+        entry.update(extra)
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {'stored': self.stored_count, 'reused': self.reused_count, 'failed': len(self._failed_ids),
+                    'converted': self.converted_count, 'conversion_cache_hits': self.conversion_cache_hits}
+
+    def cleanup(self):
+        self.conversion_cache.prune()
+        if self._owns_dir:
+            shutil.rmtree(self.root_dir, ignore_errors=True)
@@ -0,0 +1,60 @@
+# --- START OF FILE transgemini_core/lazy.py ---
+
+import threading
+import importlib
+import importlib.util
+
+
+class LazyModule:
+    """Модуль, который импортируется при первом обращении к его атрибуту.
+
+    Позволяет держать в ядре ссылки на тяжелые зависимости (lxml, ebooklib, Pillow,
+    python-docx, bs4, google-generativeai) без затрат на их импорт при старте:
+    `etree.fromstring(...)`, `except google_exceptions.ResourceExhausted` и
+    `isinstance(node, bs4.Tag)` подгружают модуль только когда код до них дошел.
+    on_load(module) вызывается один раз сразу после импорта (например, для настройки warnings).
+    """
+    def __init__(self, module_name, on_load=None):
+        self._module_name = module_name
+        self._on_load = on_load
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    module = importlib.import_module(self._module_name)
+                    if self._on_load is not None:
+                        self._on_load(module)
+                    self._module = module
+                module = self._module
+        return module
+
+    @property
+    def is_loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "загружен" if self._module is not None else "не загружен"
+        return f"<LazyModule {self._module_name!r} ({state})>"
+
+
+def lazy_import(module_name, on_load=None):
+    """Возвращает ленивую ссылку на модуль module_name (например, "lxml.etree")."""
+    return LazyModule(module_name, on_load)
+
+
+def is_module_available(module_name):
+    """Проверяет, установлен ли модуль, не импортируя его."""
+    try:
+        return importlib.util.find_spec(module_name) is not None
+    except (ImportError, ValueError):
+        return False
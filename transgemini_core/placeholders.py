@@ -0,0 +1,66 @@
+# --- START OF FILE transgemini_core/placeholders.py ---
+
+import re
+import collections
+
+
+IMAGE_PLACEHOLDER_PREFIX = "img_placeholder_"
+# Компилируется один раз: группа 1 - имя без скобок, группа 2 - UUID
+IMAGE_PLACEHOLDER_PATTERN = re.compile(r"<\|\|(" + IMAGE_PLACEHOLDER_PREFIX + r"([a-f0-9]{32}))\|\|>")
+
+def create_image_placeholder(img_uuid):
+    return f"<||{IMAGE_PLACEHOLDER_PREFIX}{img_uuid}||>"
+
+def find_image_placeholders(text):
+    return [(match.group(0), match.group(2)) for match in IMAGE_PLACEHOLDER_PATTERN.finditer(text)]
+
+def scan_image_placeholders(text):
+    """Один проход по тексту: таблица отрезков [(start, end, uuid), ...] в порядке появления."""
+    return [(match.start(), match.end(), match.group(2)) for match in IMAGE_PLACEHOLDER_PATTERN.finditer(text)]
+
+def count_image_placeholders(text):
+    """Возвращает Counter {UUID: число вхождений}."""
+    return collections.Counter(match.group(2) for match in IMAGE_PLACEHOLDER_PATTERN.finditer(text))
+
+def replace_image_placeholders(text, replacement):
+    """Заменяет все плейсхолдеры за один проход; replacement(uuid) возвращает строку замены."""
+    return IMAGE_PLACEHOLDER_PATTERN.sub(lambda match: replacement(match.group(2)), text)
+
+
+# Результат сверки плейсхолдеров перевода с оригиналом:
+# missing - UUID из оригинала, которых нет в переводе; new - UUID, которых не было в оригинале (удалены);
+# duplicated - {UUID: сколько лишних копий удалено}; expected_count/found_count/kept_count - количества
+PlaceholderDiff = collections.namedtuple(
+    "PlaceholderDiff", "cleaned_text missing new duplicated expected_count found_count kept_count")
+
+def reconcile_placeholders(original, translated_text):
+    """Сверяет плейсхолдеры перевода с оригиналом и убирает лишние одной сборкой строки.
+
+    original - текст оригинала или уже посчитанный count_image_placeholders(); оригинал
+    и перевод сканируются не больше одного раза. Плейсхолдеры, которых не было в оригинале,
+    и копии сверх числа вхождений в оригинале вырезаются; остальной текст не меняется.
+    Возвращает PlaceholderDiff.
+    """
+    expected = count_image_placeholders(original) if isinstance(original, str) else original
+    spans = scan_image_placeholders(translated_text)
+    kept = collections.Counter()
+    new, duplicated = [], collections.Counter()
+    pieces, position = [], 0
+    for start, end, img_uuid in spans:
+        if img_uuid not in expected:
+            new.append(img_uuid)
+        elif kept[img_uuid] >= expected[img_uuid]:
+            duplicated[img_uuid] += 1
+        else:
+            kept[img_uuid] += 1
+            continue
+        pieces.append(translated_text[position:start])
+        position = end
+    if pieces:
+        pieces.append(translated_text[position:])
+        cleaned_text = "".join(pieces)
+    else:
+        cleaned_text = translated_text
+    missing = [img_uuid for img_uuid in expected if kept[img_uuid] < expected[img_uuid]]
+    return PlaceholderDiff(cleaned_text, missing, new, dict(duplicated),
+                           sum(expected.values()), len(spans), sum(kept.values()))
@@ -0,0 +1,567 @@
+# --- START OF FILE transgemini_core/readers.py ---
+
+import io
+import os
+import re
+import mmap
+import uuid
+import codecs
+import zipfile
+import posixpath
+import traceback
+from pathlib import Path
+from urllib.parse import urlparse, unquote
+
+from .deps import BS4_AVAILABLE, LXML_AVAILABLE, bs4, etree
+from .placeholders import IMAGE_PLACEHOLDER_PREFIX, create_image_placeholder
+from .image_store import ImageStore
+
+
+# --- TXT: потоковое чтение через mmap ---
+TEXT_STREAM_BLOCK_BYTES = 1024 * 1024
+
+
+def iter_text_file_blocks(filepath, encoding='utf-8', block_bytes=TEXT_STREAM_BLOCK_BYTES, errors='strict'):
+    """Читает текстовый файл блоками по block_bytes через mmap; текст тот же, что дает open(..., 'r').read().
+
+    Файл отображается в память, а не читается целиком: прочитанные страницы сразу отдаются
+    ядру (MADV_DONTNEED), так что в памяти процесса - только текущий блок, каким бы ни был файл.
+    block_bytes должен быть кратен mmap.PAGESIZE.
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0: return # Пустой файл нельзя отобразить
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            can_advise = hasattr(mapped, 'madvise') # Python 3.8+, не Windows
+            if can_advise and hasattr(mmap, 'MADV_SEQUENTIAL'): mapped.madvise(mmap.MADV_SEQUENTIAL)
+            release_pages = can_advise and hasattr(mmap, 'MADV_DONTNEED') and block_bytes % mmap.PAGESIZE == 0
+            decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(errors), translate=True) # \r\n, \r -> \n
+            for offset in range(0, len(mapped), block_bytes):
+                text = decoder.decode(mapped[offset:offset + block_bytes])
+                if release_pages: mapped.madvise(mmap.MADV_DONTNEED, offset, min(block_bytes, len(mapped) - offset))
+                if text: yield text
+            tail = decoder.decode(b'', final=True)
+            if tail: yield tail
+
+
+# --- DOCX: потоковое чтение word/document.xml (iterparse) ---
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_WP = "{http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing}"
+_R_EMBED = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed"
+_A_BLIP = "{http://schemas.openxmlformats.org/drawingml/2006/main}blip"
+_W_BODY, _W_P, _W_TBL, _W_R, _W_HYPERLINK = _W + "body", _W + "p", _W + "tbl", _W + "r", _W + "hyperlink"
+_W_DRAWING, _W_PPR, _W_PSTYLE, _W_IND, _W_RPR, _W_B = _W + "drawing", _W + "pPr", _W + "pStyle", _W + "ind", _W + "rPr", _W + "b"
+_W_VAL, _W_LEFT, _W_TYPE = _W + "val", _W + "left", _W + "type"
+_WP_INLINE, _WP_ANCHOR, _WP_EXTENT = _WP + "inline", _WP + "anchor", _WP + "extent"
+# Текстовые элементы run так же, как их читает Run.text в python-docx
+_RUN_TEXT_TAGS = {_W + "t": None, _W + "tab": "\t", _W + "ptab": "\t", _W + "cr": "\n", _W + "noBreakHyphen": "-", _W + "br": "\n"}
+_ONOFF_TRUE = ("1", "true", "on")
+_RELS_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+_CONVERTIBLE_DOCX_EXTS = ('emf', 'wmf', 'tif', 'tiff', 'webp')
+
+DOCX_BOLD_CHAPTER_PATTERN = re.compile(r'^\s*(Глава|Chapter|Part)\s+([0-9IVXLCDM]+|[a-zA-Zа-яА-Я]+)\b.*', re.IGNORECASE)
+DOCX_NUM_MARKER_PATTERN = re.compile(r'^\s*(\d+\.|\([a-z]\)|\([A-Z]\)|[a-z]\.|[A-Z]\.)\s+') # Numbered or lettered lists
+DOCX_BULLET_MARKER_PATTERN = re.compile(r'^\s*([\*\-\•\⁃])\s+') # Common bullet chars
+DOCX_LIST_MARKER_STRIP_PATTERN = re.compile(r'^\s*(\d+\.|\([a-z]\)|\([A-Z]\)|[a-z]\.|[A-Z]\.|[\*\-\•\⁃])\s*')
+DOCX_LIST_LINE_PATTERN = re.compile(r'^([\*\-\•\⁃]|\d+\.|\([a-z]\)|\([A-Z]\)|[a-z]\.|[A-Z]\.)\s')
+
+
+def _docx_run_text(run):
+    parts = []
+    for child in run:
+        if child.tag in _RUN_TEXT_TAGS:
+            if child.tag == _W + "t": parts.append(child.text or "")
+            elif child.tag == _W + "br": parts.append("\n" if child.get(_W_TYPE, "textWrapping") == "textWrapping" else "")
+            else: parts.append(_RUN_TEXT_TAGS[child.tag])
+    return "".join(parts)
+
+def _docx_paragraph_text(p):
+    """Paragraph.text: runs и runs внутри гиперссылок."""
+    parts = []
+    for child in p:
+        if child.tag == _W_R: parts.append(_docx_run_text(child))
+        elif child.tag == _W_HYPERLINK: parts.extend(_docx_run_text(r) for r in child if r.tag == _W_R)
+    return "".join(parts)
+
+def _docx_run_is_bold(run):
+    rpr = run.find(_W_RPR)
+    b = rpr.find(_W_B) if rpr is not None else None
+    return b is not None and b.get(_W_VAL, "true") in _ONOFF_TRUE
+
+def _docx_measure_is_nonzero(value):
+    """Как bool(ST_SignedTwipsMeasure) в python-docx: 0.4 twip округляется до 0."""
+    try:
+        if any(unit in value for unit in "imp"): return float(re.sub(r'[a-z]+$', '', value)) != 0
+        return int(round(float(value))) != 0
+    except ValueError: return False
+
+
+def _read_docx_styles(docx_zip, styles_path):
+    """styleId -> имя в нижнем регистре (только стили абзацев) и имя стиля абзаца по умолчанию."""
+    try: styles_xml = docx_zip.read(styles_path)
+    except KeyError: return {}, "normal" # Без styles.xml python-docx берет свой шаблон, где по умолчанию Normal
+    styles, default_name = {}, None
+    for _, style in etree.iterparse(io.BytesIO(styles_xml), events=("end",), tag=_W + "style"):
+        if style.get(_W_TYPE, "paragraph") == "paragraph":
+            name_el = style.find(_W + "name")
+            name = (name_el.get(_W_VAL) or "").lower() if name_el is not None else ""
+            style_id = style.get(_W + "styleId")
+            if style_id is not None and style_id not in styles: styles[style_id] = name
+            if style.get(_W + "default") in _ONOFF_TRUE: default_name = name # Последний default по порядку, как в python-docx
+        style.clear()
+    return styles, default_name or ""
+
+
+def _read_docx_relationships(docx_zip, rels_path, base_dir):
+    """rId -> (Target как в файле, путь части в архиве или None для внешних ссылок)."""
+    relationships = {}
+    try: rels_xml = docx_zip.read(rels_path)
+    except KeyError: return relationships
+    for rel in etree.fromstring(rels_xml).iter(_RELS_NS + "Relationship"):
+        target = rel.get("Target") or ""
+        if rel.get("TargetMode") == "External": part_path = None
+        elif target.startswith("/"): part_path = target.lstrip("/")
+        else: part_path = posixpath.normpath(posixpath.join(base_dir, target))
+        relationships[rel.get("Id")] = (target, part_path)
+    return relationships
+
+
+def _docx_main_document_path(docx_zip):
+    try:
+        root = etree.fromstring(docx_zip.read("_rels/.rels"))
+        for rel in root.iter(_RELS_NS + "Relationship"):
+            if rel.get("Type", "").endswith("/officeDocument"): return rel.get("Target", "").lstrip("/")
+    except KeyError: pass
+    return "word/document.xml"
+
+
+def read_docx_with_images(filepath, temp_dir, image_map, image_store=None):
+    """Reads DOCX, extracts text, replaces images with placeholders, saves images.
+
+    word/document.xml читается потоково (iterparse): каждый абзац/таблица верхнего уровня
+    обрабатывается один раз и сразу очищается, так что память не растет с длиной рукописи.
+    image_store - общее хранилище задачи (ImageStore); без него изображения сохраняются в temp_dir.
+    """
+    if not LXML_AVAILABLE: raise ImportError("lxml library is required.")
+    if not os.path.exists(filepath): raise FileNotFoundError(f"DOCX file not found: {filepath}")
+    if image_store is None: image_store = ImageStore(temp_dir)
+
+    output_lines = []
+    with zipfile.ZipFile(filepath) as docx_zip:
+        document_path = _docx_main_document_path(docx_zip)
+        document_dir = posixpath.dirname(document_path)
+        rels_path = posixpath.join(document_dir, "_rels", posixpath.basename(document_path) + ".rels")
+        doc_rels = _read_docx_relationships(docx_zip, rels_path, document_dir)
+        style_rel = next((part_path for target, part_path in doc_rels.values() if part_path and part_path.endswith("styles.xml")), None)
+        style_names, default_style_name = _read_docx_styles(docx_zip, style_rel or posixpath.join(document_dir, "styles.xml"))
+        processed_image_rids = set()
+        processed_rid_to_uuid = {}
+
+        # EMF/TIFF/WebP документа уходят в пул конвертации сразу, пока ниже разбирается текст
+        for target, part_path in doc_rels.values():
+            if part_path and "image" in target and target.rsplit('.', 1)[-1].lower() in _CONVERTIBLE_DOCX_EXTS:
+                try: image_store.prefetch(docx_zip.read(part_path), ext_hint=target.rsplit('.', 1)[-1].lower())
+                except Exception: pass # Ошибки этой части всплывут при обработке рисунка ниже
+
+        def image_placeholder_for(rId, inline):
+            """Плейсхолдер для рисунка rId; None - рисунок пропущен, False - не изображение (берется текст run)."""
+            target, part_path = doc_rels[rId]
+            if rId in processed_image_rids: # Image already processed (e.g., copy-pasted image)
+                if rId in processed_rid_to_uuid: return create_image_placeholder(processed_rid_to_uuid[rId])
+                print(f"[WARN] DOCX: rId {rId} processed but not in UUID map."); return False
+            if part_path is None: raise ValueError("target_part property on _Relationship is undefined when target mode is External")
+            img_data = docx_zip.read(part_path)
+            original_filename = posixpath.basename(part_path)
+            img_ext_original = os.path.splitext(original_filename)[-1].lower().strip('.')
+            img_uuid = image_store.add(img_data, original_filename, ext_hint=img_ext_original or "png")
+            if img_uuid is None: return None # EMF не сконвертирован - пропускаем
+
+            width, height = None, None
+            try:
+                extent = next(inline.iter(_WP_EXTENT), None)
+                if extent is not None:
+                    emu_per_px = 9525 # Approx conversion factor
+                    width = int(extent.get('cx')) // emu_per_px
+                    height = int(extent.get('cy')) // emu_per_px
+            except Exception: pass # Ignore errors getting dimensions
+
+            image_map[img_uuid] = image_store.image_map_entry(img_uuid, original_filename, width=width, height=height)
+            processed_image_rids.add(rId); processed_rid_to_uuid[rId] = img_uuid
+            return create_image_placeholder(img_uuid)
+
+        def process_paragraph(p):
+            runs = [child for child in p if child.tag == _W_R]
+            para_text_parts = []
+            contains_image = False
+            for run in runs:
+                drawings = list(run.iter(_W_DRAWING))
+                if not drawings: para_text_parts.append(_docx_run_text(run)); continue # No drawing element in run
+                for drawing in drawings:
+                    inlines = list(drawing.iter(_WP_INLINE, _WP_ANCHOR))
+                    if not inlines: para_text_parts.append(_docx_run_text(run)); continue # No inline/anchor element
+                    for inline in inlines:
+                        blip = next(inline.iter(_A_BLIP), None)
+                        rId = blip.get(_R_EMBED) if blip is not None else None
+                        if blip is None or not (rId and rId in doc_rels and "image" in doc_rels[rId][0]):
+                            para_text_parts.append(_docx_run_text(run)); continue # No blip / not an image relationship
+                        try:
+                            placeholder = image_placeholder_for(rId, inline)
+                        except Exception as e:
+                            print(f"[WARN] DOCX: Error processing image rId {rId}: {e}"); para_text_parts.append(_docx_run_text(run)); continue
+                        if placeholder is None: continue
+                        if placeholder is False: para_text_parts.append(_docx_run_text(run)); continue
+                        para_text_parts.append(placeholder); contains_image = True
+
+            full_para_text = "".join(para_text_parts).strip()
+            ppr = p.find(_W_PPR)
+            pstyle = ppr.find(_W_PSTYLE) if ppr is not None else None
+            style_id = pstyle.get(_W_VAL) if pstyle is not None else None
+            style_name = style_names.get(style_id, default_style_name) if style_id is not None else default_style_name
+
+            if style_name.startswith('heading 1') or (style_name == 'normal' and DOCX_BOLD_CHAPTER_PATTERN.match(full_para_text)
+                                                       and all(_docx_run_is_bold(r) for r in runs if _docx_run_text(r).strip())):
+                output_lines.append(f"# {full_para_text}")
+            elif style_name.startswith('heading 2'):
+                output_lines.append(f"## {full_para_text}")
+            elif style_name.startswith('heading 3'):
+                output_lines.append(f"### {full_para_text}")
+            elif not full_para_text.strip() and not contains_image:
+                if output_lines and output_lines[-1] != "": output_lines.append("")
+            else:
+                ind = ppr.find(_W_IND) if ppr is not None else None
+                left_indent = ind is not None and ind.get(_W_LEFT) is not None and _docx_measure_is_nonzero(ind.get(_W_LEFT))
+                if style_name.startswith('list paragraph') or (left_indent and full_para_text):
+                    list_marker = "*" # Default marker
+                    para_text = _docx_paragraph_text(p)
+                    num_match = DOCX_NUM_MARKER_PATTERN.match(para_text)
+                    bullet_match = DOCX_BULLET_MARKER_PATTERN.match(para_text)
+                    if num_match: list_marker = num_match.group(1)
+                    elif bullet_match: list_marker = bullet_match.group(1)
+                    output_lines.append(f"{list_marker} {DOCX_LIST_MARKER_STRIP_PATTERN.sub('', full_para_text, count=1)}")
+                elif full_para_text or contains_image:
+                    output_lines.append(full_para_text)
+
+        with docx_zip.open(document_path) as document_stream:
+            for _, element in etree.iterparse(document_stream, events=("end",), tag=(_W_P, _W_TBL)):
+                body = element.getparent()
+                if body is None or body.tag != _W_BODY: continue # Абзацы таблиц/надписей очищаются вместе с родителем
+                if element.tag == _W_P:
+                    process_paragraph(element)
+                else:
+                    if output_lines and output_lines[-1]: output_lines.append("")
+                    output_lines.append("[--- ТАБЛИЦА (не обработано) ---]")
+                    output_lines.append("")
+                element.clear(keep_tail=True)
+                while element.getprevious() is not None: del body[0] # Уже обработанные элементы тела
+
+    final_parts = []
+    for i, line in enumerate(output_lines):
+        final_parts.append(line)
+
+        if i < len(output_lines) - 1:
+             final_parts.append("\n")
+             next_line = output_lines[i+1]
+
+             if (next_line != "" and line != "" and # Both lines have content
+                 not line.startswith('#') and not DOCX_LIST_LINE_PATTERN.match(line) and # Not headings or lists
+                 "[--- ТАБЛИЦА" not in line and "[--- ТАБЛИЦА" not in next_line and # Not tables
+                 not (IMAGE_PLACEHOLDER_PREFIX in line and IMAGE_PLACEHOLDER_PREFIX in next_line)): # Not two image lines together
+                     final_parts.append("\n")
+
+    print(f"[INFO] DOCX Read: Extracted {len(image_map)} images.")
+    return "".join(final_parts).strip()
+
+
+def process_html_images(html_content, source_context, temp_dir, image_map, image_store=None):
+    """
+    Parses HTML, extracts images, replaces with placeholders, converts Hx/title to Markdown-like,
+    and then extracts text content for translation.
+    `source_context` can be a tuple (zipfile.ZipFile, html_path_in_zip) or a base directory path.
+    `image_store` - общее хранилище задачи (ImageStore); без него изображения сохраняются в temp_dir.
+    """
+    if not BS4_AVAILABLE: raise ImportError("BeautifulSoup4 is required for HTML processing.")
+    if image_store is None: image_store = ImageStore(temp_dir)
+
+    if "<svg" in html_content.lower() or "xmlns:" in html_content.lower() or \
+       html_content.strip().startswith("<?xml"):
+        parser_type = 'lxml-xml'
+    else:
+        parser_type = 'lxml'
+
+    try:
+        soup = bs4.BeautifulSoup(html_content, parser_type)
+    except Exception as e_parse:
+        print(f"DEBUG process_html_images: Parse failed with '{parser_type}': {e_parse}. Trying 'html.parser'.")
+        try:
+            soup = bs4.BeautifulSoup(html_content, 'html.parser')
+        except Exception as e_parse_fallback:
+            print(f"[ERROR] BeautifulSoup failed to parse HTML content with primary parser '{parser_type}' and fallback 'html.parser'. Error: {e_parse_fallback}")
+            raise ValueError(f"Failed to parse HTML content after trying multiple parsers: {e_parse_fallback}")
+
+    zip_file_obj = None
+    source_html_path = None
+    base_path = ""
+    if isinstance(source_context, tuple) and len(source_context) == 2 and isinstance(source_context[0], zipfile.ZipFile):
+         zip_file_obj = source_context[0]
+         source_html_path = source_context[1]
+         if source_html_path:
+             base_path = os.path.dirname(source_html_path).replace('\\', '/')
+             if base_path == '.': base_path = ""
+    elif isinstance(source_context, str) and os.path.isdir(source_context):
+        base_path = source_context
+        source_html_path = "unknown.html"
+        zip_file_obj = None
+    else:
+        zip_file_obj = None
+        base_path = ""
+        source_html_path = "unknown.html"
+
+    image_processing_context = zip_file_obj if zip_file_obj else base_path
+    
+    # --- Image Processing ---
+    for tag in soup.find_all(['img', 'svg']):
+        if not tag.parent: continue
+        img_uuid = None
+        tag_name = tag.name.lower()
+        
+        try:
+            if tag_name == 'img':
+                img_uuid = _process_single_image(tag, image_processing_context, base_path, source_html_path, image_store, image_map, is_svg_image=False)
+                tag.replace_with(bs4.NavigableString(create_image_placeholder(img_uuid)) if img_uuid else "")
+            elif tag_name == 'svg':
+                svg_image_tag = tag.find(lambda t: t.name.lower() == 'image', recursive=False)
+                if svg_image_tag:
+                    img_uuid = _process_single_image(svg_image_tag, image_processing_context, base_path, source_html_path, image_store, image_map, is_svg_image=True)
+                tag.replace_with(bs4.NavigableString(create_image_placeholder(img_uuid)) if img_uuid else "")
+        except Exception as e:
+            print(f"[ERROR] process_html_images: Error replacing tag <{tag_name}>: {e}")
+            try: tag.replace_with("")
+            except Exception as remove_err: print(f"[ERROR] Failed to remove tag after error: {remove_err}")
+            
+    # --- НАЧАЛО БЛОКА НОРМАЛИЗАЦИИ HTML (НОВЫЙ БЛОК) ---
+    # Преобразуем стилизованные span в семантические теги em/strong
+    for span in soup.find_all('span', style=True):
+        style = span['style'].lower()
+        if 'font-style' in style and 'italic' in style:
+            span.name = 'em'
+            del span['style'] # Удаляем атрибут style после преобразования
+        elif 'font-weight' in style and ('bold' in style or any(w.strip() in ['700', '800', '900'] for w in style.split('font-weight:')[1].split(';')[0].split())):
+            span.name = 'strong'
+            del span['style']
+
+    # Объединяем последовательные теги em и strong
+    for tag_name in ['em', 'strong']:
+        for tag in soup.find_all(tag_name):
+            next_sibling = tag.next_sibling
+            while next_sibling and isinstance(next_sibling, bs4.NavigableString) and not next_sibling.strip():
+                next_sibling = next_sibling.next_sibling # Пропускаем пустые строки
+            if next_sibling and next_sibling.name == tag.name:
+                # Если у следующего тега есть атрибуты, отличные от текущего, не объединяем
+                if next_sibling.attrs == tag.attrs:
+                    tag.append(next_sibling.decode_contents())
+                    next_sibling.decompose()
+
+    # Заменяем структурные div на p, чтобы они обрабатывались как абзацы
+    # и "разворачиваем" (unwrap) вложенные div и span, которые не несут форматирования
+    tags_to_process = soup.find_all(['div', 'span'])
+    for tag in tags_to_process:
+        # Если это div, который выглядит как контейнер для абзаца, меняем его на p
+        if tag.name == 'div':
+            tag.name = 'p'
+            # Удаляем атрибуты, не относящиеся к p
+            for attr in list(tag.attrs.keys()):
+                if attr.lower() not in ['class', 'id']:
+                     del tag[attr]
+        # Если это span без атрибутов, он, скорее всего, для разбиения текста - убираем его
+        elif tag.name == 'span' and not tag.attrs:
+            tag.unwrap()
+    # --- КОНЕЦ БЛОКА НОРМАЛИЗАЦИИ HTML ---
+
+
+    # --- Header and Content Extraction ---
+    html_doctitle_text = None
+    if soup.head and soup.head.title and soup.head.title.string:
+        title_candidate = soup.head.title.string.strip()
+        generic_titles = ['untitled', 'unknown', 'navigation', 'toc', 'table of contents', 'index', 'contents', 'оглавление', 'содержание', 'индекс', 'cover', 'title page', 'copyright', 'chapter']
+        if title_candidate and title_candidate.lower() not in generic_titles and len(title_candidate) > 2:
+            html_doctitle_text = title_candidate
+
+    content_extraction_root = soup.body if soup.body else soup
+    if not content_extraction_root:
+        print("[WARN] process_html_images: No <body> or root element found.")
+        return ""
+
+    # --- CORRECTED HEADER PROCESSING LOGIC ---
+    for level in range(6, 0, -1):
+        for header_tag in content_extraction_root.find_all(f'h{level}'):
+            # Сначала преобразуем em/strong внутри заголовка в Markdown
+            for em_tag in header_tag.find_all('em'):
+                em_tag.replace_with(f"*{em_tag.get_text(strip=True)}*")
+            for strong_tag in header_tag.find_all('strong'):
+                strong_tag.replace_with(f"**{strong_tag.get_text(strip=True)}**")
+            
+            header_text = header_tag.get_text(separator=' ', strip=True)
+            if header_text:
+                markdown_header_line = f"\n\n{'#' * level} {header_text}\n\n"
+                header_tag.replace_with(bs4.NavigableString(markdown_header_line))
+
+    # Decompose unwanted tags after processing headers and normalization
+    tags_to_decompose = ['script', 'style', 'noscript', 'head', 'meta', 'link', 'form', 'iframe', 'header', 'footer', 'nav', 'aside']
+    for tag_type in tags_to_decompose:
+        for instance in content_extraction_root.find_all(tag_type):
+            instance.decompose()
+            
+    # --- ИЗМЕНЕННАЯ ЛОГИКА ИЗВЛЕЧЕНИЯ ТЕКСТА ---
+    # Преобразуем оставшиеся em/strong в Markdown перед финальным извлечением текста
+    for em_tag in content_extraction_root.find_all('em'):
+        em_tag.replace_with(f"*{em_tag.get_text(strip=True)}*")
+    for strong_tag in content_extraction_root.find_all('strong'):
+        strong_tag.replace_with(f"**{strong_tag.get_text(strip=True)}**")
+    
+    # Заменяем <br> и </p> на переносы строк для корректного разделения
+    for br in content_extraction_root.find_all("br"):
+        br.replace_with("\n")
+    for p_tag in content_extraction_root.find_all("p"):
+        p_tag.append("\n\n")
+
+    # Get all text from the modified body
+    body_text_md = content_extraction_root.get_text(separator='', strip=False) # Используем separator='', чтобы не добавлять лишних разделителей
+
+    # Final logic to assemble text for API
+    final_text_for_api = body_text_md
+    if html_doctitle_text and not body_text_md.lstrip().startswith('#'):
+        final_text_for_api = f"# {html_doctitle_text}\n\n{body_text_md}"
+
+    # Clean up excessive newlines and spaces
+    final_text_for_api = re.sub(r' +', ' ', final_text_for_api) # Сжимаем множественные пробелы
+    final_text_for_api = re.sub(r'\n{3,}', '\n\n', final_text_for_api) # Сжимаем множественные переносы
+    
+    return final_text_for_api.strip()
+
+
+def _register_stored_image(image_store, image_map, img_uuid, original_filename, original_src_value, attributes):
+    """Добавляет в image_map запись для изображения из image_store; None - изображение пропущено."""
+    if img_uuid is None: return None
+    image_map[img_uuid] = image_store.image_map_entry(
+        img_uuid, original_filename,
+        original_src=original_src_value, # Still store original_src for consistency if needed
+        attributes=attributes) # Store original attributes
+    return img_uuid
+
+
+def _process_single_image(img_tag, source_context, base_path, source_html_path, image_store, image_map, is_svg_image=False):
+    """
+    Processes individual image tag.
+    For EPUB->EPUB: Extracts original src and attributes, stores them in image_map with a UUID. Does NOT save file.
+    For other modes: Extracts image data once per source/content into image_store; the UUID is the content hash.
+    """
+    src = None
+    xlink_namespace_uri = "http://www.w3.org/1999/xlink"
+
+
+    is_epub_rebuild_mode = isinstance(source_context, zipfile.ZipFile) # True if processing for EPUB->EPUB
+
+    if is_svg_image:
+        src = img_tag.get(f'{{{xlink_namespace_uri}}}href')
+        if not src:
+            attrs_dict = img_tag.attrs
+            if 'xlink:href' in attrs_dict: src = attrs_dict['xlink:href']
+            elif 'href' in attrs_dict: src = attrs_dict['href']
+            else:
+                namespaced_key = (xlink_namespace_uri, 'href')
+                if namespaced_key in attrs_dict: src = attrs_dict[namespaced_key]
+
+    else: # HTML <img> tag
+        src = img_tag.get('src', '')
+
+
+    if not src or src.startswith('data:'):
+
+        return None
+
+    original_src_value = src # This is the raw value from the attribute, e.g., "../Images/0004.png"
+    original_tag_name = img_tag.name # 'img' or 'image' (from svg)
+    all_original_attributes = dict(img_tag.attrs) # Store all attributes
+
+    if is_epub_rebuild_mode:
+
+        img_uuid = uuid.uuid4().hex # Атрибуты у каждого вхождения свои
+        image_map[img_uuid] = {
+            'original_src': original_src_value,
+            'original_tag_name': original_tag_name, # 'img' or 'image'
+            'is_svg_image_child': is_svg_image, # True if it was <image> inside <svg>
+            'attributes': all_original_attributes # Store all original attributes
+        }
+
+        return img_uuid
+    else:
+
+        img_data = None
+        decoded_src = unquote(src)
+        original_filename = os.path.basename(urlparse(decoded_src).path)
+        if not original_filename:
+            src_parts = decoded_src.split('/')
+            potential_fname = src_parts[-1] if src_parts else "image"
+            potential_fname = potential_fname.split('?')[0]
+            safe_fname_part = re.sub(r'[^\w\.\-]+', '_', potential_fname)
+            _, ext_guess = os.path.splitext(safe_fname_part)
+            fallback_ext = "png"
+            if ext_guess and ext_guess[1:].lower() in ['jpg', 'jpeg', 'gif', 'webp', 'bmp', 'tiff', 'svg']:
+                original_filename = safe_fname_part
+            else:
+                original_filename = f"{Path(safe_fname_part).stem}.{fallback_ext}"
+
+        try:
+            if isinstance(source_context, zipfile.ZipFile): # EPUB source -> non-EPUB output
+
+                source_key = (source_context.filename, base_path, decoded_src)
+                known, img_uuid = image_store.lookup_source(source_key)
+                if known: return _register_stored_image(image_store, image_map, img_uuid, original_filename, original_src_value, all_original_attributes)
+                possible_paths = []
+                current_html_dir = base_path
+                path1 = os.path.join(current_html_dir, decoded_src)
+                path1_norm = os.path.normpath(path1).replace('\\', '/')
+                if not path1_norm.startswith('..'): possible_paths.append(path1_norm.lstrip('/'))
+                path2_norm = os.path.normpath(decoded_src.lstrip('/')) .replace('\\', '/')
+                if not path2_norm.startswith('..'): possible_paths.append(path2_norm)
+
+                unique_paths = list(dict.fromkeys(p.strip('/') for p in possible_paths if p.strip('/')))
+
+                for img_path_in_zip in unique_paths:
+                    try:
+                        img_data = source_context.read(img_path_in_zip)
+
+                        break
+                    except KeyError: continue
+                if not img_data:
+                    print(f"[WARN] HTML Image NOT Found (EPUB src -> File Output): src='{src}'. Tried: {unique_paths}.")
+                    return None
+
+            elif isinstance(source_context, str) and os.path.isdir(source_context): # Directory context
+
+                paths_to_try_fs = [
+                    os.path.normpath(os.path.join(base_path, decoded_src)),
+                    os.path.normpath(os.path.join(source_context, decoded_src.lstrip('/\\')))
+                ]
+                if not decoded_src.startswith(('/', '\\')):
+                    path3_fs = os.path.normpath(os.path.join(source_context, decoded_src))
+                    if path3_fs not in paths_to_try_fs: paths_to_try_fs.append(path3_fs)
+                abs_path = next((p for p in paths_to_try_fs if os.path.exists(p)), None)
+                if not abs_path:
+                    print(f"[WARN] HTML Image (FS Mode): Could not find '{decoded_src}'. Tried: {paths_to_try_fs}")
+                    return None
+                source_key = (abs_path,)
+                known, img_uuid = image_store.lookup_source(source_key)
+                if known: return _register_stored_image(image_store, image_map, img_uuid, original_filename, original_src_value, all_original_attributes)
+                with open(abs_path, 'rb') as f: img_data = f.read()
+            else:
+                print(f"[WARN] HTML Image: Unknown source context for file mode: {type(source_context)}")
+                return None
+
+            img_ext_from_file = os.path.splitext(original_filename)[1][1:].lower()
+            img_uuid = image_store.add(img_data, original_filename, ext_hint=img_ext_from_file or 'jpeg', source_key=source_key)
+            return _register_stored_image(image_store, image_map, img_uuid, original_filename, original_src_value, all_original_attributes)
+
+        except Exception as e:
+            print(f"[ERROR] HTML Image (File Mode): Error processing src '{src}': {e}")
+            traceback.print_exc()
+            return None
@@ -0,0 +1,234 @@
+# --- START OF FILE transgemini_core/session.py ---
+
+import os
+import json
+import time
+import zipfile
+
+from .config import DEFAULT_MODEL_NAME
+from .utils import extract_number_from_path
+
+
+class TranslationSessionManager:
+    """Менеджер сессии перевода для отслеживания прогресса между перезапусками."""
+    def __init__(self, session_file_path):
+        self.session_file_path = session_file_path
+        self.session_data = {
+            'original_file': None,
+            'output_folder': None,
+            'total_files': 0,
+            'completed_files': [],
+            'failed_files': [],
+            'content_filtered_files': [],  # Отдельный список для заблокированных фильтрами
+            'current_key_index': 0,
+            'api_keys': [],
+            'model': DEFAULT_MODEL_NAME,
+            'concurrent_requests': 10,
+            'glossary_dict': {},
+            'glossary_path': None,  # Для обратной совместимости
+            'file_type': None,
+            'epub_html_files': []
+        }
+        
+    def init_new_session(self, settings):
+        """Инициализирует новую сессию с начальными настройками"""
+        self.session_data['original_file'] = settings['file_path']
+        self.session_data['output_folder'] = settings['output_folder']
+        self.session_data['api_keys'] = settings['api_keys']
+        self.session_data['current_key_index'] = 0
+        self.session_data['model'] = settings['model']
+        self.session_data['concurrent_requests'] = settings['concurrent_requests']
+    
+        # Сохраняем ВСЕ настройки
+        if 'glossary_dict' in settings:
+            self.session_data['glossary_dict'] = settings['glossary_dict']
+        elif 'glossary_path' in settings:
+            self.session_data['glossary_path'] = settings['glossary_path']
+    
+        # Сохраняем дополнительные настройки
+        if 'dynamic_glossary' in settings:
+            self.session_data['dynamic_glossary'] = settings['dynamic_glossary']
+        if 'custom_prompt' in settings:
+            self.session_data['custom_prompt'] = settings['custom_prompt']
+        
+        self.session_data['completed_files'] = []
+        self.session_data['failed_files'] = []
+        self.session_data['content_filtered_files'] = []
+    
+        # Определяем тип файла и список для обработки
+        file_ext = os.path.splitext(settings['file_path'])[1].lower()
+        self.session_data['file_type'] = file_ext[1:]  # без точки
+    
+        if file_ext == '.epub':
+            # Для EPUB нужно получить список HTML файлов
+            html_files = self._get_epub_html_files(settings['file_path'])
+            self.session_data['epub_html_files'] = html_files
+            self.session_data['total_files'] = len(html_files)
+        else:
+            self.session_data['total_files'] = 1
+        
+        self.save_session()
+        
+    def _get_epub_html_files(self, epub_path):
+        """Извлекает список HTML файлов из EPUB."""
+        html_files = []
+        try:
+            with zipfile.ZipFile(epub_path, 'r') as epub_zip:
+                for name in epub_zip.namelist():
+                    if name.endswith(('.html', '.xhtml', '.htm')) and not name.startswith('META-INF/'):
+                        html_files.append(name)
+            return sorted(html_files, key=extract_number_from_path)
+        except Exception as e:
+            print(f"Ошибка чтения EPUB: {e}")
+            return []
+            
+    def save_session(self):
+        """Сохраняет текущее состояние сессии."""
+        try:
+            with open(self.session_file_path, 'w', encoding='utf-8') as f:
+                json.dump(self.session_data, f, ensure_ascii=False, indent=2)
+            return True
+        except Exception as e:
+            print(f"Ошибка сохранения сессии: {e}")
+            return False
+            
+    def load_session(self):
+        """Загружает сохраненную сессию."""
+        try:
+            if os.path.exists(self.session_file_path):
+                with open(self.session_file_path, 'r', encoding='utf-8') as f:
+                    loaded_data = json.load(f)
+                    self.session_data.update(loaded_data)
+                return True
+            return False
+        except Exception as e:
+            print(f"Ошибка загрузки сессии: {e}")
+            return False
+        
+    def mark_file_completed(self, file_tuple):
+        """Отмечает файл как успешно обработанный."""
+        if file_tuple not in self.session_data['completed_files']:
+            self.session_data['completed_files'].append(file_tuple)
+            self.save_session()
+            
+    def mark_file_failed(self, file_tuple, error_msg):
+        """Отмечает файл как неудачно обработанный."""
+        self.session_data['failed_files'].append({
+            'file': file_tuple,
+            'error': error_msg,
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S')
+        })
+        self.save_session()
+        
+    def mark_file_content_filtered(self, file_tuple, error_msg):
+        """Отмечает файл как заблокированный фильтрами контента"""
+        # Проверяем, не добавлен ли уже
+        if not any(f['file'] == file_tuple for f in self.session_data['content_filtered_files']):
+            self.session_data['content_filtered_files'].append({
+                'file': file_tuple,
+                'error': error_msg,
+                'timestamp': time.strftime('%Y-%m-%d %H:%M:%S')
+            })
+            self.save_session()
+            
+    def is_content_filtered(self, file_tuple):
+        """Проверяет, была ли глава заблокирована фильтрами"""
+        return any(f['file'] == file_tuple for f in self.session_data['content_filtered_files'])
+        
+    def get_pending_files(self):
+        """Возвращает список файлов для обработки (еще не завершенных и не заблокированных)"""
+        if self.session_data['file_type'] == 'epub':
+            pending = []
+            for html_file in self.session_data['epub_html_files']:
+                file_tuple = ('epub', self.session_data['original_file'], html_file)
+            
+                # Пропускаем уже успешно обработанные
+                if file_tuple in self.session_data['completed_files']:
+                    continue
+                
+                # Пропускаем заблокированные фильтрами
+                if self.is_content_filtered(file_tuple):
+                    continue
+                
+                # === НОВОЕ: Пропускаем главы с техническими ошибками (500/503) ===
+                # Они НЕ должны повторяться при смене ключа
+                is_technical_error = False
+                for failed_entry in self.session_data['failed_files']:
+                    if failed_entry.get('file') == file_tuple:
+                        error = failed_entry.get('error', '').lower()
+                        if '500' in error or '503' in error or 'internal server error' in error:
+                            is_technical_error = True
+                            break
+                        
+                if is_technical_error:
+                    continue
+                
+                # Добавляем в список для обработки
+                pending.append(file_tuple)
+            
+            return pending
+        else:
+            file_type = self.session_data['file_type']
+            file_tuple = (file_type, self.session_data['original_file'], None)
+        
+            if file_tuple in self.session_data['completed_files']:
+                return []
+            if self.is_content_filtered(file_tuple):
+                return []
+            
+            # Проверяем на технические ошибки
+            for failed_entry in self.session_data['failed_files']:
+                if failed_entry.get('file') == file_tuple:
+                    error = failed_entry.get('error', '').lower()
+                    if '500' in error or '503' in error or 'internal server error' in error:
+                        return []
+                    
+            return [file_tuple]
+            
+    def is_rate_limited(self, error_msg):
+        """Проверяет, является ли ошибка превышением лимита запросов."""
+        rate_limit_indicators = [
+            '429',
+            'rate limit',
+            'ResourceExhausted',
+            'too many requests'
+        ]
+        # НЕ включаем 'quota exceeded' и 'exceeded your current quota' сюда
+        # так как это отдельный случай - полное исчерпание квоты
+        error_lower = str(error_msg).lower()
+        return any(indicator in error_lower for indicator in rate_limit_indicators) and \
+               'exceeded your current quota' not in error_lower and \
+               'quota exceeded' not in error_lower
+
+    def is_quota_exceeded(self, error_msg):
+        """Проверяет, превышена ли квота API ключа полностью"""
+        quota_indicators = [
+            'exceeded your current quota',
+            'quota exceeded',
+            'out of quota'
+        ]
+        error_lower = str(error_msg).lower()
+        return any(indicator in error_lower for indicator in quota_indicators)
+        
+    def is_content_filter_error(self, error_msg):
+        """Проверяет, является ли ошибка блокировкой контента"""
+        content_filter_indicators = [
+            'PROHIBITED_CONTENT',
+            'block_reason',
+            'content filter',
+            'blocked prompt',
+            'safety',
+            'harmful',
+            'inappropriate',
+            'BlockedPromptException',
+            'StopCandidateException'
+        ]
+        error_lower = str(error_msg).lower()
+        return any(indicator.lower() in error_lower for indicator in content_filter_indicators)
+        
+    def get_progress(self):
+        """Возвращает текущий прогресс."""
+        completed = len(self.session_data['completed_files'])
+        filtered = len(self.session_data['content_filtered_files'])
+        total = self.session_data['total_files']
+        return completed, filtered, total
@@ -0,0 +1,32 @@
+# --- START OF FILE transgemini_core/signals.py ---
+
+import threading
+
+
+class Signal:
+    """Простая замена pyqtSignal для ядра без Qt: connect/disconnect/emit.
+
+    Слоты вызываются синхронно в потоке, который вызвал emit(). В GUI сигналы ядра
+    пересылаются в настоящие pyqtSignal (см. Worker в TransGemini.py), а Qt уже
+    доставляет их в главный поток.
+    """
+    def __init__(self):
+        self._slots = []
+        self._lock = threading.Lock()
+
+    def connect(self, slot):
+        with self._lock:
+            self._slots.append(slot)
+
+    def disconnect(self, slot=None):
+        with self._lock:
+            if slot is None:
+                self._slots.clear()
+            elif slot in self._slots:
+                self._slots.remove(slot)
+
+    def emit(self, *args):
+        with self._lock:
+            slots = list(self._slots)
+        for slot in slots:
+            slot(*args)
@@ -0,0 +1,155 @@
+# --- START OF FILE transgemini_core/utils.py ---
+
+import os
+import re
+import math
+from io import BytesIO
+from pathlib import Path
+
+from .deps import PILLOW_AVAILABLE, Image
+
+
+TRANSLATED_SUFFIX = "_translated"
+
+def add_translated_suffix(filename):
+    """Adds _translated before the file extension, handling multiple suffixes."""
+    if not filename: return filename
+    path = Path(filename)
+
+    suffixes = "".join(path.suffixes)
+    if not suffixes: # Handle case with no extension (e.g., just "myfile")
+        stem = path.name
+
+        return str(path.parent / f"{stem}{TRANSLATED_SUFFIX}")
+    else:
+
+        stem = path.name.replace(suffixes, "")
+
+        return str(path.parent / f"{stem}{TRANSLATED_SUFFIX}{suffixes}")
+
+def format_size(size_bytes):
+   """Converts bytes to a human-readable format (KB, MB, GB)."""
+   if size_bytes == 0: return "0 B"
+   size_name = ("B", "KB", "MB", "GB", "TB")
+   i = int(math.floor(math.log(size_bytes, 1024))) if size_bytes > 0 else 0
+   i = min(i, len(size_name) - 1)
+   p = math.pow(1024, i)
+   s = round(size_bytes / p, 2)
+   return f"{s} {size_name[i]}"
+
+# Сигнатуры форматов: (смещение, байты, расширение). Проверяются по порядку, хватает первых 64 байт
+IMAGE_MAGIC_SIGNATURES = (
+    (0, b'\x89PNG\r\n\x1a\n', 'png'),
+    (0, b'\xff\xd8\xff', 'jpg'),
+    (0, b'GIF87a', 'gif'),
+    (0, b'GIF89a', 'gif'),
+    (0, b'BM', 'bmp'),
+    (0, b'II*\x00', 'tiff'),
+    (0, b'MM\x00*', 'tiff'),
+    (0, b'\xd7\xcd\xc6\x9a', 'wmf'), # Placeable WMF
+    (0, b'\x01\x00\x09\x00\x00\x03', 'wmf'),
+    (40, b' EMF', 'emf'), # Сигнатура в заголовке EMR_HEADER
+)
+# Форматы, которые читалки/DOCX/FB2 не показывают: перед записью конвертируются в PNG
+CONVERTIBLE_IMAGE_FORMATS = frozenset({'emf', 'wmf', 'tiff', 'webp'})
+
+def detect_image_format(image_data):
+    """Определяет формат по сигнатуре в начале данных; None - формат не распознан."""
+    if not image_data: return None
+    head = bytes(image_data[:64])
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP': return 'webp'
+    for offset, signature, ext in IMAGE_MAGIC_SIGNATURES:
+        if head[offset:offset + len(signature)] == signature: return ext
+    if head.lstrip()[:5] in (b'<?xml', b'<svg ') and b'<svg' in bytes(image_data[:1024]): return 'svg'
+    return None
+
+def get_image_extension_from_data(image_data, fallback_ext="jpeg"):
+    """Determines image extension from binary data."""
+    if not image_data: return fallback_ext
+    ext = detect_image_format(image_data)
+    if ext is None and PILLOW_AVAILABLE: # Редкие форматы - спрашиваем Pillow (дороже сигнатур)
+        try:
+            with Image.open(BytesIO(image_data)) as img:
+                img_format = img.format
+                if img_format:
+                    fmt_lower = img_format.lower()
+                    if fmt_lower == 'jpeg': return 'jpg'
+                    if fmt_lower in ['png', 'gif', 'bmp', 'tiff', 'webp']: return fmt_lower
+        except Exception: pass # Ignore Pillow errors for unknown data
+    return ext if ext else fallback_ext
+
+
+def convert_image_to_png(image_data):
+    """Converts EMF/WMF/TIFF/WebP (any Pillow-readable) image data to PNG bytes; None on failure.
+
+    Функция уровня модуля без внешнего состояния - ее можно выполнять в пуле процессов.
+    """
+    if not PILLOW_AVAILABLE:
+        print("[WARN] Pillow library not found, cannot convert image. Skipping.")
+        return None
+    try:
+
+        with Image.open(BytesIO(image_data)) as img:
+
+            if img.mode == 'CMYK': img = img.convert('RGB')
+            elif img.mode == 'P': img = img.convert('RGBA') # Convert palette to RGBA for transparency
+            elif img.mode == '1': img = img.convert('L') # Convert bilevel to grayscale
+            elif img.mode in ('I;16', 'I;16B', 'I', 'F'): img = img.convert('L') # 16/32-битные TIFF
+
+            png_bytes_io = BytesIO()
+            img.save(png_bytes_io, format='PNG')
+            return png_bytes_io.getvalue()
+    except ImportError: # Might happen if EMF plugin for Pillow is missing
+         print("[ERROR] Failed to convert image: Pillow EMF/WMF support might be missing or incomplete on this system.")
+         return None
+    except Exception as e:
+        print(f"[ERROR] Failed to convert image to PNG: {e}")
+        return None
+
+def recompress_image_file(image_path, max_dimension, jpeg_quality):
+    """Уменьшает изображение до max_dimension по большей стороне и пережимает.
+
+    Непрозрачные изображения сохраняются в JPEG с качеством jpeg_quality, с прозрачностью - в PNG.
+    Возвращает (bytes, 'jpg'|'png') или None, если результат не меньше исходного файла
+    (анимация, ошибка, уже компактное изображение). Выполняется в пуле процессов.
+    """
+    if not PILLOW_AVAILABLE: return None
+    try:
+        original_size = os.path.getsize(image_path)
+        with Image.open(image_path) as img:
+            if getattr(img, 'is_animated', False): return None # Анимированные GIF/WebP не трогаем
+            has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+            if max_dimension and max(img.size) > max_dimension:
+                img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            out = BytesIO()
+            if has_alpha:
+                img.save(out, format='PNG', optimize=True); ext = 'png'
+            else:
+                img.save(out, format='JPEG', quality=jpeg_quality, optimize=True, progressive=True); ext = 'jpg'
+        data = out.getvalue()
+        return (data, ext) if len(data) < original_size else None
+    except Exception as e:
+        print(f"[WARN] Failed to recompress image {image_path}: {e}")
+        return None
+
+def convert_emf_to_png(emf_data):
+    """Converts EMF image data to PNG using Pillow."""
+    return convert_image_to_png(emf_data)
+
+def extract_number_from_path(path):
+    """Извлекает номер из имени файла для сортировки."""
+    filename = os.path.basename(path)
+    match = re.search(
+        r"(?:chapter|part|section|page|item|file|ch|pt|pg|_)(\d+)",
+        filename,
+        re.IGNORECASE,
+    )
+    if not match:
+        match = re.search(r"(\d+)", filename)
+    if match:
+        try:
+            return int(match.group(1))
+        except (ValueError, IndexError):
+            return float("inf")
+    return float("inf")
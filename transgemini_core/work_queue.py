@@ -0,0 +1,426 @@
+# --- START OF FILE transgemini_core/work_queue.py ---
+"""Очереди задач для распределенного режима (см. transgemini_core.distributed).
+
+Задача (элемент) проходит состояния pending -> leased -> done/failed. Воркер берет
+элемент в аренду на lease_seconds и продлевает ее, пока работает; если аренда истекла
+(воркер упал или потерял сеть), элемент возвращается в pending при следующем lease()
+или requeue_expired(), а после max_attempts попыток помечается failed. Завершить или
+продлить элемент можно только с токеном текущей аренды, поэтому результат "воскресшего"
+воркера после повторной выдачи элемента отбрасывается.
+
+Реализации: SQLiteWorkQueue - файл SQLite (один хост, тесты, несколько процессов),
+RedisWorkQueue - Redis и совместимые серверы (Valkey, KeyDB, Dragonfly) для нескольких хостов.
+Входные файлы и результаты передаются через хранилище blob-ов той же очереди.
+"""
+
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import collections
+import contextlib
+
+from .capabilities import MissingDependencyError, get_capabilities
+from .deps import redis
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+LEASE_EXPIRED_ERROR = "Аренда истекла: воркер не завершил задачу"
+
+LeasedItem = collections.namedtuple("LeasedItem", "job_id item_id payload token attempt")
+
+
+class WorkQueue:
+    """Интерфейс очереди. payload, spec и result - JSON-совместимые объекты, blob - bytes."""
+
+    def create_job(self, job_id, spec, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        raise NotImplementedError
+
+    def get_job(self, job_id):
+        """Возвращает spec задания или None."""
+        raise NotImplementedError
+
+    def enqueue(self, job_id, items):
+        """Добавляет элементы [(item_id, payload), ...] в конец очереди."""
+        raise NotImplementedError
+
+    def lease(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Берет следующий элемент в аренду. Возвращает LeasedItem или None, если очередь пуста."""
+        raise NotImplementedError
+
+    def extend(self, item, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Продлевает аренду. False - аренда уже потеряна (истекла и элемент выдан снова)."""
+        raise NotImplementedError
+
+    def complete(self, item, result):
+        """Сохраняет результат. False - аренда потеряна, результат не принят."""
+        raise NotImplementedError
+
+    def fail(self, item, error, retry=True):
+        """Сообщает об ошибке: при retry элемент возвращается в очередь, пока не исчерпаны попытки."""
+        raise NotImplementedError
+
+    def requeue_expired(self):
+        """Возвращает в очередь элементы с истекшей арендой. Возвращает их количество."""
+        raise NotImplementedError
+
+    def job_progress(self, job_id):
+        """Возвращает {'pending': n, 'leased': n, 'done': n, 'failed': n}."""
+        raise NotImplementedError
+
+    def job_results(self, job_id):
+        """Возвращает {item_id: {'state', 'attempts', 'result', 'error'}} в порядке постановки."""
+        raise NotImplementedError
+
+    def put_blob(self, job_id, key, data):
+        raise NotImplementedError
+
+    def get_blob(self, job_id, key):
+        """Возвращает bytes или None."""
+        raise NotImplementedError
+
+    def delete_job(self, job_id):
+        """Удаляет задание, его элементы и blob-ы."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """Очередь в файле SQLite (WAL); каждое изменение состояния - одна транзакция BEGIN IMMEDIATE."""
+
+    def __init__(self, path, timeout=30.0):
+        if path in ("", ":memory:"):
+            raise ValueError("SQLiteWorkQueue требует путь к файлу (соединения открываются в каждом потоке отдельно).")
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, spec TEXT NOT NULL, "
+                         "max_attempts INTEGER NOT NULL, created REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS items (job_id TEXT NOT NULL, item_id TEXT NOT NULL, "
+                         "payload TEXT NOT NULL, state TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                         "lease_token TEXT, lease_expires REAL, worker_id TEXT, result TEXT, error TEXT, "
+                         "PRIMARY KEY (job_id, item_id))")
+            conn.execute("CREATE INDEX IF NOT EXISTS items_state ON items (state, lease_expires)")
+            conn.execute("CREATE TABLE IF NOT EXISTS blobs (job_id TEXT NOT NULL, key TEXT NOT NULL, data BLOB NOT NULL, "
+                         "PRIMARY KEY (job_id, key))")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def create_job(self, job_id, spec, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO jobs (job_id, spec, max_attempts, created) VALUES (?, ?, ?, ?)",
+                         (job_id, json.dumps(spec, ensure_ascii=False), int(max_attempts), time.time()))
+
+    def get_job(self, job_id):
+        row = self._connection().execute("SELECT spec FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def enqueue(self, job_id, items):
+        with self._transaction() as conn:
+            conn.executemany("INSERT INTO items (job_id, item_id, payload) VALUES (?, ?, ?)",
+                             [(job_id, item_id, json.dumps(payload, ensure_ascii=False)) for item_id, payload in items])
+
+    def _requeue_expired(self, conn):
+        now = time.time()
+        failed = conn.execute("UPDATE items SET state = 'failed', error = ?, lease_token = NULL "
+                              "WHERE state = 'leased' AND lease_expires < ? "
+                              "AND attempts >= (SELECT max_attempts FROM jobs WHERE jobs.job_id = items.job_id)",
+                              (LEASE_EXPIRED_ERROR, now)).rowcount
+        requeued = conn.execute("UPDATE items SET state = 'pending', lease_token = NULL "
+                                "WHERE state = 'leased' AND lease_expires < ?", (now,)).rowcount
+        return failed + requeued
+
+    def requeue_expired(self):
+        with self._transaction() as conn:
+            return self._requeue_expired(conn)
+
+    def lease(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        token = uuid.uuid4().hex
+        with self._transaction() as conn:
+            self._requeue_expired(conn)
+            row = conn.execute("SELECT job_id, item_id, payload, attempts FROM items WHERE state = 'pending' "
+                               "ORDER BY rowid LIMIT 1").fetchone()
+            if row is None:
+                return None
+            job_id, item_id, payload, attempts = row
+            conn.execute("UPDATE items SET state = 'leased', attempts = attempts + 1, lease_token = ?, "
+                         "lease_expires = ?, worker_id = ? WHERE job_id = ? AND item_id = ?",
+                         (token, time.time() + lease_seconds, worker_id, job_id, item_id))
+        return LeasedItem(job_id, item_id, json.loads(payload), token, attempts + 1)
+
+    def extend(self, item, lease_seconds=DEFAULT_LEASE_SECONDS):
+        with self._transaction() as conn:
+            return conn.execute("UPDATE items SET lease_expires = ? WHERE job_id = ? AND item_id = ? "
+                                "AND state = 'leased' AND lease_token = ?",
+                                (time.time() + lease_seconds, item.job_id, item.item_id, item.token)).rowcount == 1
+
+    def complete(self, item, result):
+        with self._transaction() as conn:
+            return conn.execute("UPDATE items SET state = 'done', result = ?, error = NULL, lease_token = NULL "
+                                "WHERE job_id = ? AND item_id = ? AND state = 'leased' AND lease_token = ?",
+                                (json.dumps(result, ensure_ascii=False), item.job_id, item.item_id, item.token)).rowcount == 1
+
+    def fail(self, item, error, retry=True):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT items.attempts, jobs.max_attempts FROM items JOIN jobs USING (job_id) "
+                               "WHERE items.job_id = ? AND items.item_id = ? AND items.state = 'leased' AND items.lease_token = ?",
+                               (item.job_id, item.item_id, item.token)).fetchone()
+            if row is None:
+                return False
+            attempts, max_attempts = row
+            state = "pending" if retry and attempts < max_attempts else "failed"
+            conn.execute("UPDATE items SET state = ?, error = ?, lease_token = NULL WHERE job_id = ? AND item_id = ?",
+                         (state, str(error), item.job_id, item.item_id))
+            return True
+
+    def job_progress(self, job_id):
+        progress = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        for state, count in self._connection().execute("SELECT state, COUNT(*) FROM items WHERE job_id = ? GROUP BY state", (job_id,)):
+            progress[state] = count
+        return progress
+
+    def job_results(self, job_id):
+        rows = self._connection().execute("SELECT item_id, state, attempts, result, error FROM items WHERE job_id = ? ORDER BY rowid", (job_id,))
+        return {item_id: {"state": state, "attempts": attempts, "result": json.loads(result) if result else None, "error": error}
+                for item_id, state, attempts, result, error in rows}
+
+    def put_blob(self, job_id, key, data):
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO blobs (job_id, key, data) VALUES (?, ?, ?)", (job_id, key, sqlite3.Binary(data)))
+
+    def get_blob(self, job_id, key):
+        row = self._connection().execute("SELECT data FROM blobs WHERE job_id = ? AND key = ?", (job_id, key)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def delete_job(self, job_id):
+        with self._transaction() as conn:
+            for table in ("items", "blobs", "jobs"):
+                conn.execute(f"DELETE FROM {table} WHERE job_id = ?", (job_id,))
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+# Общая часть скриптов: вернуть в очередь элементы с истекшей арендой (время - по часам сервера)
+_REDIS_REQUEUE_LUA = """
+local p = KEYS[1]
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local requeued = 0
+for _, member in ipairs(redis.call('ZRANGEBYSCORE', p .. ':leases', '-inf', now)) do
+    redis.call('ZREM', p .. ':leases', member)
+    local ikey = p .. ':item:' .. member
+    if redis.call('HGET', ikey, 'state') == 'leased' then
+        local job_id = string.sub(member, 1, string.find(member, '|', 1, true) - 1)
+        local attempts = tonumber(redis.call('HGET', ikey, 'attempts') or '0')
+        local max_attempts = tonumber(redis.call('HGET', p .. ':job:' .. job_id, 'max_attempts') or '1')
+        if attempts >= max_attempts then
+            redis.call('HSET', ikey, 'state', 'failed', 'error', ARGV[1], 'token', '')
+        else
+            redis.call('HSET', ikey, 'state', 'pending', 'token', '')
+            redis.call('RPUSH', p .. ':pending', member)
+        end
+        requeued = requeued + 1
+    end
+end
+"""
+
+_REDIS_LEASE_LUA = _REDIS_REQUEUE_LUA + """
+local member = redis.call('RPOP', p .. ':pending')
+while member do
+    local ikey = p .. ':item:' .. member
+    if redis.call('HGET', ikey, 'state') == 'pending' then
+        local attempts = redis.call('HINCRBY', ikey, 'attempts', 1)
+        local expires = now + tonumber(ARGV[2])
+        redis.call('HSET', ikey, 'state', 'leased', 'token', ARGV[3], 'worker', ARGV[4], 'expires', tostring(expires))
+        redis.call('ZADD', p .. ':leases', expires, member)
+        return {member, redis.call('HGET', ikey, 'payload'), attempts}
+    end
+    member = redis.call('RPOP', p .. ':pending')
+end
+return false
+"""
+
+_REDIS_EXTEND_LUA = """
+local p = KEYS[1]
+local ikey = p .. ':item:' .. ARGV[1]
+if redis.call('HGET', ikey, 'state') ~= 'leased' or redis.call('HGET', ikey, 'token') ~= ARGV[2] then return 0 end
+local t = redis.call('TIME')
+local expires = tonumber(t[1]) + tonumber(t[2]) / 1000000 + tonumber(ARGV[3])
+redis.call('HSET', ikey, 'expires', tostring(expires))
+redis.call('ZADD', p .. ':leases', expires, ARGV[1])
+return 1
+"""
+
+# ARGV: member, token, новое состояние ('done' / 'failed' / 'retry'), result, error, job_id
+_REDIS_FINISH_LUA = """
+local p = KEYS[1]
+local ikey = p .. ':item:' .. ARGV[1]
+if redis.call('HGET', ikey, 'state') ~= 'leased' or redis.call('HGET', ikey, 'token') ~= ARGV[2] then return 0 end
+redis.call('ZREM', p .. ':leases', ARGV[1])
+local state = ARGV[3]
+if state == 'retry' then
+    local attempts = tonumber(redis.call('HGET', ikey, 'attempts') or '0')
+    local max_attempts = tonumber(redis.call('HGET', p .. ':job:' .. ARGV[6], 'max_attempts') or '1')
+    state = attempts < max_attempts and 'pending' or 'failed'
+end
+redis.call('HSET', ikey, 'state', state, 'token', '', 'result', ARGV[4], 'error', ARGV[5])
+if state == 'pending' then redis.call('RPUSH', p .. ':pending', ARGV[1]) end
+return 1
+"""
+
+
+class RedisWorkQueue(WorkQueue):
+    """Очередь в Redis (или совместимом сервере с поддержкой Lua): переходы состояний - атомарные скрипты.
+
+    Ключи (prefix по умолчанию "transgemini"): {p}:pending - список "job|item" к выдаче,
+    {p}:leases - zset аренд по времени истечения, {p}:item:job|item - hash элемента,
+    {p}:job:<id> - hash задания, {p}:items:<id> - порядок элементов, {p}:blob:<id>:<key> - blob-ы.
+    Скрипты обращаются к ключам по префиксу, поэтому Redis Cluster не поддерживается.
+    """
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="transgemini", client=None):
+        if client is None:
+            if not get_capabilities().get("redis", False):
+                raise MissingDependencyError(["redis"], "redis-очередь")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self._lease_script = client.register_script(_REDIS_LEASE_LUA)
+        self._requeue_script = client.register_script(_REDIS_REQUEUE_LUA + "\nreturn requeued\n")
+        self._extend_script = client.register_script(_REDIS_EXTEND_LUA)
+        self._finish_script = client.register_script(_REDIS_FINISH_LUA)
+
+    @staticmethod
+    def _member(job_id, item_id):
+        if "|" in job_id or "|" in item_id:
+            raise ValueError(f"Идентификаторы не должны содержать '|': {job_id!r}, {item_id!r}")
+        return f"{job_id}|{item_id}"
+
+    def _key(self, *parts):
+        return ":".join((self.prefix,) + parts)
+
+    def create_job(self, job_id, spec, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self._member(job_id, "")
+        if not self.client.hsetnx(self._key("job", job_id), "spec", json.dumps(spec, ensure_ascii=False)):
+            raise ValueError(f"Задание {job_id} уже существует")
+        self.client.hset(self._key("job", job_id), mapping={"max_attempts": int(max_attempts), "created": time.time()})
+
+    def get_job(self, job_id):
+        spec = self.client.hget(self._key("job", job_id), "spec")
+        return json.loads(spec) if spec else None
+
+    def enqueue(self, job_id, items):
+        pipe = self.client.pipeline(transaction=True)
+        members = []
+        for item_id, payload in items:
+            member = self._member(job_id, item_id)
+            pipe.hset(self._key("item", member), mapping={"payload": json.dumps(payload, ensure_ascii=False),
+                                                          "state": "pending", "attempts": 0})
+            members.append(member)
+        if members:
+            pipe.rpush(self._key("items", job_id), *[member.split("|", 1)[1] for member in members])
+            pipe.lpush(self._key("pending"), *members) # Выдача - RPOP, то есть в порядке постановки
+        pipe.execute()
+
+    def lease(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        token = uuid.uuid4().hex
+        leased = self._lease_script(keys=[self.prefix], args=[LEASE_EXPIRED_ERROR, lease_seconds, token, worker_id])
+        if not leased:
+            return None
+        member, payload, attempts = leased
+        member = member.decode("utf-8") if isinstance(member, bytes) else member
+        job_id, item_id = member.split("|", 1)
+        return LeasedItem(job_id, item_id, json.loads(payload), token, int(attempts))
+
+    def requeue_expired(self):
+        return int(self._requeue_script(keys=[self.prefix], args=[LEASE_EXPIRED_ERROR]))
+
+    def extend(self, item, lease_seconds=DEFAULT_LEASE_SECONDS):
+        return bool(self._extend_script(keys=[self.prefix], args=[self._member(item.job_id, item.item_id), item.token, lease_seconds]))
+
+    def _finish(self, item, state, result="", error=""):
+        return bool(self._finish_script(keys=[self.prefix],
+                                        args=[self._member(item.job_id, item.item_id), item.token, state, result, error, item.job_id]))
+
+    def complete(self, item, result):
+        return self._finish(item, "done", result=json.dumps(result, ensure_ascii=False))
+
+    def fail(self, item, error, retry=True):
+        return self._finish(item, "retry" if retry else "failed", error=str(error))
+
+    def _item_states(self, job_id):
+        item_ids = [value.decode("utf-8") for value in self.client.lrange(self._key("items", job_id), 0, -1)]
+        pipe = self.client.pipeline(transaction=False)
+        for item_id in item_ids:
+            pipe.hmget(self._key("item", self._member(job_id, item_id)), "state", "attempts", "result", "error")
+        return zip(item_ids, pipe.execute())
+
+    def job_progress(self, job_id):
+        progress = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        for _, (state, _, _, _) in self._item_states(job_id):
+            if state:
+                progress[state.decode("utf-8")] += 1
+        return progress
+
+    def job_results(self, job_id):
+        results = {}
+        for item_id, (state, attempts, result, error) in self._item_states(job_id):
+            if state is None:
+                continue
+            results[item_id] = {"state": state.decode("utf-8"), "attempts": int(attempts or 0),
+                                "result": json.loads(result) if result else None,
+                                "error": error.decode("utf-8") if error else None}
+        return results
+
+    def put_blob(self, job_id, key, data):
+        self.client.set(self._key("blob", job_id, key), data)
+
+    def get_blob(self, job_id, key):
+        return self.client.get(self._key("blob", job_id, key))
+
+    def delete_job(self, job_id):
+        item_ids = [value.decode("utf-8") for value in self.client.lrange(self._key("items", job_id), 0, -1)]
+        keys = [self._key("item", self._member(job_id, item_id)) for item_id in item_ids]
+        keys += list(self.client.scan_iter(match=self._key("blob", job_id, "*")))
+        keys += [self._key("items", job_id), self._key("job", job_id)]
+        self.client.delete(*keys) # Ссылки в pending/leases пропускаются скриптами, т.к. hash элемента удален
+
+    def close(self):
+        self.client.close()
+
+
+def open_work_queue(url):
+    """Открывает очередь по адресу: redis://, rediss://, unix:// - Redis; sqlite:///путь или просто путь - SQLite."""
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisWorkQueue(url)
+    if url.startswith("sqlite://"):
+        url = url[len("sqlite://"):]
+        if len(url) > 2 and url[0] == "/" and url[2] == ":": # sqlite:///C:/... на Windows
+            url = url[1:]
+    return SQLiteWorkQueue(url)
@@ -0,0 +1,880 @@
+# --- START OF FILE transgemini_core/writers.py ---
+
+import io
+import os
+import re
+import html
+import time
+import base64
+from pathlib import Path
+
+from .deps import DOCX_AVAILABLE, LXML_AVAILABLE, docx, docx_shared, etree
+from .placeholders import IMAGE_PLACEHOLDER_PATTERN, IMAGE_PLACEHOLDER_PREFIX, find_image_placeholders
+
+
+# --- DOCX: абзацы собираются строкой XML по готовым шаблонам и разбираются lxml одним вызовом ---
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+DOCX_HEADING_PATTERN = re.compile(r'^(#{1,6})\s+(.*)', re.DOTALL)
+DOCX_LIST_PATTERN = re.compile(r'^([\*\-\•\⁃]|\d+\.|\([a-z]\)|\([A-Z]\)|[a-z]\.|[A-Z]\.)\s+(.*)', re.DOTALL)
+DOCX_RUN_SPECIALS_PATTERN = re.compile(r'[\t\r\n]') # Как в python-docx: \t -> <w:tab/>, \r/\n -> <w:br/>
+DOCX_BULLET_MARKERS = ('*', '-', '•', '⁃')
+_DOCX_EMPTY_P = '<w:p/>'
+_DOCX_P_OPEN = '<w:p>'
+_DOCX_STYLED_P_OPEN = '<w:p><w:pPr><w:pStyle w:val="{style_id}"/></w:pPr>'
+_DOCX_HR_P = '<w:p><w:pPr><w:pBdr><w:bottom w:val="single" w:sz="6" w:space="1" w:color="auto"/></w:pBdr></w:pPr><w:r/></w:p>'
+_DOCX_EMPTY_RUN = '<w:r/>'
+_DOCX_DRAWING_RUN = '<w:r><w:drawing/></w:r>' # Пустой w:drawing, inline вставляется после разбора
+_DOCX_BODY_OPEN = f'<w:body xmlns:w="{W_NS}">'
+
+
+def _docx_run_xml(text):
+    """XML одного run с текстом так же, как его строит Run.text в python-docx."""
+    parts = ['<w:r>']
+    position = 0
+    for match in DOCX_RUN_SPECIALS_PATTERN.finditer(text):
+        if match.start() > position: parts.append(_docx_t_xml(text[position:match.start()]))
+        parts.append('<w:tab/>' if match.group() == '\t' else '<w:br/>')
+        position = match.end()
+    if position < len(text): parts.append(_docx_t_xml(text[position:]))
+    parts.append('</w:r>')
+    return "".join(parts)
+
+def _docx_t_xml(text):
+    escaped = html.escape(text, quote=False)
+    if len(text.strip()) < len(text): return f'<w:t xml:space="preserve">{escaped}</w:t>'
+    return f'<w:t>{escaped}</w:t>'
+
+
+class _DocxBodyBuilder:
+    """Копит XML абзацев; изображения создаются через python-docx (part.new_pic_inline) по месту."""
+    def __init__(self, doc, image_map):
+        self.doc = doc
+        self.image_map = image_map
+        self.parts = []
+        self.inlines = [] # По порядку пустых <w:drawing/> в self.parts
+        self.next_shape_id = doc.part.next_id # Тело пока пустое: id считаются здесь, а не XPath по документу на каждое изображение
+        self._style_openers = {}
+
+    def styled_paragraph_open(self, style_name):
+        opener = self._style_openers.get(style_name)
+        if opener is None:
+            style_id = self.doc.styles[style_name].style_id # KeyError/ValueError, если стиля нет в шаблоне
+            opener = self._style_openers[style_name] = _DOCX_STYLED_P_OPEN.format(style_id=html.escape(style_id))
+        return opener
+
+    def add_paragraph(self, opener, text_with_placeholders):
+        self.parts.append(opener)
+        self.add_runs(text_with_placeholders)
+        self.parts.append('</w:p>')
+
+    def add_runs(self, text_with_placeholders):
+        """То же, что process_text_with_placeholders, но в XML-строку."""
+        parts = self.parts
+        if "<||" not in text_with_placeholders:
+            if text_with_placeholders.strip(): parts.append(_docx_run_xml(text_with_placeholders))
+            return
+        last_index = 0
+        for match in IMAGE_PLACEHOLDER_PATTERN.finditer(text_with_placeholders):
+            text_before = text_with_placeholders[last_index:match.start()]
+            if text_before: parts.append(_docx_run_xml(text_before))
+            self.add_image(match.group(2))
+            last_index = match.end()
+        if last_index == 0:
+            if text_with_placeholders.strip(): parts.append(_docx_run_xml(text_with_placeholders))
+            return
+        text_after = text_with_placeholders[last_index:]
+        if text_after: parts.append(_docx_run_xml(text_after))
+
+    def add_image(self, img_uuid):
+        parts = self.parts
+        img_info = self.image_map.get(img_uuid)
+        if img_info is None:
+            print(f"[WARN] DOCX Write: Placeholder UUID '{img_uuid}' not found in image_map.")
+            parts.append(_docx_run_xml(f"[Unk Img: {img_uuid}]")); return
+        img_path = img_info['saved_path']
+        if not os.path.exists(img_path):
+            print(f"[ERROR] DOCX Write: Image path from map does not exist: {img_path}")
+            parts.append(_docx_run_xml(f"[Img Path Miss: {img_info.get('original_filename', img_uuid)}]")); return
+        target_width = None
+        img_width_px = img_info.get('width')
+        if img_width_px:
+            try:
+                img_width_px = float(img_width_px) # Ensure it's a number
+                if img_width_px > 0:
+                    target_width = docx_shared.Inches(min(img_width_px / 96.0, 6.0)) # Approx DPI; usable page width 6"
+            except (ValueError, TypeError): pass # Ignore invalid width values
+        try:
+            inline = self.doc.part.new_pic_inline(img_path, width=target_width)
+        except FileNotFoundError:
+            print(f"[ERROR] DOCX Write: Image file not found: {img_path}")
+            parts.append(_DOCX_EMPTY_RUN); parts.append(_docx_run_xml(f"[Image NF: {img_info.get('original_filename', img_uuid)}]")); return
+        except Exception as e:
+            print(f"[ERROR] DOCX Write: Failed to add picture {img_path}: {e}")
+            parts.append(_DOCX_EMPTY_RUN); parts.append(_docx_run_xml(f"[Img Err: {img_info.get('original_filename', img_uuid)}]")); return
+        inline.docPr.set('id', str(self.next_shape_id)); self.next_shape_id += 1
+        self.inlines.append(inline)
+        parts.append(_DOCX_DRAWING_RUN)
+
+    def attach(self):
+        """Разбирает накопленный XML одним вызовом и переносит абзацы в тело документа перед sectPr."""
+        from docx.oxml import parse_xml
+        new_body = parse_xml("".join([_DOCX_BODY_OPEN, *self.parts, '</w:body>']))
+        drawing_tag = f"{{{W_NS}}}drawing"
+        for drawing, inline in zip(new_body.iter(drawing_tag), self.inlines): drawing.append(inline)
+        body = self.doc.element.body
+        sect_pr = body.sectPr
+        if sect_pr is not None: body.remove(sect_pr)
+        body.extend(list(new_body))
+        if sect_pr is not None: body.append(sect_pr)
+
+
+def write_markdown_to_docx(filepath, md_text_with_placeholders, image_map):
+    """Writes Markdown-like text with placeholders back to DOCX.
+
+    Результат совпадает с _write_markdown_to_docx_reference (высокоуровневый API python-docx), но абзацы
+    собираются в один XML и разбираются lxml за раз: без объектов Paragraph/Run на каждый абзац.
+    """
+    if not DOCX_AVAILABLE: raise ImportError("python-docx library is required.")
+    if image_map is None: image_map = {}
+    doc = docx.Document()
+    builder = _DocxBodyBuilder(doc, image_map)
+    parts = builder.parts
+
+    # Каждая непустая строка - абзац; после абзаца (кроме черты ---) идет пустой абзац, если за ним
+    # в тексте еще что-то есть - перевод строки или пустые строки (подряд идущие схлопываются)
+    lines = md_text_with_placeholders.split('\n')
+    last_line_index = len(lines) - 1
+    for line_index, line in enumerate(lines):
+        md_para_stripped = line.strip()
+        if not md_para_stripped: continue
+
+        heading_match = DOCX_HEADING_PATTERN.match(md_para_stripped)
+        list_match = None if heading_match else DOCX_LIST_PATTERN.match(md_para_stripped)
+        if heading_match:
+            level = max(1, min(len(heading_match.group(1)), 6))
+            builder.add_paragraph(builder.styled_paragraph_open(f"Heading {level}"), heading_match.group(2).strip())
+        elif list_match:
+            style = 'List Bullet' if list_match.group(1) in DOCX_BULLET_MARKERS else 'List Number' # Basic style mapping
+            try: opener = builder.styled_paragraph_open(style)
+            except (KeyError, ValueError): # Fallback if style doesn't exist in template
+                print(f"[WARN] DOCX Write: Style '{style}' not found. Using default paragraph.")
+                opener = _DOCX_P_OPEN
+            builder.add_paragraph(opener, list_match.group(2).strip())
+        elif md_para_stripped == '---':
+            parts.append(_DOCX_HR_P)
+            continue # HR acts as break
+        else:
+            builder.add_paragraph(_DOCX_P_OPEN, md_para_stripped)
+        if line_index < last_line_index: parts.append(_DOCX_EMPTY_P)
+
+    builder.attach()
+    doc.save(filepath)
+
+
+def _write_markdown_to_docx_reference(filepath, md_text_with_placeholders, image_map):
+    """Эталонная запись DOCX через высокоуровневый API python-docx (по абзацу и run за раз).
+
+    Медленная; оставлена для сверки и бенчмарка write_markdown_to_docx (benchmarks/docx_writer_benchmark.py).
+    """
+    if not DOCX_AVAILABLE: raise ImportError("python-docx library is required.")
+    if image_map is None: image_map = {}
+    doc = docx.Document()
+
+    lines = re.split('(\n)', md_text_with_placeholders)
+
+    paragraphs_md = []
+    current_para_lines = []
+    for line in lines:
+        stripped_line = line.strip()
+        if not stripped_line: # Treat empty line as paragraph break
+            if current_para_lines:
+                paragraphs_md.append("\n".join(current_para_lines))
+                current_para_lines = []
+
+            if paragraphs_md and paragraphs_md[-1]: # Add if last added wasn't already empty
+                 paragraphs_md.append("")
+        else:
+            current_para_lines.append(line)
+    if current_para_lines: # Add last paragraph if exists
+        paragraphs_md.append("\n".join(current_para_lines))
+
+    current_docx_para = None
+    for md_para in paragraphs_md:
+        md_para_stripped = md_para.strip()
+        if not md_para_stripped:
+
+            if current_docx_para is not None: # Check if previous para exists
+                doc.add_paragraph("")
+            current_docx_para = None # Reset current para tracker
+            continue
+
+        heading_match = re.match(r'^(#{1,6})\s+(.*)', md_para_stripped, re.DOTALL)
+        if heading_match:
+            level = len(heading_match.group(1))
+            heading_text_raw = heading_match.group(2).strip()
+            current_docx_para = doc.add_heading("", level=max(1, min(level, 6))) # Add heading
+            process_text_with_placeholders(current_docx_para, heading_text_raw, image_map)
+            continue # Move to next md paragraph
+
+        list_match = re.match(r'^([\*\-\•\⁃]|\d+\.|\([a-z]\)|\([A-Z]\)|[a-z]\.|[A-Z]\.)\s+(.*)', md_para_stripped, re.DOTALL)
+        if list_match:
+             marker = list_match.group(1)
+             list_item_text_raw = list_match.group(2).strip()
+             style = 'List Bullet' if marker in ['*', '-', '•', '⁃'] else 'List Number' # Basic style mapping
+             try:
+                 current_docx_para = doc.add_paragraph(style=style)
+             except (KeyError, ValueError): # Fallback if style doesn't exist in template
+                 print(f"[WARN] DOCX Write: Style '{style}' not found. Using default paragraph.")
+                 current_docx_para = doc.add_paragraph()
+             process_text_with_placeholders(current_docx_para, list_item_text_raw, image_map)
+             continue # Move to next md paragraph
+
+        if md_para_stripped == '---':
+             hr_para = doc.add_paragraph(); hr_para.add_run()
+             hr_para._p.get_or_add_pPr().append(
+                 etree.fromstring('<w:pBdr xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:bottom w:val="single" w:sz="6" w:space="1" w:color="auto"/></w:pBdr>')
+             )
+             current_docx_para = None # HR acts as break
+             continue
+
+        current_docx_para = doc.add_paragraph()
+        process_text_with_placeholders(current_docx_para, md_para.strip(), image_map) # Process original (not stripped) to keep internal newlines
+
+    doc.save(filepath)
+
+
+def process_text_with_placeholders(docx_paragraph, text_with_placeholders, image_map):
+    """Adds runs of text and images to a docx paragraph based on placeholders."""
+
+    last_index = 0
+    placeholders_found = find_image_placeholders(text_with_placeholders)
+
+    if not placeholders_found:
+        if text_with_placeholders.strip():
+            docx_paragraph.add_run(text_with_placeholders)
+        return
+
+    for placeholder_tag, img_uuid in placeholders_found:
+        match_start = text_with_placeholders.find(placeholder_tag, last_index)
+        if match_start == -1: continue # Should not happen with finditer logic
+
+        text_before = text_with_placeholders[last_index:match_start]
+        if text_before:
+            docx_paragraph.add_run(text_before)
+
+        if img_uuid in image_map:
+            img_info = image_map[img_uuid]; img_path = img_info['saved_path']
+            if os.path.exists(img_path):
+                try:
+
+                    img_width_px = img_info.get('width'); img_height_px = img_info.get('height')
+                    run = docx_paragraph.add_run() # Create run for the picture
+                    target_width = None
+
+                    if img_width_px:
+                        try:
+                            img_width_px = float(img_width_px) # Ensure it's a number
+                            if img_width_px > 0:
+                                 target_width_inches = img_width_px / 96.0 # Approx DPI
+                                 max_doc_width_inches = 6.0 # Usable width on standard page
+                                 target_width = docx_shared.Inches(min(target_width_inches, max_doc_width_inches))
+                        except (ValueError, TypeError): pass # Ignore invalid width values
+
+                    run.add_picture(img_path, width=target_width)
+                except FileNotFoundError:
+                    print(f"[ERROR] DOCX Write: Image file not found: {img_path}")
+                    docx_paragraph.add_run(f"[Image NF: {img_info.get('original_filename', img_uuid)}]") # Add error text
+                except Exception as e:
+                    print(f"[ERROR] DOCX Write: Failed to add picture {img_path}: {e}")
+                    docx_paragraph.add_run(f"[Img Err: {img_info.get('original_filename', img_uuid)}]")
+            else:
+
+                print(f"[ERROR] DOCX Write: Image path from map does not exist: {img_path}")
+                docx_paragraph.add_run(f"[Img Path Miss: {img_info.get('original_filename', img_uuid)}]")
+        else:
+
+            print(f"[WARN] DOCX Write: Placeholder UUID '{img_uuid}' not found in image_map.")
+            docx_paragraph.add_run(f"[Unk Img: {img_uuid}]")
+
+        last_index = match_start + len(placeholder_tag)
+
+    text_after = text_with_placeholders[last_index:]
+    if text_after:
+        docx_paragraph.add_run(text_after)
+
+# --- HTML/XHTML: общий однопроходный рендер inline-Markdown (EPUB-пересборка и экспорт в HTML) ---
+_INLINE_TAG_NAME_SRC = r'(?i:br\s*/?|img\s+[^>]*?/)' # <br>, <br/>, <img .../> без угловых скобок
+_INLINE_PLACEHOLDER_SRC = r'<\|\|' + IMAGE_PLACEHOLDER_PREFIX + r'(?P<uuid>[a-f0-9]{32})\|\|>'
+# Тело выделения: обычный символ, маркер, тег <br>/<img> целиком (маркеры внутри атрибутов не считаются).
+# Альтернативы не пересекаются и берут по одному символу/тегу: у незакрытого * или ` нет экспоненциального перебора
+_INLINE_SPAN_BODY_SRC = r'(?:[^<*`]|[*`]|<' + _INLINE_TAG_NAME_SRC + r'>|<(?!' + _INLINE_TAG_NAME_SRC + r'>))+?'
+# Каждая альтернатива начинается с литерала: движок regex прыгает сразу к <, * или `
+_INLINE_TOKEN_RE = re.compile(
+    r'<(?P<tag>' + _INLINE_TAG_NAME_SRC + r')>'
+    r'|' + _INLINE_PLACEHOLDER_SRC +
+    r'|\*\*(?P<strong>' + _INLINE_SPAN_BODY_SRC + r')\*\*'
+    r'|\*(?!\*)(?P<em>' + _INLINE_SPAN_BODY_SRC + r')(?<!\*)\*(?!\*(?!\*))' # *курсив***жирный**: курсив закрывается перед **
+    r'|`(?P<code>' + _INLINE_SPAN_BODY_SRC + r')`')
+_INLINE_TAG_ONLY_RE = re.compile(r'<(?P<tag>' + _INLINE_TAG_NAME_SRC + r')>|' + _INLINE_PLACEHOLDER_SRC)
+_BR_TAG_RE = re.compile(r'<br\s*/?>', re.IGNORECASE)
+_EXCESS_NEWLINES_RE = re.compile(r'\n{3,}')
+_STANDALONE_IMG_RE = re.compile(r'\s*<img\s+[^>]*?/>\s*', re.IGNORECASE)
+MD_HEADING_PATTERN = re.compile(r'^\s*(#{1,6})\s+(.*)')
+MD_HR_PATTERN = re.compile(r'^\s*---\s*$')
+MD_UL_ITEM_PATTERN = re.compile(r'^\s*[\*\-]\s+(.*)')
+MD_OL_ITEM_PATTERN = re.compile(r'^\s*\d+\.\s+(.*)')
+MD_CODE_FENCE_PATTERN = re.compile(r'^\s*```(.*)')
+
+
+def render_inline_markdown(text, image_renderer=None, escape_spans=False):
+    """Inline-Markdown блока в (X)HTML за один проход токенизатора, результат собирается join'ом.
+
+    **жирный**, *курсив* (вложенность поддерживается) и `код` -> strong/em/code; <br> -> <br />,
+    готовые <img .../> остаются как есть. Плейсхолдеры изображений заменяются на
+    image_renderer(uuid) (None - остаются в тексте). escape_spans=True - текст внутри
+    выделений экранируется (текст вне выделений не трогается ни в каком режиме).
+    """
+    return _render_inline(text, _INLINE_TOKEN_RE, image_renderer, escape_spans, False)
+
+
+def _render_inline(text, token_re, image_renderer, escape_spans, in_span):
+    escape = in_span and escape_spans
+    parts = []
+    position = 0
+    for match in token_re.finditer(text):
+        start = match.start()
+        if start > position:
+            parts.append(html.escape(text[position:start]) if escape else text[position:start])
+        kind = match.lastgroup
+        if kind == 'tag':
+            parts.append('<br />' if match.group('tag')[0] in 'bB' else match.group(0))
+        elif kind == 'uuid':
+            parts.append(image_renderer(match.group('uuid')) if image_renderer else match.group(0))
+        else:
+            body = match.group(kind)
+            if kind == 'code': # Внутри кода Markdown не разбирается, только теги и плейсхолдеры
+                nested = '<' in body and _INLINE_TAG_ONLY_RE
+            else:
+                nested = ('<' in body or '*' in body or '`' in body) and token_re
+            if nested: body = _render_inline(body, nested, image_renderer, escape_spans, True)
+            elif escape_spans: body = html.escape(body)
+            parts.append(f"<{kind}>{body}</{kind}>")
+        position = match.end()
+    if position == 0: return html.escape(text) if escape else text
+    if position < len(text):
+        parts.append(html.escape(text[position:]) if escape else text[position:])
+    return "".join(parts)
+
+
+def _convert_placeholders_to_html_img(text_with_placeholders, item_image_map_for_this_html,
+                                    epub_new_image_objects,
+                                    canonical_title,
+                                    current_html_file_path_relative_to_opf=None,
+                                    opf_dir_path=None):
+    if not text_with_placeholders: return ""
+    if item_image_map_for_this_html is None: item_image_map_for_this_html = {}
+    if epub_new_image_objects is None: epub_new_image_objects = {}
+
+    def img_tag_for_placeholder(match):
+        img_uuid = match.group(2)
+        img_info = item_image_map_for_this_html.get(img_uuid)
+        img_tag_html = f"<!-- Placeholder Error: UUID {img_uuid} not fully processed -->"
+        if img_info:
+            original_src_from_html_map = img_info.get('original_src')
+            final_img_src_attr_value_for_tag = None
+            final_attributes_for_tag = dict(img_info.get('attributes', {}))
+            if original_src_from_html_map is not None:
+                final_img_src_attr_value_for_tag = original_src_from_html_map
+                final_attributes_for_tag.pop('{http://www.w3.org/1999/xlink}href', None)
+                final_attributes_for_tag.pop('xlink:href', None)
+            elif img_uuid in epub_new_image_objects:
+                epub_img_object_for_new = epub_new_image_objects.get(img_uuid)
+                if epub_img_object_for_new:
+                    image_path_rel_to_opf_for_new = epub_img_object_for_new.file_name.replace('\\', '/')
+                    if current_html_file_path_relative_to_opf is not None:
+                        html_dir_rel_to_opf_for_new = os.path.dirname(current_html_file_path_relative_to_opf).replace('\\', '/')
+                        if html_dir_rel_to_opf_for_new == '.': html_dir_rel_to_opf_for_new = ""
+                        try: final_img_src_attr_value_for_tag = os.path.relpath(image_path_rel_to_opf_for_new, start=html_dir_rel_to_opf_for_new).replace('\\', '/')
+                        except ValueError: final_img_src_attr_value_for_tag = image_path_rel_to_opf_for_new
+                    else: final_img_src_attr_value_for_tag = image_path_rel_to_opf_for_new
+            if final_img_src_attr_value_for_tag is not None:
+                alt_text_raw = final_attributes_for_tag.get('alt', img_info.get('original_filename', f'Image {img_uuid[:7]}'))
+                alt_text_escaped = html.escape(str(alt_text_raw), quote=True)
+                attr_strings_list = [f'src="{html.escape(final_img_src_attr_value_for_tag, quote=True)}"', f'alt="{alt_text_escaped}"']
+                for key, value in final_attributes_for_tag.items():
+                    key_lower = str(key).lower()
+                    if key_lower not in ['src', 'alt', 'xlink:href', '{http://www.w3.org/1999/xlink}href']:
+                        attr_strings_list.append(f'{html.escape(str(key))}="{html.escape(str(value))}"')
+                width_attr = final_attributes_for_tag.get('width'); height_attr = final_attributes_for_tag.get('height')
+                styles_to_add = []
+                if not width_attr or (isinstance(width_attr, str) and '%' in width_attr): styles_to_add.append("max-width: 100%;")
+                if not height_attr or (isinstance(height_attr, str) and '%' in height_attr):
+                     if "max-width: 100%;" in styles_to_add and not height_attr : styles_to_add.append("height: auto;")
+                if styles_to_add: attr_strings_list.append(f'style="{html.escape(" ".join(styles_to_add))}"')
+                img_tag_html = f"<img {' '.join(attr_strings_list)} />"
+        return img_tag_html
+
+    text_after_img_restore = IMAGE_PLACEHOLDER_PATTERN.sub(img_tag_for_placeholder, text_with_placeholders)
+
+    text_normalized_newlines = _BR_TAG_RE.sub('\n', text_after_img_restore)
+
+    text_normalized_newlines = _EXCESS_NEWLINES_RE.sub('\n\n', text_normalized_newlines)
+
+    lines = text_normalized_newlines.splitlines() # Делим по \n.
+
+    html_body_segments = []
+    paragraph_part_buffer = []
+    current_list_tag_md = None
+    in_code_block_md = False
+    code_block_buffer_md = []
+
+    def finalize_paragraph_md():
+        nonlocal paragraph_part_buffer, html_body_segments
+        if paragraph_part_buffer:
+
+            para_content_raw = "<br />".join(paragraph_part_buffer) # Восстанавливаем <br />
+            processed_content = render_inline_markdown(para_content_raw, escape_spans=True)
+            html_body_segments.append(f"<p>{processed_content}</p>")
+            paragraph_part_buffer = []
+
+    def finalize_list_md():
+        nonlocal current_list_tag_md, html_body_segments
+        if current_list_tag_md:
+            html_body_segments.append(f"</{current_list_tag_md}>")
+            current_list_tag_md = None
+            
+    def finalize_code_block_md():
+        nonlocal in_code_block_md, code_block_buffer_md, html_body_segments
+        if code_block_buffer_md:
+            escaped_code = html.escape("\n".join(code_block_buffer_md))
+            html_body_segments.append(escaped_code)
+        if in_code_block_md:
+            html_body_segments.append("</code></pre>")
+            in_code_block_md = False
+        code_block_buffer_md = []
+
+    for i, line_text in enumerate(lines): # line_text это строка без \n на конце
+        stripped_line = line_text.strip()
+
+        is_standalone_image = False
+        if stripped_line.startswith("<img") and stripped_line.endswith("/>"):
+            if _STANDALONE_IMG_RE.fullmatch(line_text):
+                is_standalone_image = True
+        
+        if is_standalone_image:
+            finalize_paragraph_md()
+            finalize_list_md()
+            finalize_code_block_md()
+            html_body_segments.append(line_text)
+            continue
+
+        code_fence_match = MD_CODE_FENCE_PATTERN.match(stripped_line)
+        if code_fence_match:
+            finalize_paragraph_md()
+            finalize_list_md()
+            if not in_code_block_md:
+                in_code_block_md = True
+                code_block_buffer_md = []
+                lang = html.escape(code_fence_match.group(1).strip())
+                html_body_segments.append(f'<pre><code class="language-{lang}">' if lang else "<pre><code>")
+            else:
+                finalize_code_block_md()
+            continue
+
+        if in_code_block_md:
+            code_block_buffer_md.append(line_text)
+            continue
+
+        if not stripped_line: # Если строка пуста ПОСЛЕ strip
+            finalize_paragraph_md()
+            finalize_list_md() 
+
+            continue # Переходим к следующей строке
+
+        heading_match = MD_HEADING_PATTERN.match(line_text) 
+        hr_match = MD_HR_PATTERN.match(stripped_line) # hr всегда на всю строку
+        ul_item_match = MD_UL_ITEM_PATTERN.match(line_text)
+        ol_item_match = MD_OL_ITEM_PATTERN.match(line_text)
+
+        is_block_markdown = bool(heading_match or hr_match or ul_item_match or ol_item_match)
+
+        if is_block_markdown:
+            finalize_paragraph_md() 
+
+        if heading_match:
+            finalize_list_md()
+            level = len(heading_match.group(1))
+            heading_text_raw = heading_match.group(2).strip() # strip() здесь, т.к. это содержимое тега
+            processed_heading_text = render_inline_markdown(heading_text_raw, escape_spans=True)
+            html_body_segments.append(f"<h{level}>{processed_heading_text}</h{level}>")
+        elif hr_match:
+            finalize_list_md()
+            html_body_segments.append("<hr />")
+        elif ul_item_match:
+            if current_list_tag_md != 'ul':
+                finalize_list_md()
+                html_body_segments.append("<ul>")
+                current_list_tag_md = 'ul'
+            list_item_raw = ul_item_match.group(1).strip() # strip() здесь
+            processed_list_item = render_inline_markdown(list_item_raw, escape_spans=True)
+            html_body_segments.append(f"<li>{processed_list_item}</li>")
+        elif ol_item_match:
+            if current_list_tag_md != 'ol':
+                finalize_list_md()
+                html_body_segments.append("<ol>")
+                current_list_tag_md = 'ol'
+            list_item_raw = ol_item_match.group(1).strip() # strip() здесь
+            processed_list_item = render_inline_markdown(list_item_raw, escape_spans=True)
+            html_body_segments.append(f"<li>{processed_list_item}</li>")
+        else: # Если это не MD-блок и не пустая строка (уже проверили stripped_line)
+            finalize_list_md() # Закрыть список, если эта строка не является его продолжением
+
+            paragraph_part_buffer.append(line_text)
+
+    finalize_paragraph_md()
+    finalize_list_md()
+    finalize_code_block_md()
+
+    body_content_final = "\n".join(html_body_segments)
+
+    final_title_text_for_html_tag = html.escape(str(canonical_title or Path(current_html_file_path_relative_to_opf or "document").stem).strip())
+    if not final_title_text_for_html_tag: final_title_text_for_html_tag = "Untitled Document"
+    stylesheet_path_final = "../Styles/stylesheet.css"
+    if current_html_file_path_relative_to_opf is not None:
+        html_abs_dir_in_epub = ""
+        if opf_dir_path: 
+            abs_html_path_in_epub = os.path.join(opf_dir_path, current_html_file_path_relative_to_opf)
+            html_abs_dir_in_epub = os.path.dirname(abs_html_path_in_epub)
+        else: 
+            html_abs_dir_in_epub = os.path.dirname(current_html_file_path_relative_to_opf)
+        if html_abs_dir_in_epub == '.': html_abs_dir_in_epub = ""
+        css_dir_from_root = os.path.join(opf_dir_path or "", "Styles")
+        abs_stylesheet_path_in_epub = os.path.join(css_dir_from_root, "stylesheet.css")
+        abs_stylesheet_path_in_epub = os.path.normpath(abs_stylesheet_path_in_epub).replace('\\','/')
+        html_abs_dir_in_epub = os.path.normpath(html_abs_dir_in_epub).replace('\\','/')
+        try: stylesheet_path_final = os.path.relpath(abs_stylesheet_path_in_epub, start=html_abs_dir_in_epub).replace('\\','/')
+        except ValueError:
+            if not html_abs_dir_in_epub: stylesheet_path_final = abs_stylesheet_path_in_epub.lstrip('/')
+            else: stylesheet_path_final = abs_stylesheet_path_in_epub
+    stylesheet_link_tag = f'<link rel="stylesheet" type="text/css" href="{html.escape(stylesheet_path_final, quote=True)}"/>'
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="ru" xml:lang="ru">
+<head>
+<meta charset="utf-8" />
+<title>{final_title_text_for_html_tag}</title>
+{stylesheet_link_tag}
+</head>
+<body>
+{body_content_final}
+</body>
+</html>"""
+
+def write_to_html(out_path, translated_content_with_placeholders, image_map, title):
+    """Creates HTML file with embedded Base64 images."""
+    if image_map is None: image_map = {}
+    print(f"[INFO] HTML: Creating HTML file with embedded images: {out_path}")
+    html_body_parts = []
+
+    lines = translated_content_with_placeholders.splitlines() # Разделяем по \n, если они там есть (обычно нет, если <br />)
+    paragraph_buffer = []
+    data_uris = {} # saved_path -> экранированный data URI: одно изображение кодируется в Base64 один раз
+
+    def embed_image(img_uuid):
+        img_info = image_map.get(img_uuid)
+        if img_info is None:
+            print(f"[WARN] HTML Write: Placeholder UUID '{img_uuid}' not found."); return f"[Unk Img: {img_uuid[:8]}]"
+        img_path = img_info['saved_path']
+        if not os.path.exists(img_path):
+            print(f"[ERROR] HTML Write: Image path not found: {img_path}"); return f"[Img path miss: {img_uuid[:8]}]"
+        try:
+            data_uri = data_uris.get(img_path)
+            if data_uri is None:
+                with open(img_path, 'rb') as f_img: img_data = f_img.read()
+                b64_data = base64.b64encode(img_data).decode('ascii')
+                content_type = img_info.get('content_type', 'image/jpeg')
+                data_uri = data_uris[img_path] = html.escape(f"data:{content_type};base64,{b64_data}", quote=True)
+            alt_text = html.escape(img_info.get('original_filename', f'Image {img_uuid[:8]}'), quote=True)
+            return f'<img src="{data_uri}" alt="{alt_text}" style="max-width: 100%; height: auto;" />'
+        except Exception as img_err:
+            print(f"[ERROR] HTML Write: Failed to read/encode image {img_path}: {img_err}"); return f"[Err embed img: {img_uuid[:8]}]"
+
+    def process_text_block_for_html(text_block):
+        return render_inline_markdown(text_block, image_renderer=embed_image)
+
+    def flush_paragraph(separator):
+        para_content = process_text_block_for_html(separator.join(paragraph_buffer)); paragraph_buffer.clear()
+        if para_content.strip(): html_body_parts.append(f"<p>{para_content}</p>\n")
+
+    current_list_type = None 
+    in_code_block = False
+    code_block_lines = []
+
+    for line in lines: # line может содержать <br />
+        stripped_line = line.strip()
+        is_code_fence = stripped_line == '```'
+
+        if is_code_fence:
+            if not in_code_block:
+                if paragraph_buffer: html_body_parts.append(f"<p>{process_text_block_for_html('<br/>'.join(paragraph_buffer))}</p>\n"); paragraph_buffer.clear()
+                if current_list_type: html_body_parts.append(f"</{current_list_type}>\n"); current_list_type = None
+                in_code_block = True; code_block_lines = []
+            else:
+                in_code_block = False
+                escaped_code = html.escape("\n".join(code_block_lines)) # Экранируем все содержимое блока кода
+                html_body_parts.append(f"<pre><code>{escaped_code}</code></pre>\n")
+            continue
+
+        if in_code_block:
+            code_block_lines.append(line); continue
+
+        heading_match = MD_HEADING_PATTERN.match(stripped_line)
+        hr_match = stripped_line == '---'
+        ul_match = MD_UL_ITEM_PATTERN.match(stripped_line)
+        ol_match = MD_OL_ITEM_PATTERN.match(stripped_line)
+
+        if current_list_type and not ((current_list_type == 'ul' and ul_match) or (current_list_type == 'ol' and ol_match)):
+             html_body_parts.append(f"</{current_list_type}>\n"); current_list_type = None
+        if paragraph_buffer and (heading_match or hr_match or ul_match or ol_match):
+             flush_paragraph("<br/>")
+
+        if heading_match:
+            level = len(heading_match.group(1)); heading_text = process_text_block_for_html(heading_match.group(2).strip())
+            if heading_text: html_body_parts.append(f"<h{level}>{heading_text}</h{level}>\n")
+        elif hr_match:
+             html_body_parts.append("<hr/>\n")
+        elif ul_match:
+             if current_list_type != 'ul': html_body_parts.append("<ul>\n"); current_list_type = 'ul'
+             html_body_parts.append(f"<li>{process_text_block_for_html(ul_match.group(1).strip())}</li>\n")
+        elif ol_match:
+             if current_list_type != 'ol': html_body_parts.append("<ol>\n"); current_list_type = 'ol'
+             html_body_parts.append(f"<li>{process_text_block_for_html(ol_match.group(1).strip())}</li>\n")
+        elif line: 
+             paragraph_buffer.append(line) # line уже содержит <br /> если они были
+        elif paragraph_buffer: 
+             flush_paragraph("") # Не соединяем через <br/>, т.к. они уже есть
+
+    if current_list_type: html_body_parts.append(f"</{current_list_type}>\n")
+    if paragraph_buffer:
+        flush_paragraph("") # Не соединяем через <br/>
+    if in_code_block:
+        escaped_code = html.escape("\n".join(code_block_lines))
+        html_body_parts.append(f"<pre><code>{escaped_code}</code></pre>\n")
+    html_body_content = "".join(html_body_parts)
+
+    safe_title = html.escape(title or "Переведенный документ")
+    html_template = f"""<!DOCTYPE html>
+<html lang="ru">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>{safe_title}</title>
+<style>
+body {{ font-family: sans-serif; line-height: 1.6; margin: 2em auto; max-width: 800px; padding: 0 1em; color: #333; background-color: #fdfdfd; }}
+p {{ margin-top: 0; margin-bottom: 1em; text-align: justify; }}
+h1, h2, h3, h4, h5, h6 {{ margin-top: 1.8em; margin-bottom: 0.6em; line-height: 1.3; font-weight: normal; color: #111; border-bottom: 1px solid #eee; padding-bottom: 0.2em;}}
+h1 {{ font-size: 2em; }} h2 {{ font-size: 1.7em; }} h3 {{ font-size: 1.4em; }}
+img {{ max-width: 100%; height: auto; display: block; margin: 1.5em auto; border: 1px solid #ddd; border-radius: 4px; box-shadow: 0 1px 3px rgba(0,0,0,0.1); }}
+hr {{ border: none; border-top: 1px solid #ccc; margin: 2.5em 0; }}
+ul, ol {{ margin-left: 1.5em; margin-bottom: 1em; padding-left: 1.5em; }}
+li {{ margin-bottom: 0.4em; }}
+strong {{ font-weight: bold; }}
+em {{ font-style: italic; }}
+a {{ color: #007bff; text-decoration: none; }} a:hover {{ text-decoration: underline; }}
+code {{ background-color: #f0f0f0; padding: 0.1em 0.3em; border-radius: 3px; font-family: Consolas, monospace; font-size: 0.9em; }}
+pre {{ background-color: #f5f5f5; border: 1px solid #ddd; border-radius: 4px; padding: 1em; overflow-x: auto; white-space: pre; }}
+pre code {{ background-color: transparent; padding: 0; border-radius: 0; font-size: 0.9em; }}
+</style>
+</head>
+<body>
+{html_body_content.strip()}
+</body>
+</html>"""
+    try:
+        with open(out_path, "w", encoding="utf-8") as f: f.write(html_template)
+        print(f"[SUCCESS] HTML file saved: {out_path}")
+    except Exception as write_err: print(f"[ERROR] Failed to write HTML file {out_path}: {write_err}"); raise
+
+class StreamingTextWriter:
+    """Пишет TXT/MD по чанкам в порядке перевода, не собирая весь текст в памяти.
+
+    Результат тот же, что у separator.join(chunks).strip() с последующим transform (замена
+    <br>, плейсхолдеров): пробельный хвост куска придерживается до следующего непустого и
+    в конце отбрасывается. Пишется во временный <out_path>.part, close() переименовывает его.
+    """
+    def __init__(self, out_path, separator="\n\n", transform=None):
+        self.out_path = out_path
+        self.temp_path = f"{out_path}.part"
+        self.separator = separator
+        self.transform = transform
+        self.chunks_written = 0
+        self._started = False
+        self._pending_whitespace = ""
+        self._file = open(self.temp_path, 'w', encoding='utf-8')
+
+    def write(self, text):
+        piece = f"{self.separator}{text}" if self.chunks_written else text
+        self.chunks_written += 1
+        if not self._started:
+            piece = piece.lstrip()
+            if not piece: return
+            self._started = True
+        body = piece.rstrip()
+        if not body: self._pending_whitespace += piece; return
+        self._file.write(self._pending_whitespace)
+        self._file.write(self.transform(body) if self.transform else body)
+        self._pending_whitespace = piece[len(body):]
+
+    def close(self):
+        self._file.close()
+        os.replace(self.temp_path, self.out_path)
+
+    def abort(self):
+        self._file.close()
+        try: os.remove(self.temp_path)
+        except OSError: pass
+
+FB2_NS = "http://www.gribuser.ru/xml/fictionbook/2.0"
+XLINK_NS = "http://www.w3.org/1999/xlink"
+FB2_BASE64_CHUNK_BYTES = 3 * 16384 # Кратно 3, чтобы куски base64 склеивались без паддинга внутри
+_FB2_HEADING_RE = re.compile(r'^(#{1,3})\s+(.*)')
+
+
+def _iter_fb2_blocks(text):
+    """Разбирает текст построчно (без копии списка строк): ('section', заголовок или None) и ('p', текст абзаца)."""
+    para_buffer = []; section_started = False
+    for line in io.StringIO(text, newline=None):
+        line = line.rstrip("\n")
+        stripped_line = line.strip()
+        chapter_match = _FB2_HEADING_RE.match(stripped_line)
+        if chapter_match:
+            if para_buffer:
+                yield 'p', "\n".join(para_buffer)
+            para_buffer = []
+            yield 'section', chapter_match.group(2).strip()
+            section_started = True
+        elif stripped_line:
+            if not section_started:
+                yield 'section', None
+                section_started = True
+            para_buffer.append(line)
+        elif para_buffer:
+            yield 'p', "\n".join(para_buffer); para_buffer = []
+    if para_buffer:
+        yield 'p', "\n".join(para_buffer)
+
+
+def _iter_base64_file(f, chunk_size=FB2_BASE64_CHUNK_BYTES):
+    while True:
+        block = f.read(chunk_size)
+        if not block: return
+        yield base64.b64encode(block).decode('ascii')
+
+
+def write_to_fb2(out_path, translated_content_with_placeholders, image_map, title):
+    """Пишет FB2 потоково (lxml.etree.xmlfile): секции уходят в файл по мере разбора текста,
+    изображения кодируются в base64 кусками прямо с диска после <body>. В памяти одновременно
+    держится только текущий абзац и один кусок изображения.
+    """
+    if not LXML_AVAILABLE: raise ImportError("lxml library is required to write FB2 files.")
+    if image_map is None: image_map = {}
+    print(f"[INFO] FB2: Creating FB2 file with image support: {out_path}")
+
+    l_href_attr = f"{{{XLINK_NS}}}href"
+    binary_ids = {} # UUID -> id в <binary>, в порядке первого появления в тексте
+    path_binary_ids = {} # saved_path -> id в <binary>: разные UUID одного файла встраиваются один раз
+    binaries = [] # (binary_id, content_type, путь к файлу)
+    stats = {'placeholders': 0, 'unknown_uuid': 0, 'missing_file': 0, 'binary_errors': 0}
+
+    def binary_id_for(img_uuid):
+        if img_uuid in binary_ids: return binary_ids[img_uuid]
+        img_info = image_map.get(img_uuid)
+        if img_info is None:
+            stats['unknown_uuid'] += 1; return None
+        img_path = img_info.get('saved_path')
+        if not img_path or not os.path.exists(img_path):
+            stats['missing_file'] += 1; return None
+        if img_path in path_binary_ids:
+            binary_ids[img_uuid] = path_binary_ids[img_path]
+            return binary_ids[img_uuid]
+        binary_id = re.sub(r'[^\w.-]', '_', f"img_{img_uuid[:8]}_{len(binaries) + 1}")
+        binaries.append((binary_id, img_info.get('content_type', 'image/jpeg'), img_path))
+        binary_ids[img_uuid] = path_binary_ids[img_path] = binary_id
+        return binary_id
+
+    def build_paragraph(para_text):
+        full_para_text = para_text.strip()
+        if not full_para_text: return None
+        p = etree.Element("p"); current_tail_element = None; last_index = 0
+
+        def append_text(text):
+            if current_tail_element is not None: current_tail_element.tail = (current_tail_element.tail or "") + text
+            else: p.text = (p.text or "") + text
+
+        for match in IMAGE_PLACEHOLDER_PATTERN.finditer(full_para_text):
+            stats['placeholders'] += 1
+            if match.start() > last_index: append_text(full_para_text[last_index:match.start()])
+            img_uuid = match.group(2)
+            binary_id = binary_id_for(img_uuid)
+            if binary_id is not None:
+                current_tail_element = etree.SubElement(p, "image", nsmap={"l": XLINK_NS})
+                current_tail_element.set(l_href_attr, f"#{binary_id}")
+            else:
+                original_filename_fb2 = image_map.get(img_uuid, {}).get('original_filename', img_uuid)
+                append_text(f" [Img Placeholder {img_uuid[:8]} found in text, but no binary data prepared (orig: {original_filename_fb2})] ")
+                current_tail_element = None
+            last_index = match.end()
+        if last_index < len(full_para_text): append_text(full_para_text[last_index:])
+        if len(p) == 0 and not (p.text or "").strip(): return None
+        return p
+
+    description = etree.Element("description")
+    title_info = etree.SubElement(description, "title-info")
+    etree.SubElement(title_info, "genre").text = "unspecified"
+    author_elem = etree.SubElement(title_info, "author"); etree.SubElement(author_elem, "first-name").text = "Translator"
+    etree.SubElement(title_info, "book-title").text = title or "Переведенный Документ"
+    etree.SubElement(title_info, "lang").text = "ru"
+    document_info = etree.SubElement(description, "document-info")
+    doc_author = etree.SubElement(document_info, "author"); etree.SubElement(doc_author, "nickname").text = "TranslatorApp"
+    etree.SubElement(document_info, "program-used").text = "TranslatorApp using Gemini"; etree.SubElement(document_info, "date", attrib={"value": time.strftime("%Y-%m-%d")}).text = time.strftime("%d %B %Y", time.localtime()); etree.SubElement(document_info, "version").text = "1.0"
+
+    section_count = 0
+    try:
+        with etree.xmlfile(out_path, encoding="utf-8") as xf:
+            xf.write_declaration()
+            with xf.element("FictionBook", nsmap={None: FB2_NS, "l": XLINK_NS}):
+                xf.write("\n"); xf.write(description, pretty_print=True)
+                with xf.element("body"):
+                    xf.write("\n")
+                    section = None
+                    for kind, value in _iter_fb2_blocks(translated_content_with_placeholders):
+                        if kind == 'section':
+                            if section is not None: section.__exit__(None, None, None); xf.write("\n")
+                            section = xf.element("section"); section.__enter__(); section_count += 1
+                            title_p = build_paragraph(value) if value else None
+                            if title_p is not None:
+                                title_elem = etree.Element("title"); title_elem.append(title_p)
+                                xf.write(title_elem, pretty_print=True)
+                        else:
+                            paragraph = build_paragraph(value)
+                            if paragraph is not None: xf.write(paragraph, pretty_print=True)
+                    if section is not None: section.__exit__(None, None, None)
+                    else:
+                        print("[WARN] FB2: No sections created. Adding empty fallback section.")
+                        xf.write(etree.Element("section"))
+                    xf.write("\n")
+                xf.write("\n")
+                for binary_id, content_type, img_path in binaries:
+                    try:
+                        img_file = open(img_path, 'rb')
+                    except OSError as e:
+                        stats['binary_errors'] += 1
+                        print(f"[ERROR] FB2: Failed to read image {img_path}: {e}"); continue
+                    with img_file, xf.element("binary", {"id": binary_id, "content-type": content_type}):
+                        for encoded_chunk in _iter_base64_file(img_file): xf.write(encoded_chunk)
+                    xf.write("\n")
+        print(f"[INFO] FB2: sections: {section_count}, placeholders: {stats['placeholders']}, images embedded: {len(binaries) - stats['binary_errors']}, "
+              f"unknown UUIDs: {stats['unknown_uuid']}, missing files: {stats['missing_file']}, read errors: {stats['binary_errors']}")
+        print(f"[SUCCESS] FB2 file saved: {out_path}")
+    except Exception as write_err:
+        print(f"[ERROR] Failed to write FB2 file {out_path}: {write_err}"); raise write_err